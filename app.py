@@ -1,17 +1,23 @@
 import sys
+import logging
+import multiprocessing
 import crds_calc
-from pandas import read_csv, DataFrame
+import loader
+import pipeline
+import readers
+import store
+import workers
+from pandas import DataFrame
+from export import residuals_frame, summarize
 from PyQt5 import QtGui, QtWidgets, QtCore
-from db import mem
+from db import session
 from mainwin import Ui_MainWindow
-from widgets import BaseGraph
+from widgets import BaseGraph, TimingPanel
+from profiling import profiler
 import pathlib
 from re import search as re_search
 from varname.core import nameof
-from hashlib import md5
-from sqlitedict import SqliteDict
-from pprint import PrettyPrinter
-from numpy import average as np_average, arange, std as np_std
+from numpy import arange, asarray, ndarray
 from pyperclip import copy as pycopy
 from os import getcwd
 
@@ -50,76 +56,50 @@ class AppWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             msg.exec_()
 
         def select_csv():
-            filename, _ = QtWidgets.QFileDialog.getOpenFileName(self)
-            data = None
+            filename, _ = QtWidgets.QFileDialog.getOpenFileName(self, filter=readers.file_filter())
+            if not filename:
+                return
             try:
-                data = read_csv(filename, comment="%", delimiter=";").to_numpy()
+                channels = readers.load(filename, timestep=self.spin_timestep.value())
+            except ValueError as e:
+                display_error(str(e))
+                return
             except:
                 return
-            mem['x_data'] = data.transpose()[0]
-            mem['y_data'] = data.transpose()[1]
-            # timestep = mem['x_data'][1] - mem['x_data'][0]
-            timestep = (mem['x_data'][-1] - mem['x_data'][0]) / len(mem['x_data'])
-            mem['timestep'] = timestep
+            # The graphs need whole channels; memmaps stay as they are, lazy channels get read here
+            x_data, y_data, v_data = [c if c is None or isinstance(c, ndarray) else asarray(c) for c in channels]
+            self.store = None # still the previous scan's store; don't write this scan's values into it
+            session.clear() # New scan, drop results from the previous one
+            self.analysis.set_data(x_data, y_data, v_data, key=loader.fingerprint(filename))
+            session.x_data = x_data
+            session.y_data = y_data
+            # timestep = session.x_data[1] - session.x_data[0]
+            timestep = (session.x_data[-1] - session.x_data[0]) / len(session.x_data)
+            session.timestep = timestep
             self.spin_timestep.setValue(timestep)
-            def set_timestep(x):
-                mem['timestep'] = x
-            self.spin_timestep.valueChanged.connect(lambda v: set_timestep(v))
             self.raw_data_graph.plot() # Graph new stuff
+            self.timing_panel.refresh()
 
             # self.groups_graph.clear() # Clear old stuff
             self.voltage_graph.clear()
             self.added_peaks_graph.clear()
             # self.tau_graph.clear()
 
-            mem['ymin'], mem['ymax'] = crds_calc.minmax(mem['y_data'])
+            session.ymin, session.ymax = crds_calc.minmax(session.y_data)
 
-            try:
-                mem['v_data'] = data.transpose()[2]
+            if v_data is not None:
+                session.v_data = v_data
                 self.voltage_graph.plot()
                 self.graph_tabs.setCurrentIndex(1)
-            except IndexError:
+            else:
                 display_warning('No voltage column detected. VThreshold algo will not work.')
                 self.voltage.setVisible(False)
                 self.graph_tabs.setCurrentIndex(0)
 
-            # Load from persistent storage & bind write actions
-            # NOTE: This is incomplete, but can very easily finished if someone can figure out what's wrong.
-            # Currently using https://github.com/RaRe-Technologies/sqlitedict for local db handling.
-
-            # path_hash = md5(filename.encode('utf-8')).hexdigest()
-
-            # def set_value(name, val):
-            #     with SqliteDict(f"{getcwd()}/db/{path_hash}.sqlite", autocommit=True) as storage:
-            #         print(f"Change {name} to {val}.")
-            #         storage[name] = val
-            #         storage.commit()
-            #         print(f"Check: {storage[name]}")
-
-            #     with SqliteDict(f"{getcwd()}/db/{path_hash}.sqlite", autocommit=True) as storage:
-            #         print(f"Check: {storage[name]}")
-
-            # with SqliteDict(f"{getcwd()}/db/{path_hash}.sqlite", autocommit=True) as storage:
-
-            #     for w in synced_value_widgets:
-            #         name = w.objectName()
-            #         try:
-            #             w.setValue(storage[name])
-            #             print(f"Loaded {name}.")
-            #         except KeyError:
-            #             print(f"Failed to load object {name}.")
-            #             pass
-            #         w.valueChanged.connect(lambda x: set_value(name, x))
-
-            #     for w in synced_check_widgets:
-            #         name = w.objectName()
-            #         try:
-            #             w.setChecked(bool(storage[name]))
-            #             print(f"Loaded {name} as {storage[name]}.")
-            #         except KeyError:
-            #             print(f"Failed to load object {name}.")
-            #             pass
-            #         w.stateChanged.connect(lambda: set_value(name, w.isChecked()))
+            # Load from persistent storage (inputs & the last stage run on this scan)
+            project = store.ProjectStore.for_file(filename)
+            restore_analysis(project)
+            self.store = project
 
         # Universal Actions stuff
 
@@ -133,6 +113,10 @@ class AppWindow(QtWidgets.QMainWindow, Ui_MainWindow):
 
         # Inputs
 
+        def set_timestep(x):
+            session.timestep = x
+        self.spin_timestep.valueChanged.connect(set_timestep)
+
         def switch_grouping_algo():
             algo = self.combo_grouping_algo.currentIndex()
             self.grouping_config_area.setCurrentIndex(algo)
@@ -169,124 +153,242 @@ class AppWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             self.spin_moving_average_denom_2.setEnabled(enabled)
         self.check_advanced_peak_detection.stateChanged.connect(update_advanced_peak_detection_setting)
 
+        # Worker processes only apply to per-peak curve_fit
+        def update_fit_method_setting():
+            enabled = pipeline.FIT_METHODS[self.combo_fit_method.currentIndex()] == 'curve_fit'
+            self.spin_fit_workers.setEnabled(enabled)
+            self.spin_fit_chunksize.setEnabled(enabled)
+        self.combo_fit_method.currentIndexChanged.connect(update_fit_method_setting)
+
+
+        def get_params(): # Current input values, keyed like pipeline.DEFAULT_PARAMS
+            params = {w.objectName(): w.value() for w in synced_value_widgets}
+            params.update({w.objectName(): w.isChecked() for w in synced_check_widgets})
+            params['combo_grouping_algo'] = self.combo_grouping_algo.currentIndex()
+            params['combo_stacking'] = self.combo_stacking.currentIndex()
+            params['combo_fit_method'] = self.combo_fit_method.currentIndex()
+            return params
+
+        def set_params(params: dict):
+            for name, value in params.items():
+                w = getattr(self, name, None)
+                if w in synced_value_widgets:
+                    w.setValue(value)
+                elif w in synced_check_widgets:
+                    w.setChecked(bool(value))
+                elif name in ['combo_grouping_algo', 'combo_stacking', 'combo_fit_method']:
+                    w.setCurrentIndex(value)
+
+        # Inputs are saved per scan as soon as they change
+        self.store = None
+
+        def save_inputs():
+            if self.store is None:
+                return
+            try:
+                self.store.save_inputs(get_params())
+            except OSError as e:
+                self.statusbar.showMessage(f"Couldn't save inputs: {e}", 5000)
+
+        for w in synced_value_widgets:
+            w.valueChanged.connect(lambda _: save_inputs())
+        for w in synced_check_widgets:
+            w.stateChanged.connect(lambda _: save_inputs())
+        self.combo_grouping_algo.currentIndexChanged.connect(lambda _: save_inputs())
+        self.combo_stacking.currentIndexChanged.connect(lambda _: save_inputs())
+        self.combo_fit_method.currentIndexChanged.connect(lambda _: save_inputs())
+
+        def save_results(stage: str, params: dict):
+            if self.store is None:
+                return
+            names = set([n for names in store.STAGE_RESULTS.values() for n in names])
+            try:
+                self.store.save_results(stage, params, {n: getattr(session, n) for n in names})
+            except OSError as e:
+                self.statusbar.showMessage(f"Couldn't save results: {e}", 5000)
+
+        # Stages run in the background; results get handed back to the graphs when done
+        self.jobs = workers.JobRunner(self.statusbar, [self.actionOpen_CSV_File, self.correlate_button, self.peak_add_button, self.isolate_button, self.fit_button])
+        self.jobs.failed.connect(display_error)
+
+        # Per-stage timing (& peak memory, if traced from the panel), refreshed whenever a stage is done
+        profiler.enable()
+        self.timing_panel = TimingPanel(self)
+        self.addDockWidget(QtCore.Qt.BottomDockWidgetArea, self.timing_panel)
+        self.jobs.idle.connect(self.timing_panel.refresh)
+
+        # Stage outputs are memoized, so a button only recomputes what its inputs invalidated
+        analysis = pipeline.Pipeline()
+        self.analysis = analysis
+
+        def require_data():
+            if session.x_data is None:
+                display_error('No data loaded. Import a data file first.')
+                return False
+            return True
+
+        def show_correlated(alignment): # overlayed groups, lags & correlation heights
+            groups_correlated, _, session.correlation_heights = alignment
+            if groups_correlated is session.groups_correlated:
+                return # already showing these
+            session.groups_correlated = groups_correlated
+            self.groups_graph.plot()
+
+        def show_added(added_peaks):
+            session.added_peaks = added_peaks
+            self.added_peaks_graph.set_params(None, shift_over=None)
+            self.added_peaks_graph.plot()
+
+        def show_isolated(results, params):
+            if results[2] is session.isolated_peaks:
+                return
+            session.added_peaks, session.peak_indices, session.isolated_peaks = results
+            self.added_peaks_graph.set_params(params['spin_peak_overlap'], shift_over=params['spin_shift_over'])
+            self.added_peaks_graph.plot()
 
         def init_correlate():
-            groups_raw = None
-            algo = self.combo_grouping_algo.currentIndex()
-            try:
-                if algo == 0:
-                    groups_raw = crds_calc.vthreshold(
-                        mem['x_data'],
-                        mem['y_data'],
-                        mem['v_data'],
-                        self.spin_min_voltage.value(),
-                        self.spin_max_voltage.value(),
-                        mirrored=False if self.check_skip_groups.checkState() == 0 else True,
-                        start=self.spin_start_time.value() if self.check_custom_start.isChecked() else None,
-                        end=self.spin_end_time.value() if self.check_custom_end.isChecked() else None
-                    )
-                    # display_error('VThreshold not yet implemented.')
-                    # return
-
-                elif algo == 1:
-                    groups_raw = crds_calc.spaced_groups(
-                        mem['x_data'],
-                        mem['y_data'],
-                        self.spin_group_len.value(),
-                        self.spin_min_peakheight.value(),
-                        self.spin_min_peakprominence.value(),
-                        self.spin_moving_average_denom.value(),
-                        mirrored=False if self.check_skip_groups.checkState() == 0 else True,
-                        start=self.spin_start_time.value() if self.check_custom_start.isChecked() else None,
-                        end=self.spin_end_time.value() if self.check_custom_end.isChecked() else None
-                    )
-
-                if groups_raw == None or len(groups_raw) < 1:
-                    display_error("No groups were detected. Try adjusting grouping parameters.")
-
-                mem['groups_correlated'] = crds_calc.correlate_groups(groups_raw)
-
-                # Graphing action
-                self.groups_graph.plot()
+            if not require_data():
+                return
+            params = get_params()
+
+            def done(alignment):
+                show_correlated(alignment)
+                save_results('correlate', params)
                 self.graph_tabs.setCurrentIndex(2)
 
-            except KeyError:
-                display_error('Failed to correlate. Did you import a data file & set parameters?')
+            self.jobs.start('Correlating', lambda progress: analysis.align(params, progress=progress), done)
         self.correlate_button.pressed.connect(init_correlate)
 
         def init_add_simple():
-            try:
-                mem['added_peaks'] = crds_calc.add_peaks_only(mem['groups_correlated'])
+            if not require_data():
+                return
+            params = get_params()
+
+            def work(progress):
+                return analysis.align(params, progress=progress), analysis.add(params, progress=progress)
 
-                self.added_peaks_graph.set_params(None, shift_over=None)
-                self.added_peaks_graph.plot()
+            def done(results):
+                alignment, added_peaks = results
+                show_correlated(alignment)
+                show_added(added_peaks)
+                save_results('add', params)
                 self.graph_tabs.setCurrentIndex(3)
 
-            except KeyError:
-                display_error("Correlated groups not found. Group peaks first.")
+            self.jobs.start('Adding peaks', work, done)
         self.peak_add_button.pressed.connect(init_add_simple)
             
 
         def init_add():
-            try:
-                mem['added_peaks'], mem['peak_indices'], mem['isolated_peaks'] = crds_calc.isolate_peaks(
-                    mem['groups_correlated'],
-                    self.spin_peak_overlap.value(),
-                    self.spin_moving_average_denom.value(),
-                    peak_prominence=self.spin_min_peak_height_added.value(),
-                    peak_minheight=self.spin_peak_prominence_added.value(),
-                    shift_over=self.spin_shift_over.value()
-                )
-                self.added_peaks_graph.set_params(self.spin_peak_overlap.value(), shift_over=self.spin_shift_over.value())
-                self.added_peaks_graph.plot()
+            if not require_data():
+                return
+            params = get_params()
+
+            def work(progress):
+                return analysis.align(params, progress=progress), analysis.isolate(params, progress=progress)
+
+            def done(results):
+                show_correlated(results[0])
+                session.isolated_peaks = None # always redraw the cut-out zones
+                show_isolated(results[1], params)
+                save_results('isolate', params)
                 self.graph_tabs.setCurrentIndex(3)
 
-            except KeyError:
-                display_error("Correlated groups not found. Group peaks first.")
+            self.jobs.start('Isolating peaks', work, done)
         self.isolate_button.pressed.connect(init_add)
 
         def init_fit():
-            if not 'isolated_peaks' in mem:
-                display_error('Peaks not yet isolated.')
+            if not require_data():
                 return
-            mem['fit_equations'] = crds_calc.fit_peaks(
-                mem['isolated_peaks'],
-                mem['peak_indices'],
-                self.spin_min_peakheight_2.value(),
-                self.spin_min_peakprominence_2.value(),
-                self.spin_moving_average_denom_2.value(),
-                self.spin_var_a.value(),
-                self.spin_var_tau.value(),
-                self.spin_var_y0.value(),
-                self.spin_shift_over_fit.value(),
-                self.check_advanced_peak_detection.isChecked()
-            )
-            mem['shift_over_fit'] = self.spin_shift_over_fit.value()
-            # print(mem['fit_equations'])
+            params = get_params()
+
+            timestep = session.timestep
+
+            def work(progress):
+                fit_results = analysis.fit(params, progress=progress)
+                return (
+                    analysis.align(params, progress=progress), analysis.isolate(params, progress=progress), fit_results, analysis.residuals(params),
+                    analysis.tau(params, timestep), analysis.gate(params), analysis.stats(params, timestep)
+                )
+
+            def done(results):
+                alignment, isolate_results, fit_results, residual_results, time_constants, quality, tau_stats = results
+                show_correlated(alignment)
+                show_isolated(isolate_results, params)
+                show_fit(fit_results, residual_results, time_constants, quality, tau_stats, timestep, params)
+                save_results('fit', params)
+
+            self.jobs.start('Fitting', work, done)
+        self.fit_button.pressed.connect(init_fit)
+
+        def show_fit(fit_results, residual_results, time_constants, quality, tau_stats, timestep, params):
+            session.fit_equations, session.overlayed_peak_indices = fit_results
+            session.residuals, session.chi2_red, session.r_squared = residual_results
+            session.shift_over_fit = params['spin_shift_over_fit']
+            # print(session.fit_equations)
             self.peak_fit_viewer.plot()
 
-            mem['time_constants'] = crds_calc.get_time_constants(mem['fit_equations'])
+            session.time_constants = time_constants
+            session.quality = quality
+            session.tau_stats = tau_stats
+            session.timestep = timestep
             self.tau_viewer.plot()
+            show_tau_summary()
 
-            tau_out = ""
-            for p_i in range(len(mem['time_constants'][0])):
-                tau_avg = np_average(mem['time_constants'][0:len(mem['time_constants'])][p_i])
-                tau_std = np_std(mem['time_constants'][0:len(mem['time_constants'])][p_i])
+        def restore_analysis(project):
+            inputs = project.load_inputs()
+            if inputs is not None:
+                set_params(inputs)
+            try:
+                stage, params, results = project.load_results()
+            except (OSError, ValueError, KeyError) as e:
+                display_warning(f"Couldn't load the saved analysis of this scan: {e}")
+                return
+            if stage is None:
+                return
+            params = {**pipeline.DEFAULT_PARAMS, **params} # saved before newer inputs existed
+
+            # Stored outputs go straight into the stage cache & the graphs, nothing gets recomputed
+            derived = analysis.restore(params, results)
+            show_correlated((results['groups_correlated'], None, results.get('correlation_heights')))
+            self.graph_tabs.setCurrentIndex(2)
+            if stage == 'add':
+                show_added(results['added_peaks'])
+                self.graph_tabs.setCurrentIndex(3)
+            elif stage in ['isolate', 'fit']:
+                show_isolated((results['added_peaks'], results['peak_indices'], results['isolated_peaks']), params)
+                self.graph_tabs.setCurrentIndex(3)
+            if stage == 'fit':
+                show_fit(
+                    (results['fit_equations'], results['overlayed_peak_indices']),
+                    (results['residuals'], results['chi2_red'], results['r_squared']),
+                    results['time_constants'],
+                    derived.get('quality'),
+                    derived.get('tau_stats'),
+                    results['timestep'],
+                    params
+                )
+            self.statusbar.showMessage(f"Restored saved analysis ({stage}).", 5000)
 
-                pp = PrettyPrinter(indent=2)
+        def show_tau_summary():
+            stats = session.tau_stats
+            tau_out = ""
+            for p_i in range(len(stats['n'])):
                 tau_out += f"""
-Tooth: {p_i+1}
-Tau Average: {tau_avg}
-Tau StD: {tau_std}
+Tooth: {p_i+1} (n = {stats['n'][p_i]})
+Tau Average: {stats['mean'][p_i]} ± {stats['se'][p_i]} (95% CI {stats['ci_low'][p_i]} - {stats['ci_high'][p_i]})
+Tau StD: {stats['std'][p_i]}
+Tau Median: {stats['median'][p_i]} (MAD {stats['mad'][p_i]})
+Tau Average, outliers rejected: {stats['clipped_mean'][p_i]} ± {stats['clipped_std'][p_i]} (n = {stats['clipped_n'][p_i]})
                 """
-# NOTE: Insert above inside fstring to see raw data; 
-# no one should really want to see that standalone?
-# Raw Tau Data:\n{pp.pformat(mem['time_constants'])}
+                if session.quality is not None:
+                    counts = session.quality['counts']
+                    reasons = ', '.join([f"{c} {counts[c][p_i]}" for c in crds_calc.GATE_CHECKS if counts[c][p_i] > 0])
+                    tau_out += f"Fits rejected: {counts['total'][p_i]}" + (f" ({reasons})" if reasons else "") + "\n"
+# NOTE: Raw tau data is in the Tau CSV export; no one should really want to see that here
 
             self.tau_output.setText(tau_out)
 
             self.graph_tabs.setCurrentIndex(5)
-        self.fit_button.pressed.connect(init_fit)
 
         # Show equation
 
@@ -300,13 +402,11 @@ Tau StD: {tau_std}
         # Tau output actions
         self.copy_results_button.pressed.connect(lambda: pycopy(self.tau_output.toPlainText()))
         def export_csv():
-            try:
-                mem['time_constants']
-            except KeyError:
+            if session.time_constants is None:
                 display_error("No tau data to export.")
                 return
             filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Export CSV", "file.csv")
-            df = DataFrame(mem['time_constants'])
+            df = DataFrame(session.time_constants)
             # df.index = arange(1, len(df)+1)
             try:
                 df.to_csv(filename, index=False)
@@ -315,13 +415,11 @@ Tau StD: {tau_std}
         self.export_csv_button.pressed.connect(export_csv)
 
         def export_csv_residuals():
-            try:
-                mem['residuals']
-            except KeyError:
+            if session.residuals is None:
                 display_error("No residual data to export.")
                 return
             filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Export Residuals CSV", "residuals.csv")
-            df = DataFrame(mem['residuals'])
+            df = residuals_frame(session.residuals)
             # df.index = arange(1, len(df)+1)
             try:
                 df.to_csv(filename, index=False)
@@ -329,11 +427,25 @@ Tau StD: {tau_std}
                 pass
         self.export_csv_button_resid.pressed.connect(export_csv_residuals)
 
+        def export_csv_summary():
+            if session.tau_stats is None:
+                display_error("No tau data to export.")
+                return
+            filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Export Summary CSV", "summary.csv")
+            df = summarize(session.tau_stats, session.chi2_red, session.r_squared, session.quality)
+            try:
+                df.to_csv(filename, index=False)
+            except:
+                pass
+        self.export_csv_button_summary.pressed.connect(export_csv_summary)
+
         # Show self
 
         self.show()
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support() # fit worker processes of the frozen (pyinstaller) app start here, not in the GUI
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(name)s: %(message)s')
     app = QtWidgets.QApplication(sys.argv)
     window = AppWindow()
     window.show()
@@ -0,0 +1,159 @@
+"""
+Benchmarks for the pipeline stages on synthetic scans with known time constants.
+
+Usage: python bench.py --groups 10 50 200 --teeth 8 --repeat 3
+
+Every stage is timed (best of `--repeat`) and its peak memory traced separately, on
+inputs produced by the stage before it. The fitted tau of every tooth is checked
+against the ground truth of the generator. With Numba installed, the NumPy & Numba
+kernels are also checked to give the same fits (including on flat & all-zero peaks).
+"""
+
+import os
+import sys
+import argparse
+import tracemalloc
+import numpy as np
+from time import perf_counter
+from tempfile import TemporaryDirectory
+import crds_calc
+import kernels
+import loader
+import pipeline
+import synthetic
+
+def measure(fn, repeat: int = 1):
+    """
+    Returns
+    -------
+    `tuple` of the result of `fn()`, best wall time in seconds & peak traced memory in bytes
+    """
+
+    best = np.inf
+    for _ in range(repeat):
+        t_start = perf_counter()
+        result = fn()
+        best = min(best, perf_counter() - t_start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+def tau_error(fit_equations, tau: np.array):
+    """
+    Median & worst relative error of the fitted tau (ticks) over all groups, per tooth
+    """
+
+    fitted = fit_equations.tau
+    error = np.abs(fitted - tau) / tau
+    return np.median(error), np.max(np.median(error, axis=0))
+
+def backend_parity(n_groups: int = 10, teeth: int = 8, samples_per_group: int = 50000):
+    """
+    Fit the same peaks with the NumPy & Numba kernels, with some peaks replaced by degenerate
+    rows (constant, all zero), which have to come out identical. Needs Numba.
+
+    Returns
+    -------
+    Largest relative difference of the fit parameters over the normal peaks & whether the
+    degenerate peaks match exactly
+    """
+
+    scan = synthetic.make_scan(n_groups=n_groups, teeth=teeth, samples_per_group=samples_per_group)
+    params = scan['params']
+    groups_raw = pipeline.stage_group(scan['x_data'], scan['y_data'], scan['v_data'], params)
+    _, peak_indices, isolated_peaks = pipeline.stage_isolate(crds_calc.correlate_groups(groups_raw), params)
+    degenerate = np.zeros(isolated_peaks.shape[:2], dtype=bool)
+    for g_i in range(isolated_peaks.n_groups):
+        n = isolated_peaks.lengths[g_i, 0]
+        isolated_peaks.data[g_i, 0, :n] = float(isolated_peaks.data[g_i, 0, 0]) if g_i % 2 else 0.0
+        degenerate[g_i, 0] = True
+
+    popt = {}
+    previous = kernels.backend
+    try:
+        for name in kernels.BACKENDS:
+            kernels.set_backend(name)
+            fit_equations, _ = pipeline.stage_fit(isolated_peaks, peak_indices, params, method='batch')
+            popt[name] = fit_equations.popt
+    finally:
+        kernels.set_backend(previous)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        difference = np.abs(popt['numba'] - popt['numpy']) / np.maximum(np.abs(popt['numpy']), 1e-300)
+    return float(np.nanmax(difference[~degenerate])), bool(np.array_equal(popt['numba'][degenerate], popt['numpy'][degenerate], equal_nan=True))
+
+def bench_scan(n_groups: int, teeth: int, samples_per_group: int, mirrored: bool, noise: float, repeat: int, curve_fit: bool, csv: bool):
+    scan = synthetic.make_scan(n_groups=n_groups, teeth=teeth, samples_per_group=samples_per_group, mirrored=mirrored, noise=noise)
+    params = scan['params']
+    x_data, y_data, v_data = scan['x_data'], scan['y_data'], scan['v_data']
+    rows = []
+
+    def record(stage, fn, items):
+        result, seconds, peak = measure(fn, repeat)
+        rows.append({'stage': stage, 'seconds': seconds, 'peak_mb': peak / 2**20, 'items': items})
+        return result
+
+    groups_raw = record('spaced_groups', lambda: pipeline.stage_group(x_data, y_data, v_data, dict(params, combo_grouping_algo=1)), len(y_data))
+    record('vthreshold', lambda: pipeline.stage_group(x_data, y_data, v_data, dict(params, combo_grouping_algo=0)), len(y_data))
+    groups_correlated = record('correlate_groups', lambda: crds_calc.correlate_groups(groups_raw), len(groups_raw))
+    _, peak_indices, isolated_peaks = record('isolate_peaks', lambda: pipeline.stage_isolate(groups_correlated, params), len(groups_raw))
+    n_peaks = isolated_peaks.n_groups * isolated_peaks.n_teeth
+    record('fit_peaks (quick)', lambda: pipeline.stage_fit(isolated_peaks, peak_indices, params, method='quick'), n_peaks)
+    fit_equations, _ = record('fit_peaks (batch)', lambda: pipeline.stage_fit(isolated_peaks, peak_indices, params, method='batch'), n_peaks)
+    if curve_fit:
+        record('fit_peaks (curve_fit)', lambda: pipeline.stage_fit(isolated_peaks, peak_indices, params, method='curve_fit'), n_peaks)
+
+    if csv:
+        with TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'scan.csv')
+            synthetic.write_csv(filename, scan)
+            record('load_csv (uncached)', lambda: loader.load_csv(filename, cache=False), len(y_data))
+            loader.load_csv(filename, cache_dir=tmp) # write the sidecar
+            record('load_csv (cached)', lambda: loader.load_csv(filename, cache_dir=tmp), len(y_data))
+
+    median_error, worst_tooth = tau_error(fit_equations, scan['tau'])
+    return rows, median_error, worst_tooth
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the CRDS pipeline stages on synthetic scans.')
+    parser.add_argument('--groups', type=int, nargs='+', default=[10, 50, 200], help='Scan sizes to run (number of sweeps)')
+    parser.add_argument('--teeth', type=int, default=8)
+    parser.add_argument('--samples-per-group', type=int, default=50000)
+    parser.add_argument('--noise', type=float, default=0.0005)
+    parser.add_argument('--no-mirror', action='store_true', help='Sawtooth instead of triangle piezo sweep')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage (best is reported)')
+    parser.add_argument('--curve-fit', action='store_true', help='Also time the per-peak curve_fit path (slow)')
+    parser.add_argument('--csv', action='store_true', help='Also time loading the scan from CSV')
+    parser.add_argument('--backend', choices=kernels.BACKENDS, default=kernels.backend, help='Kernel backend (numba if installed)')
+    parser.add_argument('--tolerance', type=float, default=0.02, help='Max median relative tau error per tooth')
+    args = parser.parse_args(argv)
+    kernels.set_backend(args.backend)
+
+    ok = True
+    for n_groups in args.groups:
+        rows, median_error, worst_tooth = bench_scan(
+            n_groups, args.teeth, args.samples_per_group, not args.no_mirror, args.noise,
+            args.repeat, args.curve_fit, args.csv
+        )
+        print(f"\n{n_groups} groups x {args.teeth} teeth, {n_groups * args.samples_per_group} samples ({kernels.backend})")
+        print(f"{'stage':<24}{'seconds':>10}{'peak MB':>10}{'items/s':>14}")
+        for r in rows:
+            print(f"{r['stage']:<24}{r['seconds']:>10.4f}{r['peak_mb']:>10.1f}{r['items'] / r['seconds']:>14.0f}")
+        print(f"tau error: {100*median_error:.2f}% median, {100*worst_tooth:.2f}% worst tooth")
+        if worst_tooth > args.tolerance:
+            print('FAILED: fitted tau is off from the ground truth')
+            ok = False
+
+    if kernels.numba is not None:
+        difference, degenerate_equal = backend_parity()
+        print(f"\nbackend parity (numpy vs numba fits): {difference:.2e} max relative difference, degenerate peaks {'identical' if degenerate_equal else 'DIFFERENT'}")
+        if difference > 1e-4 or not degenerate_equal: # normal peaks only differ by rounding, within the fit tolerance
+            print('FAILED: the kernel backends disagree')
+            ok = False
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
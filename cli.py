@@ -0,0 +1,152 @@
+"""
+Headless batch analysis: run the full CRDS pipeline over many scans.
+
+Usage: python cli.py params.json "scans/*.csv" -o results -j 4 (also .tdms, .h5, .bin)
+"""
+
+import sys
+import logging
+import argparse
+from glob import glob
+from time import perf_counter
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from pandas import DataFrame
+import kernels
+import pipeline
+import profiling
+import readers
+from profiling import profiler
+from export import summarize, residuals_frame
+
+def process_file(
+    filename: str,
+    params: dict,
+    out_dir: str,
+    fit_method: str = 'batch',
+    cache: bool = True,
+    residuals: bool = False,
+    profile: bool = False,
+    channels: dict = None,
+    raw_options: dict = None,
+    trace_memory: bool = False
+):
+    """
+    Load one scan (any format `readers` knows), run the pipeline & write `<name>_tau.csv`
+    and `<name>_summary.csv` (and `<name>_residuals.csv` with `residuals`).
+
+    Returns
+    -------
+    `dict` with the file name, sample count, group/tooth counts, elapsed time, error (if any)
+    & the stage records (with `profile`; with peak memory if `trace_memory`, which slows the stages down)
+    """
+
+    t_start = perf_counter()
+    report = {'file': filename, 'samples': 0, 'groups': 0, 'teeth': 0, 'seconds': 0.0, 'error': None, 'stages': []}
+    if profile:
+        profiler.clear()
+        profiler.enable(trace_memory=trace_memory)
+    try:
+        reader = readers.reader_for(filename)
+        options = {'timestep': params['spin_timestep']}
+        if reader is readers.read_csv:
+            options['cache'] = cache
+        elif reader is readers.read_binary:
+            options.update(raw_options or {})
+        x_data, y_data, v_data = reader(filename, channels=channels, **options) # lazy; grouping reads only its window
+        report['samples'] = len(x_data)
+        results = pipeline.run_pipeline(x_data, y_data, v_data, params, fit_method=fit_method)
+
+        stem = Path(filename).stem
+        DataFrame(results['time_constants']).to_csv(Path(out_dir) / f"{stem}_tau.csv", index=False)
+        summarize(results['tau_stats'], results['chi2_red'], results['r_squared'], results['quality']).to_csv(Path(out_dir) / f"{stem}_summary.csv", index=False)
+        if residuals:
+            residuals_frame(results['residuals']).to_csv(Path(out_dir) / f"{stem}_residuals.csv", index=False)
+        report['groups'], report['teeth'] = results['time_constants'].shape
+    except Exception as e:
+        report['error'] = f"{type(e).__name__}: {e}"
+    report['seconds'] = perf_counter() - t_start
+    if profile:
+        report['stages'] = list(profiler.records)
+        profiler.disable()
+    return report
+
+def report_progress(reports):
+    done = []
+    for r in reports: # results come in file order
+        print(f"{r['file']}: {'OK' if r['error'] is None else 'FAILED'} ({r['seconds']:.2f}s)")
+        done.append(r)
+    return done
+
+def print_throughput(reports: list, elapsed: float):
+    done = [r for r in reports if r['error'] is None]
+    samples = sum([r['samples'] for r in done])
+    print()
+    print(f"Files:       {len(done)}/{len(reports)} succeeded")
+    print(f"Samples:     {samples}")
+    print(f"Wall time:   {elapsed:.2f}s")
+    if elapsed > 0:
+        print(f"Throughput:  {len(done)/elapsed:.2f} files/s, {samples/elapsed:.0f} samples/s")
+    for r in reports:
+        if r['error'] is not None:
+            print(f"FAILED {r['file']}: {r['error']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the CRDS analysis pipeline over many scan files.')
+    parser.add_argument('params', help='JSON parameter file (keys named like the GUI inputs, e.g. spin_group_len)')
+    parser.add_argument('inputs', nargs='+', help='Input files or glob patterns')
+    parser.add_argument('-o', '--out-dir', default='results', help='Where to write tau tables & summaries')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--fit-method', choices=['batch', 'curve_fit', 'quick'], default='batch')
+    parser.add_argument('--fit-workers', type=int, default=None, help='Processes per file for --fit-method curve_fit (default: spin_fit_workers in the parameter file)')
+    parser.add_argument('--fit-chunksize', type=int, default=None, help='Groups per curve_fit task (default: spin_fit_chunksize in the parameter file)')
+    parser.add_argument('--no-cache', action='store_true', help="Don't read/write binary sidecar caches (CSV)")
+    parser.add_argument('--channel', action='append', default=[], metavar='ROLE=NAME', help='Map a channel (name or column number) to time/signal/voltage, e.g. --channel signal=ai0')
+    parser.add_argument('--raw-dtype', default='<f8', help='Sample type of raw binary files (NumPy dtype)')
+    parser.add_argument('--raw-columns', type=int, default=3, help='Channels in raw binary files')
+    parser.add_argument('--raw-offset', type=int, default=0, help='Header bytes to skip in raw binary files')
+    parser.add_argument('--raw-channel-major', action='store_true', help='Raw binary files store one whole channel after the other')
+    parser.add_argument('--residuals', action='store_true', help='Also write the fit residuals of every peak')
+    parser.add_argument('--profile', action='store_true', help='Print time, CPU time, peak memory & item counts per stage')
+    parser.add_argument('--trace', metavar='FILE', help='Write a Chrome trace (JSON) of every stage of every file')
+    parser.add_argument('--trace-memory', action='store_true', help='Also record peak memory per stage with --profile/--trace (slows the stages down)')
+    parser.add_argument('--backend', choices=kernels.BACKENDS, default=kernels.backend, help='Kernel backend (numba if installed)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Debug logging')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format='%(levelname)s %(name)s: %(message)s')
+
+    params = pipeline.load_params(args.params)
+    if args.fit_workers is not None:
+        params['spin_fit_workers'] = args.fit_workers
+    if args.fit_chunksize is not None:
+        params['spin_fit_chunksize'] = args.fit_chunksize
+    kernels.set_backend(args.backend)
+    files = sorted(set([f for pattern in args.inputs for f in glob(pattern)]))
+    if len(files) == 0:
+        print('No input files matched.')
+        return 1
+    Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+
+    t_start = perf_counter()
+    profile = args.profile or args.trace is not None
+    channels = readers.parse_channels(args.channel)
+    raw_options = {'dtype': args.raw_dtype, 'columns': args.raw_columns, 'offset': args.raw_offset, 'interleaved': not args.raw_channel_major}
+    job_args = [(params, args.out_dir, args.fit_method, not args.no_cache, args.residuals, profile, channels, raw_options, args.trace_memory)] * len(files)
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=kernels.set_backend, initargs=(args.backend,)) as executor:
+            reports = report_progress(executor.map(process_file, files, *zip(*job_args)))
+    else:
+        reports = report_progress(map(process_file, files, *zip(*job_args)))
+
+    print_throughput(reports, perf_counter() - t_start)
+    records = [record for r in reports for record in r['stages']]
+    if args.profile:
+        print()
+        print(profiling.format_totals(profiling.stage_totals(records)))
+    if args.trace is not None:
+        profiling.write_chrome_trace(args.trace, records)
+    return 0 if all([r['error'] is None for r in reports]) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,23 @@
+import logging
+import warnings
+import multiprocessing
 import numpy as np
-from scipy.signal import find_peaks, correlate
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import find_peaks
+from scipy.fft import rfft, irfft, next_fast_len
 from scipy.optimize import curve_fit
-from db import mem
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import kernels
+from peaks import PeakArray, FitArray, as_peak_array, as_fit_array
+
+logger = logging.getLogger(__name__)
 
 def minmax(data):
     return np.min(data), np.max(data)
 
 def exp_func(x, x0, a, y0, tau): # NOTE: X is not something we pass in 🤦‍♂️
-    return y0 + a*np.exp(-(x-x0)/tau)
+    return kernels.exp_func(x, x0, a, y0, tau)
 
 def spaced_groups(
     x_data: np.array,
@@ -18,14 +28,16 @@ def spaced_groups(
     sma_denom: int,
     mirrored: bool=True,
     start=None,
-    end=None
+    end=None,
+    y_data_av: np.array=None
 ):
     """
-    Use SpacedGroups algo to separate groups
+    Use SpacedGroups algo to separate groups. Pass `y_data_av` (the moving average of
+    the same, already cut data) to reuse smoothing that was done before.
 
     Returns
     -------
-    2D array of raw data; every other group
+    2D array of raw data (one row per group); every other group if `mirrored`
     """
 
     # Helpers
@@ -38,16 +50,6 @@ def spaced_groups(
         timestep = abs(x_data[1] - x_data[0])
         return int(t / timestep)
 
-    def moving_average(x, w):
-        return np.convolve(x, np.ones(w), 'valid') / w
-
-    def isolate_group(i):
-        i_min = i - t2i_range(group_len)
-        i_max = i + t2i_range(group_len)
-        # NOTE: Groups that are too short just get left out. Too bad!
-        group = y_data.tolist()[i_min:i_max]
-        return group
-
     # Check if custom start & end values are set
 
     if not end == None:
@@ -61,57 +63,30 @@ def spaced_groups(
         y_data = y_data[start_ind:]
 
     # Detect peaks w/ averaged data
-    x_data_av = np.delete(x_data, [range(int(sma_denom / 2))])
-    x_data_av = np.delete(x_data_av, [range(len(x_data)-int((sma_denom / 2) - 1), len(x_data_av))])
-    y_data_av = moving_average(y_data, sma_denom)
-    peak_indices = find_peaks(y_data_av, height=peak_minheight, prominence=peak_prominence) # Get indices of all peaks
-
-    peaks = []
-    for p in peak_indices[0]: # Get x-values of all peaks
-        peaks.append(x_data[p])
-
-
-    # Group peaks together
-    peak_groups = [[]]
-    group_index = 0
-    for i in range(len(peaks)):
-        item = peaks[i]
-        next_item = 0
-        try:
-            next_item = peaks[i+1]
-        except:
-            pass
-
-        peak_groups[group_index].append(item)
-
-        # Removed overlapping peak checks; don't really need that anymore
-        if abs(next_item - item) >= group_len: # Check if far enough away for new group
-            peak_groups.append([])
-            group_index += 1
-
-    for g in peak_groups: # empty group check
-        if len(g) == 0:
-            peak_groups.remove(g)
-
-    peaks_init = [] # Get peaks[0] for every group
-    for g in peak_groups:
-        peaks_init.append(g[0])
+    if y_data_av is None:
+        y_data_av = kernels.moving_average(y_data, sma_denom)
+    peak_indices = find_peaks(y_data_av, height=peak_minheight, prominence=peak_prominence)[0] # Get indices of all peaks
+    peaks = x_data[peak_indices] # Get x-values of all peaks
 
-    # Isolate group data
+    # Group peaks together; a new group starts wherever the gap to the previous peak is big enough
+    # Removed overlapping peak checks; don't really need that anymore
+    peaks_init = peaks[kernels.group_starts(peaks, group_len)] # Get peaks[0] for every group
 
-    groups_raw = [] 
-    for p in peaks_init:
-        if mirrored:
-            if peaks_init.index(p) % 2 == 0:
-                groups_raw.append(isolate_group(t2i(p)))
-            else:
-                pass
-        else:
-            groups_raw.append(isolate_group(t2i(p)))
+    if mirrored:
+        peaks_init = peaks_init[::2]
 
-    for i in groups_raw:
-        if len(i) == 0:
-            groups_raw.remove(i)
+    # Isolate group data
+    # NOTE: Groups that are too short (run off either end of the data) just get left out. Too bad!
+    half_len = t2i_range(group_len)
+    if 2*half_len > len(y_data) or half_len < 1:
+        return np.empty((0, max(2*half_len, 0)))
+    timestep = abs(x_data[1] - x_data[0])
+    centers = (np.abs(x_data[0] - peaks_init) / timestep).astype(int) # STATIC time to index
+    group_starts = centers - half_len
+    group_starts = group_starts[(group_starts >= 0) & (centers + half_len <= len(y_data))]
+
+    # One row per group: index into a strided window view, so only the kept groups get copied
+    groups_raw = sliding_window_view(y_data, 2*half_len)[group_starts]
 
     return groups_raw
 
@@ -127,11 +102,16 @@ def vthreshold(
     end=None
 ):
     """
-    Voltage-threshold grouping algorithm
+    Voltage-threshold grouping algorithm. A group is one piezo sweep across the
+    `vmin`-`vmax` window: from the last sample below `vmin` to the first one above
+    `vmax` (or the other way round). Because a sweep only counts once it has crossed
+    both thresholds, noise around either threshold can't split it. Sweeps cut off by
+    the start/end of the data are left out.
+    With `mirrored`, only sweeps going the same direction as the first one are kept.
 
     Returns
     -------
-    A `list` of all peak groups
+    A `list` of all peak groups (views into `y_data`)
     """
 
     # Helpers
@@ -140,64 +120,229 @@ def vthreshold(
         timestep = abs(x_data[1] - x_data[0])
         return int(delta_t / timestep)
 
-    def t2i_range(t):
-        timestep = abs(x_data[1] - x_data[0])
-        return int(t / timestep)
+    # Check if custom start & end values are set
+
+    if not end == None:
+        stop_ind = t2i(end)
+        x_data = x_data[:stop_ind]
+        y_data = y_data[:stop_ind]
+        v_data = v_data[:stop_ind]
+
+    if not start == None:
+        start_ind = t2i(start)
+        x_data = x_data[start_ind:]
+        y_data = y_data[start_ind:]
+        v_data = v_data[start_ind:]
+
+    starts, ends, direction = sweep_bounds(v_data, vmin, vmax)
+    if len(ends) == 0:
+        return []
+
+    keep = np.ones(len(ends), dtype=bool)
+    if mirrored:
+        keep = direction == direction[0]
 
-    groups_raw = []
+    groups_raw = [y_data[s:e] for s, e in zip(starts[keep], ends[keep])]
     return groups_raw
 
-def correlate_groups(groups_raw):
+def sweep_bounds(v_data: np.array, vmin: float, vmax: float):
     """
-    Overlay groups using `scipy.correlate`.
+    Find the full sweeps across the `vmin`-`vmax` window (see `vthreshold`)
 
     Returns
     -------
-    2D array of overlayed groups
+    Start & end index of every sweep & its direction (+1 up, -1 down)
     """
 
-    # Compare groups (scipy correlate)
+    # -1 below the window, +1 above it, 0 inside
+    zone = (v_data > vmax).astype(np.int8) - (v_data < vmin).astype(np.int8)
+
+    # Carry the last out-of-window zone forward through the window
+    last_out = np.where(zone != 0, np.arange(len(zone)), 0)
+    np.maximum.accumulate(last_out, out=last_out)
+    side = zone[last_out]
+
+    # A sweep ends wherever the carried zone flips from one side to the other
+    ends = np.flatnonzero(np.diff(side) != 0) + 1
+    ends = ends[side[ends-1] != 0] # first crossing from unknown side isn't a full sweep
+    starts = last_out[ends-1] + 1
 
-    group_base = np.array(groups_raw[0])
-    groups_adjusted = [group_base]
-    for x in groups_raw[1:]:
-        # calculate how much to shift
-        corr = correlate(group_base, np.array(x))
-        shift = corr.tolist().index(max(corr))
+    # A jump straight across the window (e.g. sawtooth flyback) isn't a sweep
+    swept = ends > starts
+    starts, ends = starts[swept], ends[swept]
+    return starts, ends, side[ends]
 
-        # adjust alignment to fit on top of base group
-        diff = shift - len(x)
-        if diff < 0:
-            for i in range(abs(diff)):
-                x.pop(0)
-        elif diff > 0:
-            x = [0 for i in range(abs(diff))] + x
+def align_groups(groups_raw, subsample: bool=False, chunk_rows: int=64, progress=None):
+    """
+    Cross-correlate every group against the first (base) group with one batched rFFT
+    per chunk of rows, then shift all groups onto the base group.
 
-        groups_adjusted.append(x)
+    Groups may have different lengths. Shifted-in samples at the front are 0; the output
+    is cut to the length every shifted group still covers, so it is rectangular.
+    With `subsample`, the lag is refined by fitting a parabola through the correlation
+    peak & its neighbours, and fractional shifts are applied by linear interpolation.
+    `progress(done, total)` is called after every chunk of groups.
 
+    Returns
+    -------
+    2D array of overlayed groups, lag of each group (in ticks) & normalized correlation peak height
+    """
+
+    n = len(groups_raw)
+    lengths = np.array([len(g) for g in groups_raw])
+    if isinstance(groups_raw, np.ndarray) and groups_raw.ndim == 2:
+        groups = groups_raw
+    else:
+        groups = np.zeros((n, lengths.max()))
+        for i, g in enumerate(groups_raw):
+            groups[i, :len(g)] = g
+
+    base = groups[0, :lengths[0]]
+    nfft = next_fast_len(len(base) + groups.shape[1] - 1)
+    base_f = rfft(base, nfft)
+    norms = np.sqrt(np.einsum('ij,ij->i', groups, groups))
+
+    # Circular correlation index k -> lag (k wraps around to negative lags)
+    k = np.arange(nfft)
+    k_lag = np.where(k < len(base), k, k - nfft)
+
+    lags = np.zeros(n)
+    heights = np.zeros(n)
+    for i in range(0, n, chunk_rows):
+        rows = slice(i, min(i+chunk_rows, n))
+        corr = irfft(base_f[None, :] * np.conj(rfft(groups[rows], nfft, axis=1)), nfft, axis=1)
+        # Only lags where the groups actually overlap
+        valid = (k_lag[None, :] <= len(base)-1) & (k_lag[None, :] >= -(lengths[rows, None]-1))
+        corr = np.where(valid, corr, -np.inf)
+        best = np.argmax(corr, axis=1)
+        r = np.arange(len(best))
+        peak = corr[r, best]
+        lags[rows] = k_lag[best]
+        heights[rows] = peak / np.maximum(norms[0] * norms[rows], np.finfo(float).tiny)
+
+        if subsample:
+            left = corr[r, (best-1) % nfft]
+            right = corr[r, (best+1) % nfft]
+            denom = left - 2*peak + right
+            ok = np.isfinite(left) & np.isfinite(right) & (denom < 0)
+            lags[rows] += np.where(ok, 0.5*(left - right) / np.where(ok, denom, 1), 0)
+
+        if progress is not None:
+            progress(rows.stop, n)
+    lags[0] = 0
+
+    # Common length every shifted group still covers
+    common_len = min(int(np.floor(np.min(lags + lengths - 1))) + 1, len(base))
+    if common_len <= 0:
+        return np.empty((n, 0)), lags, heights
+
+    # Shift with index arithmetic into one preallocated output array
+    groups_adjusted = np.empty((n, common_len))
+    j = np.arange(common_len)
+    for i in range(0, n, chunk_rows):
+        rows = slice(i, min(i+chunk_rows, n))
+        src = j[None, :] - lags[rows, None]
+        i0 = np.floor(src).astype(int)
+        w = src - i0
+        r = np.arange(groups[rows].shape[0])[:, None]
+        g0 = np.where(i0 >= 0, groups[rows][r, np.clip(i0, 0, None)], 0.0)
+        g1 = np.where(i0+1 >= 0, groups[rows][r, np.clip(i0+1, 0, groups.shape[1]-1)], 0.0)
+        groups_adjusted[rows] = (1-w)*g0 + w*g1
+
+    return groups_adjusted, lags, heights
+
+def correlate_groups(groups_raw, subsample: bool=False, progress=None):
+    """
+    Overlay groups by cross-correlating them against the first group (see `align_groups`).
+
+    Returns
+    -------
+    2D array of overlayed groups
+    """
+
+    groups_adjusted, _, _ = align_groups(groups_raw, subsample=subsample, progress=progress)
     return groups_adjusted
 
-def add_peaks_only(groups_adjusted: list):
+STACKING = ['sum', 'weighted', 'median']
 
-    def unequal_add_truncation(a,b): # Instead of padding with 0, truncate
-        if len(a) < len(b):
-            c = b.copy()
-            c = c[:len(a)]
-            c += a
-        else:
-            c = a.copy()
-            c = c[:len(b)]
-            c += b
-        return(c)
+def as_group_array(groups_adjusted):
+    """
+    Overlayed groups as one 2D array, cut to the length of the shortest group (no copy if
+    they already are one, e.g. straight from `align_groups`)
+    """
+
+    if isinstance(groups_adjusted, np.ndarray) and groups_adjusted.ndim == 2:
+        return groups_adjusted
+    common_len = min([len(g) for g in groups_adjusted])
+    return np.stack([np.asarray(g, dtype=float)[:common_len] for g in groups_adjusted])
+
+def noise_weights(groups: np.array):
+    """
+    Inverse-variance weight of every group, from a robust estimate of its sample-to-sample
+    noise (MAD of the first differences, so the ring-downs themselves barely count)
+    """
+
+    d = np.diff(groups, axis=1)
+    mad = np.median(np.abs(d - np.median(d, axis=1, keepdims=True)), axis=1)
+    return 1 / np.maximum(mad, np.finfo(float).tiny)**2
+
+def add_groups(groups_adjusted, stacking: str = 'sum', weights: np.array = None):
+    """
+    Stack overlayed groups into one trace over the length every group covers.
+
+    `stacking` is `'sum'`, `'weighted'` (sum of the groups scaled by `weights`, by default
+    `noise_weights()`, so noisy groups count less) or `'median'` (times the number of
+    groups). All three come out on the scale of the plain sum, so the peak height &
+    prominence inputs mean the same thing whichever is used.
+
+    Returns
+    -------
+    1D array of added peaks
+    """
+
+    if stacking not in STACKING:
+        raise ValueError(f"Unknown stacking {stacking} (choose from {', '.join(STACKING)})")
+    groups = as_group_array(groups_adjusted)
+    if stacking == 'sum':
+        return groups.sum(axis=0)
+    if stacking == 'median':
+        return np.median(groups, axis=0) * len(groups)
+
+    weights = noise_weights(groups) if weights is None else np.asarray(weights, dtype=float)
+    return (weights * (len(weights) / weights.sum())) @ groups
 
-    added_peaks = np.array(groups_adjusted[0])
+class GroupAccumulator:
+    """
+    Running (weighted) sum of overlayed groups, added one at a time in place. Groups of
+    different length truncate the sum to the shortest, like `add_groups()`.
+    Median stacking needs every group at once, so it is not available here.
+    """
 
-    for g in groups_adjusted[1:]:
-        g1 = np.array(g)
-        g0 = added_peaks
-        added_peaks = unequal_add_truncation(g0, g1)
+    def __init__(self):
+        self.total = None
+        self.weight = 0.0
+        self.count = 0
 
-    return added_peaks
+    def add(self, group: np.array, weight: float = 1.0):
+        group = np.asarray(group, dtype=float)
+        if self.total is None:
+            self.total = group * weight
+        else:
+            if len(group) < len(self.total):
+                self.total = self.total[:len(group)] # view, nothing copied
+            self.total += weight * group[:len(self.total)]
+        self.weight += weight
+        self.count += 1
+
+    @property
+    def added_peaks(self):
+        # On the scale of a plain sum (see `add_groups`)
+        if self.total is None:
+            return None
+        return self.total * (self.count / self.weight)
+
+def add_peaks_only(groups_adjusted: list, stacking: str = 'sum'):
+    return add_groups(groups_adjusted, stacking)
 
 def isolate_peaks(
     groups_adjusted: list,
@@ -205,55 +350,218 @@ def isolate_peaks(
     sma_denom: int,
     peak_minheight: int = None,
     peak_prominence: int = None,
-    shift_over: int = 0
+    shift_over: int = 0,
+    stacking: str = 'sum',
+    progress=None
 ):
+    """
+    Add the overlayed groups (see `add_groups`), find the peaks in the sum & cut the same
+    zone around every peak out of every group.
 
-    def unequal_add(a,b): # NOTE: See https://www.delftstack.com/howto/numpy/vector-addition-in-numpy/
-        if len(a) < len(b):
-            c = b.copy()
-            c[:len(a)] += a
-        else:
-            c = a.copy()
-            c[:len(b)] += b
-        return(c)
-
-    def unequal_add_truncation(a,b): # Instead of padding with 0, truncate
-        if len(a) < len(b):
-            c = b.copy()
-            c = c[:len(a)]
-            c += a
-        else:
-            c = a.copy()
-            c = c[:len(b)]
-            c += b
-        return(c)
-
-    def moving_average(x, w):
-        return np.convolve(x, np.ones(w), 'valid') / w
-
-    added_peaks = np.array(groups_adjusted[0])
+    Returns
+    -------
+    Added peaks, peak indices & isolated peaks (`PeakArray`, one row per group)
+    """
 
-    for g in groups_adjusted[1:]:
-        g1 = np.array(g)
-        g0 = added_peaks
-        added_peaks = unequal_add_truncation(g0, g1)
+    added_peaks = add_groups(groups_adjusted, stacking)
 
-    added_peaks_av = moving_average(added_peaks, sma_denom)
+    added_peaks_av = kernels.moving_average(added_peaks, sma_denom)
     peak_indices = find_peaks(added_peaks_av, height=peak_minheight, prominence=peak_prominence, distance=peak_width/2)[0] # Get indices of all peaks
 
-    isolated_peaks = []
+    # Same cut-out zone in every group: one gather into an (n_groups, n_teeth, width) array
+    groups = as_group_array(groups_adjusted)
     delta = peak_width/2
-
-    for g in groups_adjusted:
-        peaks_cut = []
-        for i in peak_indices:
-            peak = g[int(i-delta+shift_over):int(i+delta+shift_over)]
-            peaks_cut.append(peak)
-        isolated_peaks.append(peaks_cut)
+    bounds = np.array([slice(int(i-delta+shift_over), int(i+delta+shift_over)).indices(groups.shape[1])[:2] for i in peak_indices], dtype=np.int64).reshape(-1, 2)
+    lengths = np.maximum(bounds[:, 1] - bounds[:, 0], 0)
+    j = bounds[:, 0, None] + np.arange(lengths.max(initial=0))
+    cut = j < bounds[:, 1, None]
+
+    data = np.empty((len(groups), len(bounds), j.shape[1]))
+    for g in range(len(groups)):
+        data[g] = np.where(cut, groups[g][np.clip(j, 0, groups.shape[1]-1)], np.nan)
+        if progress is not None:
+            progress(g+1, len(groups))
+    isolated_peaks = PeakArray(data, np.broadcast_to(lengths, data.shape[:2]).copy())
 
     return added_peaks, peak_indices, isolated_peaks
 
 
+def stack_peaks(isolated_peaks: list):
+    """
+    Stack every isolated peak (all groups, all teeth) into one NaN-padded 2D array
+
+    Returns
+    -------
+    `(n_peaks, width)` array of peak data, matching validity mask & row lengths of `isolated_peaks`
+    """
+
+    if isinstance(isolated_peaks, PeakArray):
+        return isolated_peaks.flat()
+
+    row_lengths = [len(peaks_cut) for peaks_cut in isolated_peaks]
+    flat = [np.asarray(peak_data, dtype=float) for peaks_cut in isolated_peaks for peak_data in peaks_cut]
+    width = max([len(p) for p in flat], default=0)
+
+    stacked = np.full((len(flat), width), np.nan)
+    for i, p in enumerate(flat):
+        stacked[i, :len(p)] = p
+    valid = ~np.isnan(stacked)
+
+    return stacked, valid, row_lengths
+
+TAU_MIN = 1e-12 # lower bound of tau in the batched fit (tau > 0)
+
+def batch_exp_fit(
+    t: np.array,
+    y: np.array,
+    valid: np.array,
+    p0: np.array,
+    max_iter: int = 200,
+    tol: float = 1e-10
+):
+    """
+    Fit `y0 + a*e^(-t/tau)` to every row of `y` at once (vectorized Levenberg-Marquardt).
+    `t` is the time since the fit start; rows only use samples where `valid` is set.
+    Bounds match the serial fit (a >= 0, tau > 0).
+
+    Returns
+    -------
+    `(n, 3)` array of `[a, y0, tau]` and `(n, 3, 3)` covariance matrices
+    """
+
+    n = y.shape[0]
+    w = valid.astype(float)
+    t = np.where(valid, t, 0.0)
+    y = np.where(valid, y, 0.0)
+    m = w.sum(axis=1)
+
+    def evaluate(p, rows):
+        return kernels.exp_residuals(t, y, w, rows, p[:, 0], p[:, 1], p[:, 2])
+
+    def jacobian(p, e, rows):
+        J = np.stack([e, np.ones_like(e), p[:, 0:1]*e*t[rows]/p[:, 2:3]**2], axis=2)
+        return J * w[rows][..., None]
+
+    p = np.array(p0, dtype=float)
+    p[:, 0] = np.maximum(p[:, 0], 0.0)
+    p[:, 2] = np.maximum(p[:, 2], TAU_MIN)
+
+    # Flat rows (constant, e.g. all zero): there's no decay, so tau is undetermined & iterating
+    # would only follow rounding noise (which differs between kernel backends). Settle them here:
+    # a = 0 (rejected by the quality gate as a bound), y0 = the level, tau = the seed.
+    with np.errstate(invalid='ignore'):
+        y_max = np.where(valid, y, -np.inf).max(axis=1, initial=-np.inf)
+        y_min = np.where(valid, y, np.inf).min(axis=1, initial=np.inf)
+        flat = (m > 0) & (y_max - y_min <= 16 * np.finfo(float).eps * np.maximum(np.abs(y_max), np.abs(y_min)))
+    p[flat, 0] = 0.0
+    p[flat, 1] = y_max[flat]
+
+    lam = np.full(n, 1e-3)
+    active = (m > 3) & ~flat # need more samples than params for a fit (and a variance estimate)
+
+    all_rows = np.arange(n)
+    e, r = evaluate(p, all_rows)
+    cost = np.sum(r**2, axis=1)
+
+    for _ in range(max_iter):
+        rows = np.flatnonzero(active)
+        if len(rows) == 0:
+            break
+        p_a = p[rows]
+        e_a, r_a = evaluate(p_a, rows)
+        J = jacobian(p_a, e_a, rows)
+        JTJ = np.einsum('nli,nlj->nij', J, J)
+        JTr = np.einsum('nli,nl->ni', J, r_a)
+
+        # Marquardt scaling; floor the diagonal so damped system is always solvable
+        diag = np.maximum(np.einsum('nii->ni', JTJ), 1e-12)
+        A = JTJ + (lam[rows][:, None] * diag)[:, :, None] * np.eye(3)
+        delta = np.linalg.solve(A, JTr[..., None])[..., 0]
+
+        p_new = p_a + delta
+        p_new[:, 0] = np.maximum(p_new[:, 0], 0.0)
+        p_new[:, 2] = np.maximum(p_new[:, 2], TAU_MIN)
+        _, r_new = evaluate(p_new, rows)
+        cost_new = np.sum(r_new**2, axis=1)
+
+        better = cost_new < cost[rows]
+        improved = rows[better]
+        gain = cost[improved] - cost_new[better]
+        p[improved] = p_new[better]
+        cost[improved] = cost_new[better]
+        lam[rows] = np.where(better, lam[rows] / 10, lam[rows] * 10)
+
+        # Converged: step barely changes the cost, or damping has blown up (no downhill step left)
+        done = np.zeros(n, dtype=bool)
+        done[improved] = gain <= tol * (cost[improved] + tol)
+        done[rows] |= lam[rows] > 1e12
+        active &= ~done
+
+    # Covariance (same scaling as curve_fit with absolute_sigma=False)
+    pcov = np.full((n, 3, 3), np.inf)
+    fitted = m > 3
+    rows = np.flatnonzero(fitted)
+    if len(rows) > 0:
+        e, r = evaluate(p[rows], rows)
+        J = jacobian(p[rows], e, rows)
+        JTJ = np.einsum('nli,nlj->nij', J, J)
+        s_sq = cost[rows] / (m[rows] - 3)
+        pcov[rows] = np.linalg.pinv(JTJ) * s_sq[:, None, None]
+
+    return p, pcov
+
+def estimate_exp(t: np.array, y: np.array, valid: np.array):
+    """
+    Closed-form fit of `y0 + a*e^(-t/tau)` to every row at once (successive integration).
+    Integrating the decay gives `y = c0 - S/tau + t*y0/tau`, with `S` the running integral
+    of `y`, which is linear in `c0`, `1/tau` & `y0/tau`; `a` & `y0` then follow from a
+    linear fit with `tau` fixed. Two small least-squares solves per row, no iterations.
+
+    Returns
+    -------
+    `(n, 3)` array of `[a, y0, tau]` & whether each row gave a usable (decaying) estimate
+    """
+
+    w = valid.astype(float)
+    t = np.where(valid, t, 0.0)
+    y = np.where(valid, y, 0.0)
+    m = w.sum(axis=1)
+
+    # Running trapezoid integral over the valid run of every row
+    step = w[:, 1:] * w[:, :-1]
+    S = np.zeros_like(y)
+    S[:, 1:] = np.cumsum(step * 0.5*(y[:, 1:] + y[:, :-1]) * np.diff(t, axis=1), axis=1)
+
+    def lstsq(X, target):
+        # Weighted least squares for every row: X is (n, samples, k)
+        Xw = X * w[..., None]
+        XTX = np.einsum('nli,nlj->nij', Xw, X)
+        XTy = np.einsum('nli,nl->ni', Xw, target)
+        return (np.linalg.pinv(XTX) @ XTy[..., None])[..., 0]
+
+    c = lstsq(np.stack([np.ones_like(t), S, t], axis=2), y)
+    ok = (c[:, 1] < 0) & (m > 3)
+    tau = np.where(ok, -1 / np.where(ok, c[:, 1], -1), np.nan)
+
+    e = np.exp(-t / np.where(ok, tau, 1)[:, None])
+    a, y0 = lstsq(np.stack([e, np.ones_like(e)], axis=2), y).T
+    ok &= np.isfinite(tau) & np.isfinite(a) & np.isfinite(y0) & (a > 0)
+    return np.column_stack([a, y0, tau]), ok
+
+def fit_seeds(stacked: np.array, valid: np.array, fit_start: np.array, a: float, tau: float, y0: float):
+    """
+    Starting values `[a, y0, tau]` for fitting every peak from its fit start on: the
+    `estimate_exp()` of the peak where that works, the given guesses where it doesn't
+
+    Returns
+    -------
+    `(n, 3)` seeds & mask of the peaks that got an estimate (not the guesses)
+    """
+
+    t = np.arange(stacked.shape[1])[None, :] - fit_start[:, None]
+    p0, ok = estimate_exp(t, stacked, valid & (t >= 0))
+    return np.where(ok[:, None], p0, [a, y0, tau]), ok
+
 def fit_peaks(
     isolated_peaks: list,
     peak_indices: list,
@@ -264,61 +572,445 @@ def fit_peaks(
     tau: float,
     y0: float,
     shift_over: int,
-    use_advanced: bool
+    use_advanced: bool,
+    method: str = 'batch',
+    workers: int = None,
+    chunksize: int = 1,
+    progress=None
 ):
     
     """
+    Fit `exp_func` to every isolated peak.
+
+    `method` is either `'batch'` (all peaks solved at once, see `batch_exp_fit`),
+    `'curve_fit'` (one `scipy.optimize.curve_fit` per peak) or `'quick'` (just the
+    closed-form `estimate_exp()`, no iterations, for fast previews). With `'curve_fit'`,
+    `workers > 1` spreads groups over a process pool, `chunksize` groups per task.
+    Every fit starts from `estimate_exp()` of its peak; `a`, `tau` & `y0` are only the
+    fallback for peaks it can't estimate.
+    `progress(done, total)` is called as groups finish; raising from it aborts the fit.
+
     Returns
     -------
-    Peak fit equations. Linked to `mem['isolated_peaks']`.
+    Peak fit equations (`FitArray`) & overlayed peak indices. Both linked to `isolated_peaks`.
     """
 
-    params_guess = (0.0000, a, y0, tau)
+    if method in ['batch', 'quick']:
+        return fit_peaks_batch(isolated_peaks, min_peak_height, min_peak_prominence, a, tau, y0, shift_over, use_advanced, quick=(method == 'quick'), progress=progress)
+    elif method != 'curve_fit':
+        raise ValueError(f"Unknown fit method '{method}'")
+
+    fit_args = (min_peak_height, min_peak_prominence, a, tau, y0, shift_over, use_advanced)
+
+    if workers is not None and workers > 1:
+        equations, overlayed_peak_indices = fit_peaks_parallel(isolated_peaks, fit_args, workers, chunksize, progress=progress)
+    else:
+        equations = []
+        overlayed_peak_indices = []
+        for peaks_cut in isolated_peaks:
+            equation_row, overlayed_peak_row = fit_group(peaks_cut, *fit_args)
+            equations.append(equation_row)
+            overlayed_peak_indices.append(overlayed_peak_row)
+            if progress is not None:
+                progress(len(equations), len(isolated_peaks))
+    return as_fit_array(equations), overlayed_peak_indices # linked with isolated_peaks
+
+def fit_group(
+    peaks_cut: list,
+    min_peak_height: float,
+    min_peak_prominence: float,
+    a: float,
+    tau: float,
+    y0: float,
+    shift_over: int,
+    use_advanced: bool
+):
+    """
+    `curve_fit` every peak in one group (one row of `isolated_peaks`)
+
+    Returns
+    -------
+    Row of fit equations & row of overlayed peak indices
+    """
+
+    if not use_advanced:
+        peak_indices = [np.argmax(peak_data, axis=0) for peak_data in peaks_cut]
+    else:
+        peak_indices = [find_peaks(peak_data, height=min_peak_height, prominence=min_peak_prominence)[0][0] for peak_data in peaks_cut]
+    stacked, valid, _ = stack_peaks([peaks_cut])
+    seeds, _ = fit_seeds(stacked, valid, np.array(peak_indices, dtype=int) + shift_over, a, tau, y0)
+
+    equation_row = []
+    overlayed_peak_row = []
+    for peak_data, peak_index, seed in zip(peaks_cut, peak_indices, seeds):
+        x_data = np.arange(len(peak_data)) # just placeholder indices
+        # x_data = np.arange(0, len(peak_data)*timestep, timestep)
+        logger.debug('Fitting peak of %d samples', len(peak_data))
+        params_guess = (peak_index+shift_over, *seed)
+        x_data_target = x_data[peak_index+shift_over:]
+        peak_data_target = peak_data[peak_index+shift_over:]
+        popt, pcov = curve_fit(exp_func, x_data_target, peak_data_target, bounds=([-np.inf, 0.0, -np.inf, 0.0], np.inf), p0=params_guess, maxfev=10000000)
+        equation_row.append({'popt': popt, 'pcov': pcov})
+        overlayed_peak_row.append(peak_index)
+
+    return equation_row, overlayed_peak_row
+
+def _fit_groups_shared(shm_name, shape, row_lengths, peak_lengths, group_range, fit_args):
+    # Worker side of `fit_peaks_parallel`: attach to the shared peak array & fit a range of groups
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        stacked = np.ndarray(shape, dtype=float, buffer=shm.buf)
+        offsets = np.concatenate([[0], np.cumsum(row_lengths)])
+        results = []
+        for g_i in range(*group_range):
+            peaks_cut = [
+                stacked[j, :peak_lengths[j]].copy() # copy so nothing outlives the shared buffer
+                for j in range(offsets[g_i], offsets[g_i+1])
+            ]
+            results.append(fit_group(peaks_cut, *fit_args))
+        return results
+    finally:
+        shm.close()
+
+def fit_peaks_parallel(isolated_peaks: list, fit_args: tuple, workers: int, chunksize: int = 1, progress=None):
+    """
+    Spread groups over a process pool (spawned, the same on every platform). Peak data is
+    shipped once through shared memory; each task only carries the group range it should fit.
+    Results keep group order.
+
+    Returns
+    -------
+    Fit equations & overlayed peak indices, same as the serial path
+    """
+
+    stacked, valid, row_lengths = stack_peaks(isolated_peaks)
+    peak_lengths = valid.sum(axis=1).tolist()
+    chunksize = max(int(chunksize), 1)
+    group_ranges = [(i, min(i+chunksize, len(isolated_peaks))) for i in range(0, len(isolated_peaks), chunksize)]
+
+    if stacked.size == 0:
+        return [[] for _ in isolated_peaks], [[] for _ in isolated_peaks]
+
     equations = []
     overlayed_peak_indices = []
-    for peaks_cut in isolated_peaks:
-        equation_row = []
-        overlayed_peak_row = []
-        for peak_data in peaks_cut:
-            x_data = np.arange(len(peak_data)) # just placeholder indices
-            # x_data = np.arange(0, len(peak_data)*mem['timestep'], mem['timestep'])
-            print(x_data)
-            if not use_advanced:
-                peak_index = np.argmax(peak_data, axis=0)
-            else:
-                peak_index = find_peaks(peak_data, height=min_peak_height, prominence=min_peak_prominence)[0][0]
-            # print(peak_index)
-            params_guess = (peak_index+shift_over, a, y0, tau)
-            x_data_target = x_data[peak_index+shift_over:]
-            peak_data_target = peak_data[peak_index+shift_over:]
-            popt, pcov = curve_fit(exp_func, x_data_target, peak_data_target, bounds=([-np.inf, 0.0, -np.inf, 0.0], np.inf), p0=params_guess, maxfev=10000000)
-            equation_row.append({'popt': popt, 'pcov': pcov})
-            overlayed_peak_row.append(peak_index)
-        equations.append(equation_row)
-        overlayed_peak_indices.append(overlayed_peak_row)
-        mem['overlayed_peak_indices'] = overlayed_peak_indices
-
-    return equations # list linked with isolated_peaks
-
-
-def get_time_constants(equation_data):
+    shm = shared_memory.SharedMemory(create=True, size=stacked.nbytes)
+    try:
+        np.ndarray(stacked.shape, dtype=float, buffer=shm.buf)[:] = stacked
+        # spawn, not fork: callers may be multithreaded (the GUI fits on a worker thread) & frozen apps need it anyway
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [
+                executor.submit(_fit_groups_shared, shm.name, stacked.shape, row_lengths, peak_lengths, r, fit_args)
+                for r in group_ranges
+            ]
+            try:
+                for f in futures:
+                    for equation_row, overlayed_peak_row in f.result():
+                        equations.append(equation_row)
+                        overlayed_peak_indices.append(overlayed_peak_row)
+                    if progress is not None:
+                        progress(len(equations), len(isolated_peaks))
+            except BaseException:
+                for f in futures: # don't start anything that's still queued
+                    f.cancel()
+                raise
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return equations, overlayed_peak_indices
+
+def fit_peaks_batch(
+    isolated_peaks: list,
+    min_peak_height: float,
+    min_peak_prominence: float,
+    a: float,
+    tau: float,
+    y0: float,
+    shift_over: int,
+    use_advanced: bool,
+    quick: bool = False,
+    chunk_groups: int = 16,
+    progress=None
+):
+    """
+    Batched version of `fit_peaks`: pad all peaks into one 2D array & fit them together
+    (`chunk_groups` groups per solve, so progress can be reported in between).
+    x0 is held at the fit start (it is degenerate with `a` anyway), so its row/column in `pcov` is 0.
+    With `quick`, the closed-form estimates are kept as they are (covariance still evaluated there);
+    peaks that have no estimate get NaN.
+
+    Returns
+    -------
+    Peak fit equations & overlayed peak indices. Both linked to `isolated_peaks`.
+    """
+
+    stacked, valid, row_lengths = stack_peaks(as_peak_array(isolated_peaks))
+
+    if not use_advanced:
+        peak_index = np.where(valid, stacked, -np.inf).argmax(axis=1)
+    else:
+        peak_index = np.array([
+            find_peaks(p[v], height=min_peak_height, prominence=min_peak_prominence)[0][0]
+            for p, v in zip(stacked, valid)
+        ], dtype=int)
+
+    fit_start = peak_index + shift_over
+    t = np.arange(stacked.shape[1])[None, :] - fit_start[:, None]
+    fit_valid = valid & (t >= 0)
+
+    popt3 = np.empty((len(stacked), 3))
+    pcov3 = np.empty((len(stacked), 3, 3))
+    offsets = np.concatenate([[0], np.cumsum(row_lengths)]).astype(int)
+    n_groups = len(row_lengths)
+    for g in range(0, n_groups, chunk_groups):
+        g_end = min(g+chunk_groups, n_groups)
+        rows = slice(offsets[g], offsets[g_end])
+        p0, ok = fit_seeds(stacked[rows], valid[rows], fit_start[rows], a, tau, y0)
+        popt3[rows], pcov3[rows] = batch_exp_fit(t[rows], stacked[rows], fit_valid[rows], p0, max_iter=0 if quick else 200)
+        if quick: # nothing was fitted, so a peak without an estimate has no result (not the guesses)
+            popt3[rows][~ok] = np.nan
+            pcov3[rows][~ok] = np.nan
+        if progress is not None:
+            progress(g_end, n_groups)
+
+    popt = np.column_stack([fit_start, popt3])
+    pcov = np.zeros((len(stacked), 4, 4))
+    pcov[:, 1:, 1:] = pcov3
+
+    shape = (n_groups, max(row_lengths, default=0))
+    equations = FitArray(popt.reshape(shape + (4,)), pcov.reshape(shape + (4, 4)))
+    overlayed_peak_indices = peak_index.reshape(shape).tolist()
+    return equations, overlayed_peak_indices # linked with isolated_peaks
+
+
+def unflatten(values: np.array, row_lengths: list, fill=np.nan):
+    """
+    Turn per-peak values (flattened like `stack_peaks` rows) back into a `(n_groups, n_teeth, ...)` array
+    """
+
+    values = np.asarray(values)
+    out = np.full((len(row_lengths), max(row_lengths, default=0)) + values.shape[1:], fill, dtype=float)
+    i = 0
+    for g_i, row_length in enumerate(row_lengths):
+        out[g_i, :row_length] = values[i:i+row_length]
+        i += row_length
+    return out
+
+def fit_residuals(isolated_peaks: list, equation_data: list, overlayed_peak_indices: list, shift_over: int):
+    """
+    Residuals & goodness of fit for every fit at once (one vectorized `exp_func` evaluation).
+    Reduced chi-square uses unit weights (no noise estimate) and 3 free parameters,
+    since x0 & a aren't independent.
+
+    Returns
+    -------
+    `(n_groups, n_teeth, width)` residuals (NaN outside each fit window),
+    `(n_groups, n_teeth)` reduced chi-square & `(n_groups, n_teeth)` R²
+    """
+
+    stacked, valid, row_lengths = stack_peaks(as_peak_array(isolated_peaks))
+    popt = as_fit_array(equation_data).popt.reshape(-1, 4)
+    fit_start = np.asarray(overlayed_peak_indices, dtype=int).ravel() + shift_over
+
+    x_data = np.arange(stacked.shape[1])[None, :]
+    window = valid & (x_data >= fit_start[:, None])
+    with np.errstate(over='ignore', invalid='ignore'):
+        model = exp_func(x_data, popt[:, 0:1], popt[:, 1:2], popt[:, 2:3], popt[:, 3:4])
+    residuals = np.where(window, stacked - model, np.nan)
+
+    m = window.sum(axis=1)
+    ssr = np.nansum(residuals**2, axis=1)
+    peak_target = np.where(window, stacked, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(peak_target, axis=1) / m # NaN for peaks with nothing in the fit window (no nanmean warning)
+        ss_tot = np.nansum((peak_target - mean[:, None])**2, axis=1)
+        chi2_red = np.where(m > 3, ssr / (m - 3), np.nan)
+        r_squared = 1 - ssr / ss_tot
+
+    return unflatten(residuals, row_lengths), unflatten(chi2_red, row_lengths), unflatten(r_squared, row_lengths)
+
+def get_time_constants(equation_data, timestep: float):
     """
     Extracts time constant from all fit-output equations (2d array)
     
     Returns
     -------
 
-    Tau data in same dimensions as `equation_data`
+    `(n_groups, n_teeth)` array of tau (in the units of `timestep`), same layout as `equation_data`
     """
-    
-    tau_data = []
-    for r in equation_data:
-        row = []
-        for e in r:
-            tau = e['popt'][3]*mem['timestep']
-            row.append(tau)
-        tau_data.append(row)
 
-    print(tau_data)
+    tau_data = as_fit_array(equation_data).tau * timestep
+    logger.debug('Time constants: %s', tau_data)
 
     return tau_data
+
+def robust_z(x: np.array, center: np.array = None, axis: int = 0):
+    """
+    `|x - center| / (MAD-based std)` along `axis` (`center` defaults to the median). NaN
+    where `x` is NaN; where the spread is 0, 0 if `x` equals the center & inf otherwise.
+    """
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        center = np.nanmedian(x, axis=axis, keepdims=True) if center is None else center
+        d = np.abs(x - center)
+        spread = 1.482602218505602 * np.nanmedian(d, axis=axis, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = d / spread
+    return np.where(d == 0, 0.0, z)
+
+GATE_CHECKS = ['fit', 'residual', 'covariance', 'tau', 'correlation']
+
+def gate_fits(
+    fit_equations,
+    chi2_red: np.array,
+    correlation_heights: np.array = None,
+    max_residual_z: float = 5.0,
+    max_condition: float = 1e8,
+    max_tau_z: float = 5.0,
+    min_tau_deviation: float = 0.02,
+    neighbours: int = 5,
+    min_correlation: float = 0.5
+):
+    """
+    Score every fit & reject the bad ones, all fits at once. Checks (`GATE_CHECKS`):
+
+    - `fit`: parameters or their variances aren't finite, or the fit ended on a bound (a = 0, tau at `TAU_MIN`)
+    - `residual`: residual RMS more than `max_residual_z` robust deviations above the tooth's median
+    - `covariance`: condition number of the (a, y0, tau) correlation matrix above `max_condition`
+    - `tau`: tau more than `max_tau_z` robust deviations (and more than `min_tau_deviation`,
+      relative) from the median tau of the `neighbours` groups around it (same tooth)
+    - `correlation`: the group's normalized correlation peak (`align_groups`) below `min_correlation`
+
+    Returns
+    -------
+    `dict` with `accepted` (`(n_groups, n_teeth)` mask), `rejected` (check -> mask, a fit can fail
+    several), `scores` (check -> `(n_groups, n_teeth)` value) & `counts` (check -> rejects per tooth,
+    plus `total` & `accepted`)
+    """
+
+    fits = as_fit_array(fit_equations)
+    n_groups, n_teeth = fits.shape
+    popt, pcov = fits.popt, fits.pcov
+    tau = fits.tau
+    var = np.diagonal(pcov[..., 1:, 1:], axis1=-2, axis2=-1)
+
+    scores = {}
+    rejected = {}
+    rejected['fit'] = ~(np.isfinite(popt).all(axis=-1) & np.isfinite(var).all(axis=-1) & (popt[..., 1] > 0) & (tau > TAU_MIN))
+
+    # Residual RMS, against the spread of the same tooth over all groups
+    rms = np.sqrt(np.asarray(chi2_red, dtype=float))
+    scores['residual'] = rms
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # teeth without a single finite fit
+        rejected['residual'] = ~np.isfinite(rms) | ((robust_z(rms) > max_residual_z) & (rms > np.nanmedian(rms, axis=0)))
+
+    # Covariance conditioning (scale-free: correlation matrix of a, y0, tau)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sd = np.sqrt(var)
+        corr = pcov[..., 1:, 1:] / (sd[..., :, None] * sd[..., None, :])
+    condition = np.full((n_groups, n_teeth), np.inf)
+    ok = np.isfinite(corr).all(axis=(-2, -1))
+    if ok.any():
+        condition[ok] = np.linalg.cond(corr[ok])
+    scores['covariance'] = condition
+    rejected['covariance'] = ~(condition <= max_condition)
+
+    # Tau against its neighbouring groups (the fit itself left out of the median)
+    h = max(int(neighbours), 2) // 2
+    padded = np.pad(np.where(rejected['fit'], np.nan, tau), ((h, h), (0, 0)), constant_values=np.nan)
+    window = sliding_window_view(padded, 2*h + 1, axis=0).copy() # (groups, teeth, window)
+    window[..., h] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # lone groups have no neighbours
+        local = np.nanmedian(window, axis=-1)
+    scores['tau'] = robust_z(tau - local, center=0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rejected['tau'] = (scores['tau'] > max_tau_z) & (np.abs(tau / local - 1) > min_tau_deviation)
+
+    # Correlation peak of the whole group
+    heights = np.ones(n_groups) if correlation_heights is None else np.asarray(correlation_heights, dtype=float)
+    scores['correlation'] = np.broadcast_to(heights[:, None], (n_groups, n_teeth))
+    rejected['correlation'] = scores['correlation'] < min_correlation
+
+    accepted = ~np.logical_or.reduce([rejected[c] for c in GATE_CHECKS])
+    counts = {c: rejected[c].sum(axis=0) for c in GATE_CHECKS}
+    counts['total'] = (~accepted).sum(axis=0)
+    counts['accepted'] = accepted.sum(axis=0)
+    return {'accepted': accepted, 'rejected': rejected, 'scores': scores, 'counts': counts}
+
+def tau_statistics(
+    time_constants,
+    sigma: float = 3.0,
+    max_iter: int = 10,
+    n_boot: int = 1000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    chunk_elements: int = 1 << 22
+):
+    """
+    Per-tooth statistics of a `(n_groups, n_teeth)` tau table, each one axis-wise over
+    the groups (NaN taus are left out):
+
+    - `n`, `mean`, `std`, `median`, `mad` (scaled to match `std` for normal data) & `se` (of the mean)
+    - `clipped_mean`, `clipped_std`, `clipped_n`: after iteratively rejecting taus more than
+      `sigma` robust deviations (MAD) from the median, until nothing changes or `max_iter` rounds
+    - `ci_low`, `ci_high`: percentile bootstrap `confidence` interval of the mean, from
+      `n_boot` resamples of the groups drawn all at once (in chunks of about `chunk_elements` values)
+
+    Returns
+    -------
+    `dict` of statistic name -> `(n_teeth,)` array
+    """
+
+    tau = np.atleast_2d(np.asarray(time_constants, dtype=float))
+    n_groups, n_teeth = tau.shape
+    finite = ~np.isnan(tau)
+    n = finite.sum(axis=0)
+    mad_scale = 1.482602218505602 # MAD -> std for normal data
+
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # all-NaN teeth just give NaN
+        mean = np.nanmean(tau, axis=0)
+        std = np.nanstd(tau, axis=0, ddof=1)
+        median = np.nanmedian(tau, axis=0)
+        mad = mad_scale * np.nanmedian(np.abs(tau - median), axis=0)
+
+        # Sigma clipping around the median, all teeth at once
+        keep = finite
+        for _ in range(max_iter):
+            kept = np.where(keep, tau, np.nan)
+            center = np.nanmedian(kept, axis=0)
+            spread = mad_scale * np.nanmedian(np.abs(kept - center), axis=0)
+            new_keep = finite & (np.abs(tau - center) <= sigma * np.where(spread > 0, spread, np.inf))
+            if np.array_equal(new_keep, keep):
+                break
+            keep = new_keep
+        kept = np.where(keep, tau, np.nan)
+        clipped_n = keep.sum(axis=0)
+
+        # Bootstrap: the same resampled group indices for every tooth, one (boots, groups, teeth) gather per chunk
+        rng = np.random.default_rng(seed)
+        boot_means = np.empty((n_boot, n_teeth))
+        chunk = max(chunk_elements // max(n_groups * n_teeth, 1), 1)
+        for i in range(0, n_boot, chunk):
+            rows = slice(i, min(i+chunk, n_boot))
+            idx = rng.integers(0, n_groups, size=(rows.stop - rows.start, n_groups))
+            boot_means[rows] = np.nanmean(tau[idx], axis=1)
+        alpha = (1 - confidence) / 2
+        ci_low, ci_high = np.nanquantile(boot_means, [alpha, 1 - alpha], axis=0) if n_boot > 0 else (np.full(n_teeth, np.nan),)*2
+
+        return {
+            'n': n,
+            'mean': mean,
+            'std': std,
+            'median': median,
+            'mad': mad,
+            'se': std / np.sqrt(n),
+            'clipped_mean': np.nanmean(kept, axis=0),
+            'clipped_std': np.nanstd(kept, axis=0, ddof=1),
+            'clipped_n': clipped_n,
+            'ci_low': ci_low,
+            'ci_high': ci_high,
+        }
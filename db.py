@@ -1,20 +1,79 @@
-from sqlitedict import SqliteDict
-from varname.core import nameof
-from hashlib import md5
+import numpy as np
+from dataclasses import dataclass, fields
+from peaks import PeakArray, FitArray
 
-class ModSqliteDict(SqliteDict):
-    def __init__(self):
+@dataclass
+class Session:
+    """
+    Analysis state for the currently loaded scan.
 
-        # Initialize in-memory db
-        self.filename = ':memory:'
-        super().__init__()
+    Attributes hold arrays (and the nested stage outputs) by reference, so reading
+    `session.y_data` never copies or deserializes anything. Use `snapshot()` /
+    `restore()` to explicitly write the state to disk & load it back.
+    """
 
-    def set_key(self, item):
-        name = nameof(item)
-        self[name] = item
+    # Raw data
+    x_data: np.ndarray = None
+    y_data: np.ndarray = None
+    v_data: np.ndarray = None
+    timestep: float = None
+    ymin: float = None
+    ymax: float = None
 
-    def set_key_value(self, item, value):
-        name = nameof(item)
-        self[name] = value
+    # Grouping & peak isolation
+    groups_correlated: list = None
+    correlation_heights: np.ndarray = None # (groups,) normalized correlation peak of each group
+    added_peaks: np.ndarray = None
+    peak_indices: np.ndarray = None
+    isolated_peaks: PeakArray = None # (groups, teeth, width) + lengths
 
-mem = ModSqliteDict()
\ No newline at end of file
+    # Fitting
+    fit_equations: FitArray = None # (groups, teeth, 4) popt & (groups, teeth, 4, 4) pcov
+    overlayed_peak_indices: list = None
+    shift_over_fit: int = None
+    time_constants: np.ndarray = None # (groups, teeth)
+    quality: dict = None # fit quality gate, see crds_calc.gate_fits (None if off)
+    tau_stats: dict = None # per-tooth statistics, see crds_calc.tau_statistics
+    residuals: np.ndarray = None # (groups, teeth, width), NaN outside the fit window
+    chi2_red: np.ndarray = None # (groups, teeth)
+    r_squared: np.ndarray = None # (groups, teeth)
+
+    def clear(self):
+        for f in fields(self):
+            setattr(self, f.name, None)
+
+    def snapshot(self, path):
+        """
+        Write all set attributes to a `.npz` file. Arrays & scalars are stored natively;
+        nested stage outputs (lists of groups/peaks/fits) are stored as object arrays.
+        """
+
+        data = {}
+        for f in fields(self):
+            value = getattr(self, f.name)
+            if value is None:
+                continue
+            if isinstance(value, np.ndarray) or np.isscalar(value):
+                data[f.name] = value
+            else:
+                obj = np.empty(1, dtype=object)
+                obj[0] = value
+                data[f.name] = obj
+        np.savez(path, **data)
+
+    def restore(self, path):
+        """
+        Load a snapshot written by `snapshot()`, replacing the current state.
+        """
+
+        self.clear()
+        with np.load(path, allow_pickle=True) as data:
+            for name in data.files:
+                value = data[name]
+                if value.dtype == object:
+                    value = value[0]
+                elif value.ndim == 0:
+                    value = value.item()
+                setattr(self, name, value)
+
+session = Session()
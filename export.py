@@ -0,0 +1,36 @@
+import numpy as np
+from pandas import DataFrame
+
+def summarize(tau_stats: dict, chi2_red: np.array = None, r_squared: np.array = None, quality: dict = None):
+    """
+    Per-tooth summary from `crds_calc.tau_statistics()` output (& reject counts of `crds_calc.gate_fits()`)
+
+    Returns
+    -------
+    `DataFrame` with one row per comb tooth
+    """
+
+    df = DataFrame({'tooth': np.arange(1, len(tau_stats['n'])+1)})
+    names = {'n': 'n', 'clipped_n': 'clipped_n', 'mean': 'tau_avg'} # tau_avg as in earlier summaries
+    for name, values in tau_stats.items():
+        df[names.get(name, f"tau_{name}")] = values
+    if quality is not None:
+        for name, counts in quality['counts'].items():
+            df[name if name == 'accepted' else f"rejected_{name}"] = counts
+    with np.errstate(invalid='ignore', divide='ignore'): # NaN for teeth without any fit (no nanmean warning)
+        if chi2_red is not None:
+            df['chi2_red_avg'] = np.nansum(chi2_red, axis=0) / (~np.isnan(chi2_red)).sum(axis=0)
+        if r_squared is not None:
+            df['r_squared_avg'] = np.nansum(r_squared, axis=0) / (~np.isnan(r_squared)).sum(axis=0)
+    return df
+
+def residuals_frame(residuals: np.array):
+    """
+    Flatten a `(groups, teeth, width)` residual array into one row per fit (NaN outside the fit window)
+    """
+
+    n_groups, n_teeth, width = residuals.shape
+    df = DataFrame(residuals.reshape(-1, width))
+    df.insert(0, 'tooth', np.tile(np.arange(1, n_teeth+1), n_groups))
+    df.insert(0, 'group', np.repeat(np.arange(1, n_groups+1), n_teeth))
+    return df
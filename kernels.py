@@ -0,0 +1,166 @@
+"""
+Hot inner loops of `crds_calc`, with a compiled (Numba) & a pure-NumPy backend.
+
+Numba is optional: without it (or with `CRDS_BACKEND=numpy` in the environment)
+everything runs on NumPy. Switch at runtime with `set_backend()`.
+"""
+
+import os
+import logging
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ['numpy', 'numba']
+
+# NumPy backend
+
+def _moving_average_numpy(x, w):
+    c = np.cumsum(x, dtype=float)
+    out = c[w-1:].copy()
+    out[1:] -= c[:-w]
+    out /= w
+    return out
+
+def _group_starts_numpy(peaks, gap):
+    if len(peaks) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([[0], np.flatnonzero(np.diff(peaks) >= gap) + 1])
+
+def _exp_func_numpy(x, x0, a, y0, tau):
+    return y0 + a*np.exp(-(x-x0)/tau)
+
+def _exp_residuals_numpy(t, y, w, rows, a, y0, tau):
+    e = np.exp(-t[rows] / tau[:, None])
+    r = (y[rows] - (y0[:, None] + a[:, None]*e)) * w[rows]
+    return e, r
+
+# Numba backend (compiled on first use)
+
+def _build_numba():
+    njit = numba.njit(cache=True, nogil=True)
+
+    @njit
+    def moving_average(x, w):
+        out = np.empty(len(x) - w + 1)
+        s = 0.0
+        for i in range(w):
+            s += x[i]
+        out[0] = s / w
+        for i in range(1, len(out)):
+            s += x[i+w-1] - x[i-1]
+            out[i] = s / w
+        return out
+
+    @njit
+    def group_starts(peaks, gap):
+        starts = np.empty(len(peaks), dtype=np.int64)
+        n = 0
+        for i in range(len(peaks)):
+            if i == 0 or peaks[i] - peaks[i-1] >= gap:
+                starts[n] = i
+                n += 1
+        return starts[:n]
+
+    @numba.vectorize(['float64(float64, float64, float64, float64, float64)'], cache=True)
+    def exp_func(x, x0, a, y0, tau):
+        return y0 + a*np.exp(-(x-x0)/tau)
+
+    @numba.njit(cache=True, nogil=True, parallel=True)
+    def exp_residuals(t, y, w, rows, a, y0, tau):
+        e = np.empty((len(rows), t.shape[1]))
+        r = np.empty((len(rows), t.shape[1]))
+        for i in numba.prange(len(rows)):
+            row = rows[i]
+            for j in range(t.shape[1]):
+                e[i, j] = np.exp(-t[row, j] / tau[i])
+                r[i, j] = (y[row, j] - (y0[i] + a[i]*e[i, j])) * w[row, j]
+        return e, r
+
+    return {
+        'moving_average': moving_average,
+        'group_starts': group_starts,
+        'exp_func': exp_func,
+        'exp_residuals': exp_residuals,
+    }
+
+_numpy = {
+    'moving_average': _moving_average_numpy,
+    'group_starts': _group_starts_numpy,
+    'exp_func': _exp_func_numpy,
+    'exp_residuals': _exp_residuals_numpy,
+}
+_numba = None
+_impl = _numpy
+backend = 'numpy'
+
+def set_backend(name: str):
+    """
+    Use the `'numpy'` or `'numba'` kernels from now on
+    """
+
+    global _impl, _numba, backend
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name} (choose from {', '.join(BACKENDS)})")
+    if name == 'numba':
+        if numba is None:
+            raise ValueError('Numba is not installed.')
+        if _numba is None:
+            _numba = _build_numba()
+        _impl = _numba
+    else:
+        _impl = _numpy
+    backend = name
+
+def default_backend():
+    name = os.environ.get('CRDS_BACKEND')
+    if name is None:
+        return 'numba' if numba is not None else 'numpy'
+    if name not in BACKENDS:
+        logger.warning(f"Unknown backend {name} in CRDS_BACKEND (choose from {', '.join(BACKENDS)}); using numpy")
+        return 'numpy'
+    if name == 'numba' and numba is None:
+        logger.warning('CRDS_BACKEND=numba but Numba is not installed; using numpy')
+        return 'numpy'
+    return name
+
+# Kernels
+
+def moving_average(x: np.array, w: int):
+    """
+    Simple moving average over windows of `w` samples ('valid' part only, O(n) in `w`)
+    """
+
+    w = int(w)
+    if w < 1:
+        raise ValueError('Moving average size must be at least 1.')
+    x = np.ascontiguousarray(x, dtype=float)
+    if len(x) < w:
+        return np.empty(0)
+    return _impl['moving_average'](x, w)
+
+def group_starts(peaks: np.array, gap: float):
+    """
+    Indices of the first peak of every group; a new group starts wherever the
+    distance to the previous peak is at least `gap`
+    """
+
+    return _impl['group_starts'](np.ascontiguousarray(peaks, dtype=float), float(gap))
+
+def exp_func(x, x0, a, y0, tau):
+    return _impl['exp_func'](x, x0, a, y0, tau)
+
+def exp_residuals(t: np.array, y: np.array, w: np.array, rows: np.array, a: np.array, y0: np.array, tau: np.array):
+    """
+    `e^(-t/tau)` & weighted residuals `(y - (y0 + a*e)) * w` of the given `rows` of `t`/`y`/`w`
+    (one set of parameters per row)
+    """
+
+    return _impl['exp_residuals'](t, y, w, rows, a, y0, tau)
+
+set_backend(default_backend())
@@ -0,0 +1,168 @@
+import numpy as np
+from pandas import read_csv
+from hashlib import md5
+from os import getcwd, makedirs, replace as os_replace, stat
+from os.path import abspath, join as path_join, exists
+from profiling import profiler
+
+# Zurich lock-in export format
+COMMENT = '%'
+DELIMITER = ';'
+MAX_COLUMNS = 3 # <time>; <signal>; <piezo voltage (optional)>
+
+BLOCK_SIZE = 1 << 24 # bytes per read when scanning the raw file
+FINGERPRINT_SIZE = 1 << 20 # bytes hashed from each end of the file
+
+def default_cache_dir():
+    return path_join(getcwd(), 'db')
+
+def fingerprint(filename: str):
+    """
+    Cache key for a data file: path, size, mtime & the first/last MiB of content.
+    Hashing the whole file would cost as much as parsing it, which defeats the point.
+    """
+
+    st = stat(filename)
+    h = md5(f"{abspath(filename)}|{st.st_size}|{st.st_mtime_ns}".encode('utf-8'))
+    with open(filename, 'rb') as f:
+        h.update(f.read(FINGERPRINT_SIZE))
+        if st.st_size > FINGERPRINT_SIZE:
+            f.seek(max(st.st_size - FINGERPRINT_SIZE, FINGERPRINT_SIZE))
+            h.update(f.read())
+    return h.hexdigest()
+
+def content_key(filename: str, samples: int = 16):
+    """
+    Key for a data file's *content* only (size, first/last MiB & `samples` blocks spread
+    across the middle), so it stays the same when the file is renamed, moved or copied.
+    """
+
+    size = stat(filename).st_size
+    h = md5(str(size).encode('utf-8'))
+    with open(filename, 'rb') as f:
+        h.update(f.read(FINGERPRINT_SIZE))
+        if size > 2*FINGERPRINT_SIZE:
+            for offset in np.linspace(FINGERPRINT_SIZE, size - FINGERPRINT_SIZE, samples + 2)[1:-1].astype(np.int64):
+                f.seek(int(offset))
+                h.update(f.read(1 << 16))
+        if size > FINGERPRINT_SIZE:
+            f.seek(max(size - FINGERPRINT_SIZE, FINGERPRINT_SIZE))
+            h.update(f.read())
+    return h.hexdigest()
+
+def scan_layout(filename: str):
+    """
+    Single binary pass over the file to find the number of data rows & columns
+    (the first non-comment line is the header, same as `pandas.read_csv` would treat it).
+
+    Returns
+    -------
+    Row count, column count
+    """
+
+    header = None
+    with open(filename, 'rb') as f:
+        for line in f:
+            if line.strip() and not line.startswith(COMMENT.encode()):
+                header = line
+                break
+
+    lines = 0
+    prev = b'\n' # so the very first byte counts as a line start
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            raw = np.frombuffer(block, dtype=np.uint8)
+            starts = np.flatnonzero(raw[:-1] == ord('\n')) + 1
+            if prev == b'\n':
+                starts = np.concatenate([[0], starts])
+            first = raw[starts]
+            # Skip comments & blank lines (incl. CRLF blanks)
+            keep = (first != ord(COMMENT)) & (first != ord('\n')) & (first != ord('\r'))
+            lines += int(np.count_nonzero(keep))
+            prev = block[-1:]
+
+    if header is None:
+        return 0, 0
+    n_cols = header.split(COMMENT.encode())[0].count(DELIMITER.encode()) + 1
+    return lines - 1, n_cols
+
+def parse_csv(filename: str, out: np.array, chunk_rows: int = 1000000):
+    """
+    Parse a Zurich CSV chunk by chunk straight into `out`, a preallocated
+    `(n_columns, n_rows)` float64 array (or memmap). Each column stays contiguous.
+    """
+
+    n_cols, n_rows = out.shape
+    i = 0
+    with read_csv(
+        filename,
+        comment=COMMENT,
+        delimiter=DELIMITER,
+        usecols=range(n_cols),
+        dtype=np.float64,
+        chunksize=chunk_rows
+    ) as reader:
+        for chunk in reader:
+            block = chunk.to_numpy(dtype=np.float64)
+            out[:, i:i+len(block)] = block.T
+            i += len(block)
+
+    if i != n_rows:
+        raise ValueError(f"Expected {n_rows} rows in {filename}, parsed {i}")
+    return out
+
+def load_csv(
+    filename: str,
+    chunk_rows: int = 1000000,
+    cache: bool = True,
+    mmap: bool = True,
+    cache_dir: str = None,
+    columns: bool = False
+):
+    """
+    Load a Zurich (`%` comments, `;` delimiter) CSV export.
+
+    With `cache`, the parsed columns are stored as a `.npy` sidecar keyed by `fingerprint()`,
+    so reopening the same scan skips parsing. With `mmap`, the sidecar is opened memory-mapped
+    (read-only) & only the pages that actually get used are read from disk.
+
+    Returns
+    -------
+    `x_data`, `y_data` & `v_data` (`None` if there's no voltage column), or the whole
+    `(n_columns, n_rows)` array with `columns`
+    """
+
+    if cache:
+        cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+        makedirs(cache_dir, exist_ok=True)
+        sidecar = path_join(cache_dir, f"{fingerprint(filename)}.npy")
+
+        if not exists(sidecar):
+            with profiler.stage('load (parse)') as stage:
+                n_rows, n_cols = scan_layout(filename)
+                stage['items'] = n_rows
+                tmp = sidecar + '.tmp'
+                out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float64, shape=(min(n_cols, MAX_COLUMNS), n_rows))
+                parse_csv(filename, out, chunk_rows)
+                out.flush()
+                del out
+                os_replace(tmp, sidecar) # only publish complete caches
+
+        with profiler.stage('load (cached)') as stage:
+            data = np.load(sidecar, mmap_mode='r' if mmap else None)
+            stage['items'] = data.shape[-1]
+    else:
+        with profiler.stage('load (parse)') as stage:
+            n_rows, n_cols = scan_layout(filename)
+            stage['items'] = n_rows
+            data = parse_csv(filename, np.empty((min(n_cols, MAX_COLUMNS), n_rows)), chunk_rows)
+
+    if columns:
+        return data
+    if data.shape[0] < 2:
+        raise ValueError(f"{filename} needs at least a time & a signal column")
+    v_data = data[2] if data.shape[0] > 2 else None
+    return data[0], data[1], v_data
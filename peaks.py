@@ -0,0 +1,135 @@
+"""
+Array-backed stage outputs. Isolated peaks & fit results are rectangular (every group has
+the same comb teeth), so they are kept as dense `(n_groups, n_teeth, ...)` arrays. Both still
+index like the nested lists they replace: `peaks[g][p]` is a peak, `fits[g][p]['popt']` its fit.
+"""
+
+import numpy as np
+
+class PeakArray:
+    """
+    Isolated peaks as one `(n_groups, n_teeth, width)` array, NaN past the end of every peak.
+    `lengths` holds the length of every peak; `valid` is the matching mask.
+    """
+
+    def __init__(self, data: np.array, lengths: np.array):
+        self.data = data
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+
+    @classmethod
+    def from_rows(cls, rows: list):
+        """
+        From nested lists: one row (group) of peaks per group, every row with the same number of teeth
+        """
+
+        n_teeth = len(rows[0]) if len(rows) else 0
+        if any([len(row) != n_teeth for row in rows]):
+            raise ValueError('Every group needs the same number of peaks.')
+        lengths = np.array([[len(p) for p in row] for row in rows], dtype=np.int64).reshape(len(rows), n_teeth)
+        data = np.full(lengths.shape + (lengths.max(initial=0),), np.nan)
+        for g_i, row in enumerate(rows):
+            for p_i, p in enumerate(row):
+                data[g_i, p_i, :len(p)] = p
+        return cls(data, lengths)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def n_groups(self):
+        return self.data.shape[0]
+
+    @property
+    def n_teeth(self):
+        return self.data.shape[1]
+
+    @property
+    def valid(self):
+        return np.arange(self.data.shape[2]) < self.lengths[..., None]
+
+    def flat(self):
+        """
+        Returns
+        -------
+        `(n_peaks, width)` view of the peaks, matching validity mask & row lengths (like `crds_calc.stack_peaks`)
+        """
+
+        width = self.data.shape[2]
+        return self.data.reshape(-1, width), self.valid.reshape(-1, width), [self.n_teeth] * self.n_groups
+
+    def __len__(self):
+        return self.n_groups
+
+    def __getitem__(self, i):
+        if isinstance(i, tuple): # peaks[g, p]
+            g_i, p_i = i
+            return self.data[g_i, p_i, :self.lengths[g_i, p_i]]
+        return [self.data[i, p_i, :n] for p_i, n in enumerate(self.lengths[i])]
+
+    def __iter__(self):
+        return (self[g_i] for g_i in range(self.n_groups))
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.lengths.nbytes
+
+class FitArray:
+    """
+    Fit results as `(n_groups, n_teeth, 4)` parameters `[x0, a, y0, tau]` & `(n_groups, n_teeth, 4, 4)` covariances
+    """
+
+    def __init__(self, popt: np.array, pcov: np.array):
+        self.popt = popt
+        self.pcov = pcov
+
+    @classmethod
+    def from_rows(cls, rows: list):
+        """
+        From nested lists of `{'popt': ..., 'pcov': ...}` dicts, every row with the same number of teeth
+        """
+
+        n_teeth = len(rows[0]) if len(rows) else 0
+        if any([len(row) != n_teeth for row in rows]):
+            raise ValueError('Every group needs the same number of fits.')
+        popt = np.array([[eq['popt'] for eq in row] for row in rows], dtype=float).reshape(len(rows), n_teeth, 4)
+        pcov = np.array([[eq['pcov'] for eq in row] for row in rows], dtype=float).reshape(len(rows), n_teeth, 4, 4)
+        return cls(popt, pcov)
+
+    @property
+    def shape(self):
+        return self.popt.shape[:2]
+
+    @property
+    def n_groups(self):
+        return self.popt.shape[0]
+
+    @property
+    def n_teeth(self):
+        return self.popt.shape[1]
+
+    @property
+    def tau(self):
+        # In ticks
+        return self.popt[..., 3]
+
+    def __len__(self):
+        return self.n_groups
+
+    def __getitem__(self, i):
+        if isinstance(i, tuple): # fits[g, p]
+            return {'popt': self.popt[i], 'pcov': self.pcov[i]}
+        return [{'popt': popt, 'pcov': pcov} for popt, pcov in zip(self.popt[i], self.pcov[i])]
+
+    def __iter__(self):
+        return (self[g_i] for g_i in range(self.n_groups))
+
+    @property
+    def nbytes(self):
+        return self.popt.nbytes + self.pcov.nbytes
+
+def as_peak_array(isolated_peaks):
+    return isolated_peaks if isinstance(isolated_peaks, PeakArray) else PeakArray.from_rows(isolated_peaks)
+
+def as_fit_array(fit_equations):
+    return fit_equations if isinstance(fit_equations, FitArray) else FitArray.from_rows(fit_equations)
@@ -0,0 +1,493 @@
+import json
+import numpy as np
+import crds_calc
+import kernels
+from peaks import PeakArray, FitArray
+from profiling import profiler
+from hashlib import md5
+from threading import Lock
+from collections import OrderedDict
+
+# Same names (and defaults) as the input widgets in the main window, so a parameter
+# file reads just like the GUI config panel.
+DEFAULT_PARAMS = {
+    # General
+    'spin_timestep': None, # None: derive from the time column
+
+    # Grouping
+    'combo_grouping_algo': 1, # 0: VThreshold, 1: SpacedGroups
+    'spin_min_voltage': 0.001,
+    'spin_max_voltage': 0.009,
+    'spin_group_len': 0.0006,
+    'spin_min_peakheight': 0.0004,
+    'spin_min_peakprominence': 0.0012,
+    'spin_moving_average_denom': 20,
+    'check_custom_start': False,
+    'spin_start_time': 0.0,
+    'check_custom_end': False,
+    'spin_end_time': 0.0,
+    'check_skip_groups': True,
+
+    # Peak isolation
+    'spin_peak_overlap': 2000,
+    'spin_min_peak_height_added': 0.0,
+    'spin_peak_prominence_added': 0.01,
+    'spin_shift_over': 200,
+    'combo_stacking': 0, # index into crds_calc.STACKING (0: sum, 1: noise-weighted, 2: median)
+
+    # Fitting
+    'spin_var_a': 0.0005,
+    'spin_var_tau': 150,
+    'spin_var_y0': 0.0,
+    'spin_shift_over_fit': 40,
+    'check_advanced_peak_detection': False,
+    'spin_min_peakheight_2': 0.0004,
+    'spin_min_peakprominence_2': 0.0012,
+    'spin_moving_average_denom_2': 20,
+    'check_quick_look': False, # closed-form estimates only, no nonlinear fit
+    'combo_fit_method': 0, # index into FIT_METHODS
+    'spin_fit_workers': 1, # processes for curve_fit (groups spread over a pool if > 1)
+    'spin_fit_chunksize': 1, # groups per pool task
+    'check_quality_gate': True, # leave fits that fail crds_calc.gate_fits out of the tau statistics
+}
+
+def load_params(filename: str = None):
+    """
+    Read a JSON parameter file (keys named after the GUI widgets) on top of `DEFAULT_PARAMS`.
+    """
+
+    params = dict(DEFAULT_PARAMS)
+    if filename is None:
+        return params
+    with open(filename, 'r') as f:
+        user_params = json.load(f)
+    unknown = set(user_params) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+    params.update(user_params)
+    return params
+
+def get_timestep(x_data: np.array, params: dict):
+    if params['spin_timestep']:
+        return params['spin_timestep']
+    return (x_data[-1] - x_data[0]) / len(x_data)
+
+def window(x_data, y_data, v_data, params: dict):
+    """
+    Cut the custom start-end window out of the channels (same indexing as the `crds_calc`
+    grouping algos). Lazy channels (`readers`) only get that window read.
+    """
+
+    def t2i(t): # STATIC time to index
+        return int(abs(x_data[0] - t) / abs(x_data[1] - x_data[0]))
+
+    start = t2i(params['spin_start_time']) if params['check_custom_start'] else None
+    stop = t2i(params['spin_end_time']) if params['check_custom_end'] else None
+    if start is not None and stop is not None and stop < start:
+        start = stop
+    cut = slice(start, stop)
+    return np.asarray(x_data[cut]), np.asarray(y_data[cut]), None if v_data is None else np.asarray(v_data[cut])
+
+# Stages (one per button in the GUI)
+
+def stage_smooth(x_data: np.array, y_data: np.array, v_data: np.array, params: dict):
+    # Moving average of the signal that SpacedGroups finds peaks in
+    _, y_data, _ = window(x_data, y_data, v_data, params)
+    with profiler.stage('smooth', items=len(y_data)):
+        return kernels.moving_average(y_data, params['spin_moving_average_denom'])
+
+def stage_group(x_data: np.array, y_data: np.array, v_data: np.array, params: dict, y_data_av: np.array = None):
+    mirrored = bool(params['check_skip_groups'])
+    x_data, y_data, v_data = window(x_data, y_data, v_data, params)
+
+    if params['combo_grouping_algo'] == 0:
+        if v_data is None:
+            raise ValueError('No voltage column detected. VThreshold algo will not work.')
+        with profiler.stage('group (vthreshold)', items=len(y_data)):
+            return crds_calc.vthreshold(
+                x_data,
+                y_data,
+                v_data,
+                params['spin_min_voltage'],
+                params['spin_max_voltage'],
+                mirrored=mirrored
+            )
+
+    with profiler.stage('group (spaced)', items=len(y_data)):
+        return crds_calc.spaced_groups(
+            x_data,
+            y_data,
+            params['spin_group_len'],
+            params['spin_min_peakheight'],
+            params['spin_min_peakprominence'],
+            params['spin_moving_average_denom'],
+            mirrored=mirrored,
+            y_data_av=y_data_av
+        )
+
+def stage_correlate(groups_raw: list, progress=None):
+    # Overlayed groups, lags & correlation peak heights (see `crds_calc.align_groups`)
+    if groups_raw is None or len(groups_raw) < 1:
+        raise ValueError('No groups were detected. Try adjusting grouping parameters.')
+    with profiler.stage('correlate', items=len(groups_raw)):
+        return crds_calc.align_groups(groups_raw, progress=progress)
+
+def stage_isolate(groups_correlated: list, params: dict, progress=None):
+    with profiler.stage('isolate', items=len(groups_correlated)):
+        return crds_calc.isolate_peaks(
+            groups_correlated,
+            params['spin_peak_overlap'],
+            params['spin_moving_average_denom'],
+            peak_minheight=params['spin_min_peak_height_added'],
+            peak_prominence=params['spin_peak_prominence_added'],
+            shift_over=params['spin_shift_over'],
+            stacking=crds_calc.STACKING[params['combo_stacking']],
+            progress=progress
+        )
+
+FIT_METHODS = ['batch', 'curve_fit'] # combo_fit_method
+
+def stage_fit(
+    isolated_peaks: list,
+    peak_indices: np.array,
+    params: dict,
+    method: str = 'batch',
+    workers: int = None,
+    chunksize: int = None,
+    progress=None
+):
+    # The fit method input & quick look override `method`; `workers`/`chunksize` default to the inputs
+    n_peaks = sum([len(row) for row in isolated_peaks])
+    if params['check_quick_look']:
+        method = 'quick'
+    elif params['combo_fit_method'] != 0:
+        method = FIT_METHODS[params['combo_fit_method']]
+    workers = params['spin_fit_workers'] if workers is None else workers
+    chunksize = params['spin_fit_chunksize'] if chunksize is None else chunksize
+    with profiler.stage(f"fit ({method})", items=n_peaks):
+        return crds_calc.fit_peaks(
+            isolated_peaks,
+            peak_indices,
+            params['spin_min_peakheight_2'],
+            params['spin_min_peakprominence_2'],
+            params['spin_moving_average_denom_2'],
+            params['spin_var_a'],
+            params['spin_var_tau'],
+            params['spin_var_y0'],
+            params['spin_shift_over_fit'],
+            params['check_advanced_peak_detection'],
+            method=method,
+            workers=workers,
+            chunksize=chunksize,
+            progress=progress
+        )
+
+def stage_residuals(isolated_peaks: list, fit_equations: list, overlayed_peak_indices: list, params: dict):
+    with profiler.stage('residuals', items=sum([len(row) for row in fit_equations])):
+        return crds_calc.fit_residuals(isolated_peaks, fit_equations, overlayed_peak_indices, params['spin_shift_over_fit'])
+
+def stage_tau(fit_equations: list, timestep: float):
+    with profiler.stage('tau', items=sum([len(row) for row in fit_equations])):
+        return crds_calc.get_time_constants(fit_equations, timestep)
+
+def stage_gate(fit_equations, chi2_red: np.array, correlation_heights: np.array, params: dict):
+    # `None` if gating is off (every fit accepted)
+    if not params['check_quality_gate']:
+        return None
+    with profiler.stage('quality gate', items=np.size(chi2_red)):
+        return crds_calc.gate_fits(fit_equations, chi2_red, correlation_heights)
+
+def stage_stats(time_constants: np.array, quality: dict = None):
+    with profiler.stage('tau stats', items=np.size(time_constants)):
+        if quality is not None:
+            time_constants = np.where(quality['accepted'], time_constants, np.nan)
+        return crds_calc.tau_statistics(time_constants)
+
+def run_pipeline(
+    x_data: np.array,
+    y_data: np.array,
+    v_data: np.array,
+    params: dict,
+    fit_method: str = 'batch',
+    workers: int = None,
+    chunksize: int = None
+):
+    """
+    Run grouping -> correlation -> isolation -> fitting -> tau extraction on one scan.
+    `workers`/`chunksize` spread curve_fit over a process pool (default: the fit worker inputs).
+
+    Returns
+    -------
+    `dict` of every stage output, keyed like the `Session` attributes
+    """
+
+    timestep = get_timestep(x_data, params)
+    groups_raw = stage_group(x_data, y_data, v_data, params)
+    groups_correlated, _, correlation_heights = stage_correlate(groups_raw)
+    added_peaks, peak_indices, isolated_peaks = stage_isolate(groups_correlated, params)
+    fit_equations, overlayed_peak_indices = stage_fit(isolated_peaks, peak_indices, params, method=fit_method, workers=workers, chunksize=chunksize)
+    residuals, chi2_red, r_squared = stage_residuals(isolated_peaks, fit_equations, overlayed_peak_indices, params)
+    time_constants = stage_tau(fit_equations, timestep)
+    quality = stage_gate(fit_equations, chi2_red, correlation_heights, params)
+    tau_stats = stage_stats(time_constants, quality)
+
+    return {
+        'timestep': timestep,
+        'groups_correlated': groups_correlated,
+        'correlation_heights': correlation_heights,
+        'added_peaks': added_peaks,
+        'peak_indices': peak_indices,
+        'isolated_peaks': isolated_peaks,
+        'fit_equations': fit_equations,
+        'overlayed_peak_indices': overlayed_peak_indices,
+        'shift_over_fit': params['spin_shift_over_fit'],
+        'residuals': residuals,
+        'chi2_red': chi2_red,
+        'r_squared': r_squared,
+        'time_constants': time_constants,
+        'quality': quality,
+        'tau_stats': tau_stats,
+    }
+
+
+# Incremental (cached) pipeline
+
+# Inputs each stage depends on, on top of its upstream stage
+GROUP_PARAMS = {
+    0: ['spin_min_voltage', 'spin_max_voltage'],
+    1: ['spin_group_len', 'spin_min_peakheight', 'spin_min_peakprominence', 'spin_moving_average_denom'],
+}
+WINDOW_PARAMS = ['check_custom_start', 'spin_start_time', 'check_custom_end', 'spin_end_time']
+GROUP_COMMON_PARAMS = ['combo_grouping_algo', 'check_skip_groups'] + WINDOW_PARAMS
+ISOLATE_PARAMS = ['spin_peak_overlap', 'spin_moving_average_denom', 'spin_min_peak_height_added', 'spin_peak_prominence_added', 'spin_shift_over', 'combo_stacking']
+FIT_PARAMS = [
+    'spin_min_peakheight_2', 'spin_min_peakprominence_2', 'spin_moving_average_denom_2',
+    'spin_var_a', 'spin_var_tau', 'spin_var_y0', 'spin_shift_over_fit', 'check_advanced_peak_detection', 'check_quick_look',
+    'combo_fit_method'
+] # not the worker count & chunk size: they don't change the result
+
+def nbytes(value):
+    """
+    Rough memory footprint of a stage output (arrays, nested lists/tuples/dicts of arrays)
+    """
+
+    if isinstance(value, (np.ndarray, PeakArray, FitArray)):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return 64 + sum([nbytes(v) for v in value])
+    if isinstance(value, dict):
+        return 64 + sum([nbytes(v) for v in value.values()])
+    return 64
+
+def hash_arrays(*arrays):
+    h = md5()
+    for a in arrays:
+        if a is None:
+            h.update(b'None')
+            continue
+        a = np.ascontiguousarray(a)
+        h.update(f"{a.dtype}{a.shape}".encode('utf-8'))
+        h.update(a.data)
+    return h.hexdigest()
+
+def stage_key(name: str, upstream: str, values):
+    return md5(json.dumps([name, upstream, values], default=str).encode('utf-8')).hexdigest()
+
+class StageCache:
+    """
+    LRU cache of stage outputs, bounded by (approximate) memory use. The latest output is
+    always kept, even on its own over `max_bytes` (everything else is evicted then), so
+    asking for it again never recomputes it.
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> (value, size)
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value):
+        size = nbytes(value)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, s) = self.entries.popitem(last=False)
+                self.size -= s
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+class Pipeline:
+    """
+    Stage graph load -> (smooth ->) group -> correlate -> add/isolate -> fit -> residuals/tau -> gate -> stats with memoized outputs.
+
+    Every stage output is stored under a key built from the key of its upstream stage &
+    the parameters it uses, so only the raw data ever gets hashed. Asking for a stage
+    recomputes only what changed since last time (including anything upstream of it).
+    """
+
+    def __init__(self, cache: StageCache = None):
+        self.cache = StageCache() if cache is None else cache
+        self.data = None
+        self.data_key = None
+
+    def set_data(self, x_data: np.array, y_data: np.array, v_data: np.array, key: str = None):
+        """
+        Load stage. Pass `key` (e.g. `loader.fingerprint(filename)`) to skip hashing the arrays.
+        """
+
+        self.data = (x_data, y_data, v_data)
+        self.data_key = hash_arrays(x_data, y_data, v_data) if key is None else key
+
+    # Keys (cheap, no computation)
+
+    def group_key(self, params: dict):
+        names = GROUP_COMMON_PARAMS + GROUP_PARAMS[params['combo_grouping_algo']]
+        return stage_key('group', self.data_key, [params[n] for n in names])
+
+    def smooth_key(self, params: dict):
+        return stage_key('smooth', self.data_key, [params[n] for n in WINDOW_PARAMS + ['spin_moving_average_denom']])
+
+    def correlate_key(self, params: dict):
+        return stage_key('correlate', self.group_key(params), [])
+
+    def add_key(self, params: dict):
+        return stage_key('add', self.correlate_key(params), [params['combo_stacking']])
+
+    def isolate_key(self, params: dict):
+        return stage_key('isolate', self.correlate_key(params), [params[n] for n in ISOLATE_PARAMS])
+
+    def fit_key(self, params: dict, method: str = 'batch'):
+        return stage_key('fit', self.isolate_key(params), [params[n] for n in FIT_PARAMS] + [method])
+
+    def residuals_key(self, params: dict, method: str = 'batch'):
+        return stage_key('residuals', self.fit_key(params, method), [])
+
+    def tau_key(self, params: dict, timestep: float, method: str = 'batch'):
+        return stage_key('tau', self.fit_key(params, method), [timestep])
+
+    def restore(self, params: dict, results: dict, method: str = 'batch'):
+        """
+        Put stored stage outputs (keyed like the `Session` attributes, computed with `params`)
+        back into the cache, so asking for those stages again doesn't recompute anything.
+
+        Returns
+        -------
+        `dict` with the `quality` & `tau_stats` derived from stored fit results (empty without them)
+        """
+
+        def has(*names):
+            return all([results.get(n) is not None for n in names])
+
+        if has('groups_correlated'):
+            self.cache.put(self.correlate_key(params), (results['groups_correlated'], None, results.get('correlation_heights')))
+        if has('added_peaks', 'peak_indices', 'isolated_peaks'):
+            self.cache.put(self.isolate_key(params), (results['added_peaks'], results['peak_indices'], results['isolated_peaks']))
+        elif has('added_peaks'):
+            self.cache.put(self.add_key(params), results['added_peaks'])
+        if has('fit_equations', 'overlayed_peak_indices'):
+            self.cache.put(self.fit_key(params, method), (results['fit_equations'], results['overlayed_peak_indices']))
+        if has('fit_equations', 'residuals', 'chi2_red', 'r_squared'):
+            self.cache.put(self.residuals_key(params, method), (results['residuals'], results['chi2_red'], results['r_squared']))
+        if has('fit_equations', 'time_constants', 'timestep'):
+            self.cache.put(self.tau_key(params, results['timestep'], method), results['time_constants'])
+
+        # Gate & stats aren't stored (cheap): compute them from the stored outputs, so nothing
+        # upstream has to be in the cache (big outputs may not all fit)
+        derived = {}
+        if has('fit_equations', 'chi2_red', 'time_constants', 'timestep'):
+            derived['quality'] = stage_gate(results['fit_equations'], results['chi2_red'], results.get('correlation_heights'), params)
+            derived['tau_stats'] = stage_stats(results['time_constants'], derived['quality'])
+            self.cache.put(self.gate_key(params, method), derived['quality'])
+            self.cache.put(self.stats_key(params, results['timestep'], method), derived['tau_stats'])
+        return derived
+
+    # Stages
+
+    def cached(self, key: str, compute):
+        value = self.cache.get(key)
+        if value is None:
+            value = compute()
+            self.cache.put(key, value)
+        return value
+
+    def group(self, params: dict):
+        if self.data is None:
+            raise ValueError('No data loaded.')
+        def compute():
+            smoothed = self.smooth(params) if params['combo_grouping_algo'] == 1 else None
+            return stage_group(*self.data, params, y_data_av=smoothed)
+        return self.cached(self.group_key(params), compute)
+
+    def smooth(self, params: dict):
+        # Shared by every SpacedGroups setting with the same window & moving average size
+        if self.data is None:
+            raise ValueError('No data loaded.')
+        return self.cached(self.smooth_key(params), lambda: stage_smooth(*self.data, params))
+
+    def align(self, params: dict, progress=None):
+        # Overlayed groups, lags & correlation heights (lags/heights may be `None` if restored from an older save)
+        return self.cached(self.correlate_key(params), lambda: stage_correlate(self.group(params), progress=progress))
+
+    def correlate(self, params: dict, progress=None):
+        return self.align(params, progress=progress)[0]
+
+    def add(self, params: dict, progress=None):
+        def compute():
+            groups_correlated = self.correlate(params, progress=progress)
+            with profiler.stage('add', items=len(groups_correlated)):
+                return crds_calc.add_peaks_only(groups_correlated, crds_calc.STACKING[params['combo_stacking']])
+        return self.cached(self.add_key(params), compute)
+
+    def isolate(self, params: dict, progress=None):
+        return self.cached(self.isolate_key(params), lambda: stage_isolate(self.correlate(params, progress=progress), params, progress=progress))
+
+    def fit(self, params: dict, method: str = 'batch', progress=None):
+        def compute():
+            _, peak_indices, isolated_peaks = self.isolate(params, progress=progress)
+            return stage_fit(isolated_peaks, peak_indices, params, method=method, progress=progress)
+        return self.cached(self.fit_key(params, method), compute)
+
+    def residuals(self, params: dict, method: str = 'batch'):
+        def compute():
+            _, _, isolated_peaks = self.isolate(params)
+            fit_equations, overlayed_peak_indices = self.fit(params, method)
+            return stage_residuals(isolated_peaks, fit_equations, overlayed_peak_indices, params)
+        return self.cached(self.residuals_key(params, method), compute)
+
+    def tau(self, params: dict, timestep: float, method: str = 'batch'):
+        def compute():
+            fit_equations, _ = self.fit(params, method)
+            return stage_tau(fit_equations, timestep)
+        return self.cached(self.tau_key(params, timestep, method), compute)
+
+    def gate_key(self, params: dict, method: str = 'batch'):
+        return stage_key('gate', self.residuals_key(params, method), [params['check_quality_gate']])
+
+    def gate(self, params: dict, method: str = 'batch'):
+        def compute():
+            fit_equations, _ = self.fit(params, method)
+            _, chi2_red, _ = self.residuals(params, method)
+            return stage_gate(fit_equations, chi2_red, self.align(params)[2], params)
+        return self.cached(self.gate_key(params, method), compute)
+
+    def stats_key(self, params: dict, timestep: float, method: str = 'batch'):
+        return stage_key('stats', self.tau_key(params, timestep, method), [self.gate_key(params, method)])
+
+    def stats(self, params: dict, timestep: float, method: str = 'batch'):
+        return self.cached(
+            self.stats_key(params, timestep, method),
+            lambda: stage_stats(self.tau(params, timestep, method), self.gate(params, method))
+        )
@@ -0,0 +1,162 @@
+import os
+import json
+import threading
+import tracemalloc
+from time import time, perf_counter, thread_time
+from dataclasses import dataclass
+from contextlib import contextmanager
+
+@dataclass
+class StageRecord:
+    name: str
+    start: float # Unix time (s), comparable across processes
+    wall: float # seconds
+    cpu: float # seconds, calling thread only (not worker processes)
+    peak_memory: int # bytes allocated on top of what was live when the stage started, None without memory tracing
+    items: int = None # e.g. samples, groups or peaks processed
+    pid: int = None
+    tid: int = None
+
+class Profiler:
+    """
+    Records wall time, CPU time, peak allocated memory & item counts of every pipeline
+    stage run inside `stage()`. Does nothing (and costs nothing) unless `enabled`.
+
+    Peak memory is only recorded with `trace_memory`: it is traced with `tracemalloc`
+    (NumPy reports its allocations to it), which slows down allocation-heavy Python code
+    (several times for `curve_fit`), so the times it records are inflated.
+    """
+
+    def __init__(self, enabled: bool = False, trace_memory: bool = False):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local() # stack of open stages per thread
+
+    def enable(self, trace_memory: bool = False):
+        self.enabled = True
+        self.trace_memory = trace_memory
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self.lock:
+            self.records = []
+
+    @contextmanager
+    def stage(self, name: str, items: int = None):
+        """
+        Record the enclosed block as stage `name`. Yields a `dict`; set its `items` key
+        when the item count is only known inside the block.
+        """
+
+        if not self.enabled:
+            yield {}
+            return
+
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+
+        frame = {'child_peak': 0, 'started': False, 'items': items}
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                frame['started'] = True
+            current, peak = tracemalloc.get_traced_memory()
+            if stack: # keep the enclosing stage's peak, reset_peak() is about to drop it
+                stack[-1]['child_peak'] = max(stack[-1]['child_peak'], peak)
+            tracemalloc.reset_peak()
+            frame['base'] = current
+        stack.append(frame)
+
+        start = time()
+        t_start = perf_counter()
+        cpu_start = thread_time()
+        try:
+            yield frame
+        finally:
+            wall = perf_counter() - t_start
+            cpu = thread_time() - cpu_start
+            stack.pop()
+            peak_memory = None
+            if 'base' in frame and tracemalloc.is_tracing(): # traced when the stage started (can be toggled meanwhile)
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, frame['child_peak'])
+                peak_memory = max(peak - frame['base'], 0)
+                if stack:
+                    stack[-1]['child_peak'] = max(stack[-1]['child_peak'], peak)
+                if frame['started']:
+                    tracemalloc.stop()
+            record = StageRecord(name, start, wall, cpu, peak_memory, frame['items'], os.getpid(), threading.get_ident())
+            with self.lock:
+                self.records.append(record)
+
+    def totals(self):
+        with self.lock:
+            return stage_totals(list(self.records))
+
+def stage_totals(records: list):
+    """
+    Per-stage sums over all records, in order of first appearance
+
+    Returns
+    -------
+    `list` of `dict` with `name`, `calls`, `wall`, `cpu`, `peak_memory` (max) & `items`
+    """
+
+    totals = {}
+    for r in records:
+        t = totals.setdefault(r.name, {'name': r.name, 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_memory': None, 'items': None})
+        t['calls'] += 1
+        t['wall'] += r.wall
+        t['cpu'] += r.cpu
+        if r.peak_memory is not None:
+            t['peak_memory'] = max(t['peak_memory'] or 0, r.peak_memory)
+        if r.items is not None:
+            t['items'] = (t['items'] or 0) + r.items
+    return list(totals.values())
+
+def format_totals(totals: list):
+    lines = [f"{'stage':<22}{'calls':>6}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}{'items':>12}{'items/s':>12}"]
+    for t in totals:
+        peak = '-' if t['peak_memory'] is None else f"{t['peak_memory'] / 2**20:.1f}"
+        items = '-' if t['items'] is None else str(t['items'])
+        rate = '-' if t['items'] is None or t['wall'] <= 0 else f"{t['items'] / t['wall']:.0f}"
+        lines.append(f"{t['name']:<22}{t['calls']:>6}{t['wall']:>10.3f}{t['cpu']:>10.3f}{peak:>10}{items:>12}{rate:>12}")
+    return '\n'.join(lines)
+
+def to_chrome_trace(records: list):
+    """
+    Convert stage records to the Chrome trace event format (open in chrome://tracing or Perfetto)
+    """
+
+    if len(records) == 0:
+        return {'traceEvents': []}
+    t0 = min([r.start for r in records])
+    events = []
+    for r in records:
+        args = {'cpu_ms': 1e3 * r.cpu}
+        if r.peak_memory is not None:
+            args['peak_memory_mb'] = r.peak_memory / 2**20
+        if r.items is not None:
+            args['items'] = r.items
+        events.append({
+            'name': r.name,
+            'cat': 'stage',
+            'ph': 'X',
+            'ts': 1e6 * (r.start - t0),
+            'dur': 1e6 * r.wall,
+            'pid': r.pid,
+            'tid': r.tid,
+            'args': args,
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def write_chrome_trace(filename: str, records: list):
+    with open(filename, 'w') as f:
+        json.dump(to_chrome_trace(records), f)
+
+profiler = Profiler()
@@ -0,0 +1,278 @@
+"""
+Scan readers. Every reader returns `x_data`, `y_data` & `v_data` (`None` without a voltage
+channel) as arrays or lazy array-likes: anything with `len()`, indexing & slicing that only
+reads what's asked for (memmaps, HDF5 datasets, TDMS channels, `TimeAxis`). `np.asarray()`
+reads a whole channel.
+
+Pick the channels with `channels={'time': ..., 'signal': ..., 'voltage': ...}` (names, or
+column numbers for CSV/binary); whatever is left out is guessed from the channel names &
+order. Without a time channel, the time axis comes from the file's waveform properties
+(TDMS) or the `timestep` option.
+"""
+
+import numpy as np
+from os.path import splitext
+import loader
+
+ROLES = ['time', 'signal', 'voltage']
+
+class TimeAxis:
+    """
+    Evenly spaced time column `t0 + i*timestep`, computed on access instead of stored
+    """
+
+    ndim = 1
+    dtype = np.dtype(float)
+
+    def __init__(self, t0: float, timestep: float, n: int):
+        self.t0 = float(t0)
+        self.timestep = float(timestep)
+        self.n = int(n)
+
+    @property
+    def shape(self):
+        return (self.n,)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.n)
+            return self.t0 + np.arange(start, stop, step) * self.timestep
+        i = np.asarray(i)
+        if np.any((i < -self.n) | (i >= self.n)):
+            raise IndexError('time index out of range')
+        i = np.where(i < 0, i + self.n, i)
+        out = self.t0 + i * self.timestep
+        return float(out) if out.ndim == 0 else out
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+class LazyChannel:
+    """
+    Array-like over a channel that is read in pieces (`read(offset, length)`)
+    """
+
+    ndim = 1
+    dtype = np.dtype(float)
+
+    def __init__(self, read, n: int, owner=None):
+        self.read = read
+        self.n = int(n)
+        self.owner = owner # keeps the open file alive
+
+    @property
+    def shape(self):
+        return (self.n,)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.n)
+            if stop <= start:
+                return np.empty(0)
+            return np.asarray(self.read(start, stop - start), dtype=float)[::step]
+        if isinstance(i, (int, np.integer)):
+            i = i + self.n if i < 0 else i
+            if not 0 <= i < self.n:
+                raise IndexError('channel index out of range')
+            return float(self.read(i, 1)[0])
+        return np.asarray(self)[i]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+def map_channels(names: list, channels: dict = None):
+    """
+    Assign channel `names` to the time/signal/voltage roles: explicit `channels` first,
+    then names containing the role (`'time'`, `'volt'`/`'piezo'`), then the remaining
+    channels in order (time only if there are 3 or more).
+
+    Returns
+    -------
+    `dict` of role -> name (or `None`)
+    """
+
+    channels = {} if channels is None else dict(channels)
+    unknown = set(channels) - set(ROLES)
+    if unknown:
+        raise ValueError(f"Unknown channel roles: {', '.join(sorted(unknown))}")
+    for role, name in channels.items():
+        if name is not None and name not in names:
+            raise ValueError(f"No channel named {name} (found: {', '.join(map(str, names))})")
+
+    free = [n for n in names if n not in channels.values()]
+    hints = {'time': ['time'], 'voltage': ['volt', 'piezo']}
+    for role, words in hints.items():
+        if role not in channels:
+            match = [n for n in free if any([w in str(n).lower() for w in words])]
+            if match:
+                channels[role] = match[0]
+                free.remove(match[0])
+
+    if 'time' not in channels and len(free) >= 3:
+        channels['time'] = free.pop(0)
+    for role in ['signal', 'voltage']:
+        if role not in channels and free:
+            channels[role] = free.pop(0)
+    if channels.get('signal') is None:
+        raise ValueError('No signal channel found.')
+    return {role: channels.get(role) for role in ROLES}
+
+def time_axis(x_data, n: int, timestep: float = None, t0: float = 0.0):
+    if x_data is not None:
+        return x_data
+    if not timestep:
+        raise ValueError('No time channel found. Set a timestep to read this file.')
+    return TimeAxis(t0, timestep, n)
+
+# Readers
+
+def read_csv(filename: str, channels: dict = None, timestep: float = None, cache: bool = True, mmap: bool = True):
+    data = loader.load_csv(filename, cache=cache, mmap=mmap, columns=True)
+    roles = map_channels(list(range(len(data))), {'time': 0, 'signal': 1, 'voltage': 2 if len(data) > 2 else None, **(channels or {})})
+    pick = lambda role: None if roles[role] is None else data[roles[role]]
+    return time_axis(pick('time'), data.shape[1], timestep), pick('signal'), pick('voltage')
+
+def read_binary(
+    filename: str,
+    channels: dict = None,
+    timestep: float = None,
+    dtype: str = '<f8',
+    columns: int = 3,
+    offset: int = 0,
+    interleaved: bool = True
+):
+    """
+    Headerless binary: `columns` channels of `dtype` after `offset` header bytes, stored
+    row by row (`interleaved`, like the CSV) or one whole channel after the other.
+    Opened memory-mapped, so only the pages that get used are read.
+    """
+
+    data = np.memmap(filename, dtype=np.dtype(dtype), mode='r', offset=offset)
+    n = len(data) // columns
+    data = data[:n*columns]
+    data = data.reshape(n, columns).T if interleaved else data.reshape(columns, n)
+    defaults = {'time': 0, 'signal': 1, 'voltage': 2} if columns > 2 else {}
+    roles = map_channels(list(range(columns)), {**defaults, **(channels or {})})
+    pick = lambda role: None if roles[role] is None else data[roles[role]]
+    return time_axis(pick('time'), n, timestep), pick('signal'), pick('voltage')
+
+def read_hdf5(filename: str, channels: dict = None, timestep: float = None):
+    """
+    HDF5: channels are 1D datasets, named by their path in the file. Contiguous,
+    uncompressed datasets are memory-mapped; others are read on slicing (h5py).
+    """
+
+    try:
+        import h5py
+    except ImportError:
+        raise ValueError('Reading HDF5 files needs h5py (pip3 install h5py).')
+
+    f = h5py.File(filename, 'r')
+    datasets = {}
+    def visit(name, obj): # returning anything but None stops the visit
+        if isinstance(obj, h5py.Dataset) and obj.ndim == 1:
+            datasets[name] = obj
+    f.visititems(visit)
+    roles = map_channels(list(datasets), channels)
+
+    def open_channel(name):
+        if name is None:
+            return None
+        ds = datasets[name]
+        offset = ds.id.get_offset()
+        if ds.chunks is None and ds.compression is None and offset is not None:
+            return np.memmap(filename, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape)
+        return ds
+
+    x_data, y_data, v_data = [open_channel(roles[r]) for r in ROLES]
+    if x_data is None:
+        attrs = datasets[roles['signal']].attrs
+        timestep = attrs.get('timestep', attrs.get('wf_increment', timestep))
+        x_data = time_axis(None, len(y_data), timestep, attrs.get('t0', attrs.get('wf_start_offset', 0.0)))
+    return x_data, y_data, v_data
+
+def read_tdms(filename: str, channels: dict = None, timestep: float = None):
+    """
+    LabVIEW TDMS: channels are named `<group>/<channel>` (or just `<channel>` if unique).
+    Channels are read on slicing. Without a time channel, the time axis comes from the
+    signal channel's `wf_start_offset` & `wf_increment`.
+    """
+
+    try:
+        from nptdms import TdmsFile
+    except ImportError:
+        raise ValueError('Reading TDMS files needs npTDMS (pip3 install npTDMS).')
+
+    f = TdmsFile.open(filename)
+    found = {f"{g.name}/{c.name}": c for g in f.groups() for c in g.channels() if len(c) > 0}
+    short = [name.split('/', 1)[1] for name in found]
+    names = list(found)
+    if channels is not None: # allow bare channel names when they're unique
+        channels = {r: (names[short.index(n)] if n not in found and short.count(n) == 1 else n) for r, n in channels.items()}
+    roles = map_channels(names, channels)
+
+    def open_channel(name):
+        if name is None:
+            return None
+        c = found[name]
+        return LazyChannel(lambda offset, length: c.read_data(offset, length), len(c), owner=f)
+
+    x_data, y_data, v_data = [open_channel(roles[r]) for r in ROLES]
+    if x_data is None:
+        props = found[roles['signal']].properties
+        x_data = time_axis(None, len(y_data), props.get('wf_increment', timestep), props.get('wf_start_offset', 0.0))
+    return x_data, y_data, v_data
+
+READERS = {
+    '.csv': read_csv,
+    '.txt': read_csv,
+    '.bin': read_binary,
+    '.dat': read_binary,
+    '.h5': read_hdf5,
+    '.hdf5': read_hdf5,
+    '.tdms': read_tdms,
+}
+
+def register_reader(extension: str, reader):
+    """
+    Add a reader `reader(filename, channels=None, timestep=None, **options)` for files ending in `extension`
+    """
+
+    READERS[extension.lower()] = reader
+
+def reader_for(filename: str):
+    ext = splitext(filename)[1].lower()
+    if ext not in READERS:
+        raise ValueError(f"Unsupported file type {ext} (supported: {', '.join(sorted(READERS))})")
+    return READERS[ext]
+
+def load(filename: str, channels: dict = None, **options):
+    """
+    Open a scan with the reader for its extension. `options` go to the reader
+    (e.g. `timestep`, or `dtype`/`columns` for raw binary).
+    """
+
+    return reader_for(filename)(filename, channels=channels, **options)
+
+def parse_channels(specs: list):
+    """
+    `['signal=ai0', 'voltage=2']` -> `{'signal': 'ai0', 'voltage': 2}` (numbers pick CSV/binary columns)
+    """
+
+    channels = {}
+    for spec in specs:
+        role, _, name = spec.partition('=')
+        channels[role.strip()] = int(name) if name.strip().isdigit() else name.strip()
+    return channels
+
+def file_filter():
+    # For QFileDialog
+    return f"Scans ({' '.join(['*' + ext for ext in READERS])});;All files (*)"
@@ -0,0 +1,159 @@
+import os
+import json
+import shutil
+import numpy as np
+from os.path import join as path_join, exists
+import loader
+from peaks import PeakArray, FitArray, as_peak_array, as_fit_array
+
+# Stages in pipeline order & the `Session` attributes each one adds
+STAGES = ['correlate', 'add', 'isolate', 'fit']
+STAGE_RESULTS = {
+    'correlate': ['groups_correlated', 'correlation_heights'],
+    'add': ['added_peaks'],
+    'isolate': ['added_peaks', 'peak_indices', 'isolated_peaks'],
+    'fit': ['timestep', 'fit_equations', 'overlayed_peak_indices', 'shift_over_fit', 'residuals', 'chi2_red', 'r_squared', 'time_constants'],
+}
+
+# Encoding (everything ends up as plain .npy arrays, nothing pickled)
+
+def flatten_rows(rows: list):
+    # List of rows (groups) of per-tooth values -> flat list & row lengths
+    return [v for row in rows for v in row], np.array([len(row) for row in rows], dtype=np.int64)
+
+def split_rows(flat, row_lengths):
+    offsets = np.concatenate([[0], np.cumsum(row_lengths)]).astype(int)
+    return [flat[offsets[i]:offsets[i+1]] for i in range(len(row_lengths))]
+
+def encode(name: str, value):
+    """
+    Turn a `Session` attribute into `{file suffix: array}` (one `.npy` file each)
+    """
+
+    if name == 'isolated_peaks': # peaks of different length, NaN-padded
+        value = as_peak_array(value)
+        padded, _, row_lengths = value.flat()
+        return {'': padded, '.lengths': value.lengths.ravel(), '.rows': np.array(row_lengths, dtype=np.int64)}
+    if name == 'fit_equations':
+        value = as_fit_array(value)
+        row_lengths = np.full(value.n_groups, value.n_teeth, dtype=np.int64)
+        return {'.popt': value.popt.reshape(-1, 4), '.pcov': value.pcov.reshape(-1, 4, 4), '.rows': row_lengths}
+    if name in ['overlayed_peak_indices', 'time_constants']:
+        flat, row_lengths = flatten_rows(value)
+        return {'': np.array(flat), '.rows': row_lengths}
+    return {'': np.asarray(value)}
+
+def decode(name: str, arrays: dict):
+    """
+    Inverse of `encode()`
+    """
+
+    if name == 'isolated_peaks':
+        shape = (len(arrays['.rows']), int(arrays['.rows'].max(initial=0)))
+        return PeakArray(arrays[''].reshape(shape + arrays[''].shape[1:]), arrays['.lengths'].reshape(shape))
+    if name == 'fit_equations':
+        shape = (len(arrays['.rows']), int(arrays['.rows'].max(initial=0)))
+        return FitArray(arrays['.popt'].reshape(shape + (4,)), arrays['.pcov'].reshape(shape + (4, 4)))
+    if name == 'time_constants':
+        return arrays[''].reshape(len(arrays['.rows']), int(arrays['.rows'].max(initial=0)))
+    if name == 'overlayed_peak_indices':
+        return [row.tolist() for row in split_rows(arrays[''], arrays['.rows'])]
+    value = arrays['']
+    return value.item() if value.ndim == 0 else value
+
+SUFFIXES = {
+    'isolated_peaks': ['', '.lengths', '.rows'],
+    'fit_equations': ['.popt', '.pcov', '.rows'],
+    'overlayed_peak_indices': ['', '.rows'],
+    'time_constants': ['', '.rows'],
+}
+
+class ProjectStore:
+    """
+    On-disk analysis state of one scan, in `db/<content key>/`:
+
+    - `inputs.json`: the GUI inputs (`spin_*`, `check_*`, `combo_*`) as last set
+    - `results.json`: the last stage that was run & the parameters it ran with
+    - `<attribute>*.npy`: that stage's outputs (and everything upstream of it) as plain arrays
+
+    Keyed by `loader.content_key()`, so a renamed or copied scan finds its analysis again.
+    """
+
+    def __init__(self, key: str, root: str = None):
+        self.key = key
+        root = loader.default_cache_dir() if root is None else root
+        self.path = path_join(root, key)
+
+    @classmethod
+    def for_file(cls, filename: str, root: str = None):
+        return cls(loader.content_key(filename), root)
+
+    def file(self, name: str):
+        return path_join(self.path, name)
+
+    def write_json(self, name: str, value: dict):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.file(name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(value, f, indent=2)
+        os.replace(tmp, self.file(name))
+
+    def read_json(self, name: str):
+        if not exists(self.file(name)):
+            return None
+        with open(self.file(name), 'r') as f:
+            return json.load(f)
+
+    # Inputs
+
+    def save_inputs(self, params: dict):
+        self.write_json('inputs.json', params)
+
+    def load_inputs(self):
+        return self.read_json('inputs.json')
+
+    # Results
+
+    def save_results(self, stage: str, params: dict, results: dict):
+        """
+        Store the outputs of `stage` & every stage upstream of it (`results` keyed like the
+        `Session` attributes), replacing whatever was stored before.
+        """
+
+        names = list(dict.fromkeys([n for s in STAGES[:STAGES.index(stage)+1] for n in STAGE_RESULTS[s]]))
+
+        self.clear_results()
+        os.makedirs(self.path, exist_ok=True)
+        for name in names:
+            if results.get(name) is None:
+                continue
+            for suffix, array in encode(name, results[name]).items():
+                np.save(self.file(f"{name}{suffix}.npy"), array, allow_pickle=False)
+        self.write_json('results.json', {'stage': stage, 'params': params, 'names': [n for n in names if results.get(n) is not None]})
+
+    def load_results(self):
+        """
+        Returns
+        -------
+        The last stage stored, the parameters it ran with & its outputs keyed like the
+        `Session` attributes (`None, None, {}` if nothing is stored)
+        """
+
+        meta = self.read_json('results.json')
+        if meta is None:
+            return None, None, {}
+        results = {}
+        for name in meta['names']:
+            arrays = {s: np.load(self.file(f"{name}{s}.npy"), allow_pickle=False) for s in SUFFIXES.get(name, [''])}
+            results[name] = decode(name, arrays)
+        return meta['stage'], meta['params'], results
+
+    def clear_results(self):
+        if not exists(self.path):
+            return
+        for f in os.listdir(self.path):
+            if f.endswith('.npy') or f == 'results.json':
+                os.remove(self.file(f))
+
+    def delete(self):
+        shutil.rmtree(self.path, ignore_errors=True)
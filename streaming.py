@@ -0,0 +1,436 @@
+"""
+Online analysis: feed a scan in chunks as it is acquired & get tau estimates per group
+as soon as the group is complete.
+
+Usage: python streaming.py params.json --tail scan.csv
+       acquisition | python streaming.py params.json --stdin --columns 3
+       python streaming.py params.json --listen 127.0.0.1:5000
+"""
+
+import sys
+import time
+import socket
+import argparse
+import numpy as np
+from collections import deque
+from dataclasses import dataclass
+from scipy.signal import find_peaks
+import crds_calc
+import kernels
+import pipeline
+
+class SampleBuffer:
+    """
+    Growable window of the most recent samples of one or more channels, addressed by
+    absolute sample index. Appending is amortized O(chunk); `drop_before()` forgets old samples.
+    """
+
+    def __init__(self, channels: int = 1, capacity: int = 1 << 16):
+        self.data = np.empty((channels, capacity))
+        self.start = 0 # absolute index of the first stored sample
+        self.offset = 0 # where that sample sits in `data`
+        self.size = 0
+
+    @property
+    def end(self):
+        return self.start + self.size
+
+    def append(self, *chunks):
+        n = len(chunks[0])
+        if self.offset + self.size + n > self.data.shape[1]:
+            live = self.data[:, self.offset:self.offset+self.size]
+            if self.size + n > self.data.shape[1] // 2:
+                grown = np.empty((self.data.shape[0], max(2*(self.size + n), self.data.shape[1])))
+                grown[:, :self.size] = live
+                self.data = grown
+            else:
+                self.data[:, :self.size] = live.copy()
+            self.offset = 0
+        for c, chunk in enumerate(chunks):
+            self.data[c, self.offset+self.size:self.offset+self.size+n] = chunk
+        self.size += n
+
+    def drop_before(self, index: int):
+        n = min(max(index - self.start, 0), self.size)
+        self.start += n
+        self.offset += n
+        self.size -= n
+
+    def get(self, channel: int, lo: int = None, hi: int = None):
+        # View of samples [lo, hi) (absolute indices) of one channel
+        lo = self.start if lo is None else max(lo, self.start)
+        hi = self.end if hi is None else min(hi, self.end)
+        return self.data[channel, self.offset+lo-self.start:self.offset+hi-self.start]
+
+class SpacedGrouper:
+    """
+    Streaming SpacedGroups: peaks of the moving-averaged signal are only accepted once
+    `group_len` worth of samples follow them (so their prominence has settled), and a group
+    is emitted once the data covers `group_len` on both sides of its first peak.
+    """
+
+    def __init__(self, params: dict, timestep: float):
+        self.timestep = timestep
+        self.group_len = params['spin_group_len']
+        self.height = params['spin_min_peakheight']
+        self.prominence = params['spin_min_peakprominence']
+        self.sma_denom = int(params['spin_moving_average_denom'])
+        self.mirrored = bool(params['check_skip_groups'])
+        self.half_len = int(self.group_len / timestep)
+        if self.half_len < 1:
+            raise ValueError('Group length is shorter than one sample.')
+        self.settle = self.half_len
+        self.lookback = 2*self.half_len + self.sma_denom
+        self.buffer = SampleBuffer(1)
+        self.frontier = 0 # peaks before this are final
+        self.last_peak = None
+        self.n_starts = 0
+        self.pending = deque() # centers of groups waiting for data
+
+    def push(self, y: np.array, v: np.array = None):
+        buf = self.buffer
+        buf.append(y)
+        frontier = buf.end - self.settle
+        if frontier > self.frontier:
+            lo = max(buf.start, self.frontier - self.lookback)
+            smoothed = kernels.moving_average(buf.get(0, lo), self.sma_denom)
+            peaks = find_peaks(smoothed, height=self.height, prominence=self.prominence)[0] + lo
+            peaks = peaks[(peaks >= self.frontier) & (peaks < frontier)]
+            if self.last_peak is not None:
+                peaks = peaks[peaks > self.last_peak]
+            for p in peaks:
+                if self.last_peak is None or (p - self.last_peak) * self.timestep >= self.group_len:
+                    if not self.mirrored or self.n_starts % 2 == 0:
+                        self.pending.append(p)
+                    self.n_starts += 1
+                self.last_peak = p
+            self.frontier = frontier
+
+        groups = []
+        while self.pending and self.pending[0] + self.half_len <= buf.end:
+            center = self.pending.popleft()
+            if center - self.half_len >= 0: # ran off the start of the stream
+                groups.append(buf.get(0, center - self.half_len, center + self.half_len).copy())
+
+        keep = self.frontier - self.lookback
+        if self.pending:
+            keep = min(keep, self.pending[0] - self.half_len)
+        buf.drop_before(keep)
+        return groups
+
+class VThresholdGrouper:
+    """
+    Streaming VThreshold: a group is emitted as soon as its sweep has crossed both thresholds.
+    """
+
+    def __init__(self, params: dict):
+        self.vmin = params['spin_min_voltage']
+        self.vmax = params['spin_max_voltage']
+        self.mirrored = bool(params['check_skip_groups'])
+        self.direction = None
+        self.buffer = SampleBuffer(2)
+
+    def push(self, y: np.array, v: np.array = None):
+        if v is None:
+            raise ValueError('No voltage column detected. VThreshold algo will not work.')
+        buf = self.buffer
+        buf.append(y, v)
+        v_buf = buf.get(1)
+        starts, ends, direction = crds_calc.sweep_bounds(v_buf, self.vmin, self.vmax)
+
+        groups = []
+        for s, e, d in zip(starts, ends, direction):
+            if self.direction is None:
+                self.direction = d
+            if not self.mirrored or d == self.direction:
+                groups.append(buf.get(0, buf.start + s, buf.start + e).copy())
+
+        if len(ends) > 0:
+            buf.drop_before(buf.start + ends[-1]) # sample on the far side starts the next sweep
+        else:
+            out = np.flatnonzero((v_buf > self.vmax) | (v_buf < self.vmin))
+            if len(out) > 0:
+                buf.drop_before(buf.start + out[-1])
+        return groups
+
+class TauHistogram:
+    """
+    Per-tooth tau histograms with `bins` fixed bins between `lo` & `hi` (bounded memory no
+    matter how many groups), plus running mean & StD (Welford). Values outside the bins are
+    counted as under/overflow.
+    """
+
+    def __init__(self, lo: np.array, hi: np.array, bins: int = 50):
+        self.lo = np.asarray(lo, dtype=float)
+        self.hi = np.asarray(hi, dtype=float)
+        teeth = len(self.lo)
+        self.counts = np.zeros((teeth, bins), dtype=np.int64)
+        self.underflow = np.zeros(teeth, dtype=np.int64)
+        self.overflow = np.zeros(teeth, dtype=np.int64)
+        self.n = np.zeros(teeth, dtype=np.int64)
+        self.mean = np.zeros(teeth)
+        self.m2 = np.zeros(teeth)
+
+    @classmethod
+    def around(cls, tau: np.array, bins: int = 50, span: float = 0.5):
+        # Bins covering `tau` * (1 -/+ `span`) for every tooth (`tau` from the reference groups)
+        return cls(np.nanmin(tau, axis=0) * (1 - span), np.nanmax(tau, axis=0) * (1 + span), bins)
+
+    @property
+    def edges(self):
+        return np.linspace(self.lo, self.hi, self.counts.shape[1]+1, axis=1)
+
+    def add(self, tau: np.array):
+        teeth = np.flatnonzero(np.isfinite(tau))
+        t = tau[teeth]
+        n_bins = self.counts.shape[1]
+        width = np.maximum(self.hi[teeth] - self.lo[teeth], np.finfo(float).tiny)
+        b = np.floor((t - self.lo[teeth]) / width * n_bins).astype(int)
+        b[t == self.hi[teeth]] = n_bins - 1 # right edge is inclusive
+        inside = (b >= 0) & (b < n_bins)
+        self.counts[teeth[inside], b[inside]] += 1
+        self.underflow[teeth[b < 0]] += 1
+        self.overflow[teeth[b >= n_bins]] += 1
+
+        self.n[teeth] += 1
+        delta = t - self.mean[teeth]
+        self.mean[teeth] += delta / self.n[teeth]
+        self.m2[teeth] += delta * (t - self.mean[teeth])
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / np.maximum(self.n, 1))
+
+@dataclass
+class GroupResult:
+    index: int # group number since the start of the stream
+    lag: float # shift onto the running reference (ticks)
+    height: float # normalized correlation peak height
+    tau: np.array # per tooth, in time units
+    fit_equations: list
+
+class StreamingAnalyzer:
+    """
+    Streaming version of the pipeline. `feed()` chunks of `(t, signal, voltage)`; every group
+    that completes is aligned to a running reference (the sum of all aligned groups so far,
+    noise-weighted with weighted `combo_stacking`),
+    cut into peaks, fitted & added to the per-tooth tau histograms.
+
+    Peak positions come from the sum of the first `reference_groups` groups (just like
+    isolation in the batch pipeline over that many groups); until then, groups are held back.
+    Memory stays bounded: only a few groups' worth of samples, the reference, the histograms
+    & the last `max_recent` results are kept.
+    """
+
+    def __init__(self, params: dict, reference_groups: int = 10, bins: int = 50, span: float = 0.5, max_recent: int = 100):
+        self.params = params
+        self.reference_groups = max(int(reference_groups), 1)
+        self.bins = bins
+        self.span = span
+        self.timestep = params['spin_timestep'] or None
+        self.grouper = None
+        self.stacking = crds_calc.STACKING[params.get('combo_stacking', 0)]
+        if self.stacking == 'median':
+            raise ValueError('Median stacking needs the whole scan; use sum or weighted stacking for live analysis.')
+        self.reference = crds_calc.GroupAccumulator() # running sum of aligned groups
+        self.held = [] # aligned groups waiting for the peak positions
+        self.peak_indices = None
+        self.histogram = None
+        self.recent = deque(maxlen=max_recent)
+        self.n_groups = 0
+
+    def start(self, t: np.array):
+        if self.timestep is None:
+            if len(t) < 2:
+                return False
+            self.timestep = float(t[1] - t[0])
+        if self.params['combo_grouping_algo'] == 0:
+            self.grouper = VThresholdGrouper(self.params)
+        else:
+            self.grouper = SpacedGrouper(self.params, self.timestep)
+        return True
+
+    def feed(self, t: np.array, y: np.array, v: np.array = None):
+        """
+        Returns
+        -------
+        `list` of `GroupResult` for the groups completed (and fitted) by this chunk
+        """
+
+        if self.grouper is None and not self.start(t):
+            return []
+        results = []
+        for g in self.grouper.push(np.asarray(y, dtype=float), None if v is None else np.asarray(v, dtype=float)):
+            results.extend(self.add_group(g))
+        self.recent.extend(results)
+        return results
+
+    def align(self, g: np.array):
+        # Shift `g` onto the reference (zero-filled to the reference length)
+        if self.reference.total is None:
+            return g.copy(), 0.0, 1.0
+        _, lags, heights = crds_calc.align_groups([self.reference.total, g])
+        lag = int(lags[1])
+        aligned = np.zeros(len(self.reference.total))
+        src = np.arange(len(aligned)) - lag
+        ok = (src >= 0) & (src < len(g))
+        aligned[ok] = g[src[ok]]
+        return aligned, lag, heights[1]
+
+    def add_group(self, g: np.array):
+        aligned, lag, height = self.align(g)
+        weight = crds_calc.noise_weights(aligned[None, :])[0] if self.stacking == 'weighted' else 1.0
+        self.reference.add(aligned, weight)
+        index = self.n_groups
+        self.n_groups += 1
+
+        if self.peak_indices is None:
+            self.held.append((index, aligned, lag, height))
+            if len(self.held) < self.reference_groups:
+                return []
+            self.find_peaks()
+            held, self.held = self.held, []
+            return self.fit(held)
+        return self.fit([(index, aligned, lag, height)])
+
+    def find_peaks(self):
+        params = self.params
+        peak_width = params['spin_peak_overlap']
+        reference_av = kernels.moving_average(self.reference.added_peaks, params['spin_moving_average_denom'])
+        self.peak_indices = find_peaks(
+            reference_av,
+            height=params['spin_min_peak_height_added'],
+            prominence=params['spin_peak_prominence_added'],
+            distance=peak_width/2
+        )[0]
+        if len(self.peak_indices) == 0:
+            raise ValueError('No peaks found in the reference groups. Try adjusting peak isolation parameters.')
+
+    def fit(self, groups: list):
+        params = self.params
+        delta = params['spin_peak_overlap']/2
+        shift_over = params['spin_shift_over']
+        isolated_peaks = [
+            [aligned[max(int(i-delta+shift_over), 0):int(i+delta+shift_over)] for i in self.peak_indices]
+            for _, aligned, _, _ in groups
+        ]
+        fit_equations, _ = pipeline.stage_fit(isolated_peaks, self.peak_indices, params)
+        tau = np.array(crds_calc.get_time_constants(fit_equations, self.timestep))
+
+        if self.histogram is None:
+            self.histogram = TauHistogram.around(tau, self.bins, self.span)
+        results = []
+        for (index, _, lag, height), row, eq in zip(groups, tau, fit_equations):
+            self.histogram.add(row)
+            results.append(GroupResult(index, lag, height, row, eq))
+        return results
+
+    @property
+    def added_peaks(self):
+        return self.reference.added_peaks
+
+# Sources (local stand-ins for the instrument)
+
+def tail_csv(filename: str, chunk_rows: int = 10000, poll: float = 0.2, idle_timeout: float = None):
+    """
+    Follow a Zurich CSV that is still being written (like `tail -f`), yielding `(t, signal, voltage)`
+    chunks of complete lines. Stops once nothing new arrived for `idle_timeout` seconds (never if `None`).
+    """
+
+    header_seen = False
+    partial = ''
+    idle_since = time.monotonic()
+    with open(filename, 'r') as f:
+        while True:
+            text = f.read(1 << 20)
+            if not text:
+                if idle_timeout is not None and time.monotonic() - idle_since > idle_timeout:
+                    return
+                time.sleep(poll)
+                continue
+            idle_since = time.monotonic()
+            lines = (partial + text).split('\n')
+            partial = lines.pop() # incomplete last line
+            rows = []
+            for line in lines:
+                line = line.strip()
+                if not line or line.startswith('%'):
+                    continue
+                if not header_seen:
+                    header_seen = True
+                    continue
+                rows.append(line)
+            for i in range(0, len(rows), chunk_rows):
+                data = np.loadtxt(rows[i:i+chunk_rows], delimiter=';', ndmin=2)
+                yield data[:, 0], data[:, 1], data[:, 2] if data.shape[1] > 2 else None
+
+def read_stream(stream, columns: int = 3, dtype: str = '<f8', chunk_rows: int = 10000):
+    """
+    Read interleaved binary rows of `<time>, <signal>, <voltage (optional)>` from a pipe,
+    socket (`sock.makefile('rb')`) or file, yielding `(t, signal, voltage)` chunks until EOF.
+    """
+
+    dtype = np.dtype(dtype)
+    row_bytes = columns * dtype.itemsize
+    leftover = b''
+    while True:
+        block = stream.read(chunk_rows * row_bytes)
+        if not block:
+            return
+        block = leftover + block
+        n = len(block) // row_bytes
+        leftover = block[n*row_bytes:]
+        if n == 0:
+            continue
+        data = np.frombuffer(block[:n*row_bytes], dtype=dtype).reshape(n, columns).astype(float)
+        yield data[:, 0], data[:, 1], data[:, 2] if columns > 2 else None
+
+def listen(address: str):
+    # Accept one connection on `host:port` & return it as a binary stream
+    host, _, port = address.rpartition(':')
+    server = socket.create_server((host or '127.0.0.1', int(port)))
+    conn, _ = server.accept()
+    server.close()
+    return conn.makefile('rb')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze a CRDS scan while it is being acquired.')
+    parser.add_argument('params', help='JSON parameter file (keys named like the GUI inputs)')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--tail', metavar='CSV', help='Follow a CSV file that is still being written')
+    source.add_argument('--stdin', action='store_true', help='Read binary rows from stdin')
+    source.add_argument('--listen', metavar='HOST:PORT', help='Read binary rows from one TCP connection')
+    parser.add_argument('--columns', type=int, default=3, help='Columns per binary row (time, signal[, voltage])')
+    parser.add_argument('--dtype', default='<f8', help='Binary sample type (NumPy dtype)')
+    parser.add_argument('--reference-groups', type=int, default=10, help='Groups summed to find the peak positions')
+    parser.add_argument('--idle-timeout', type=float, default=None, help='Stop tailing after this many seconds without new data')
+    args = parser.parse_args(argv)
+
+    params = pipeline.load_params(args.params)
+    analyzer = StreamingAnalyzer(params, reference_groups=args.reference_groups)
+    if args.tail is not None:
+        chunks = tail_csv(args.tail, idle_timeout=args.idle_timeout)
+    elif args.stdin:
+        chunks = read_stream(sys.stdin.buffer, args.columns, args.dtype)
+    else:
+        chunks = read_stream(listen(args.listen), args.columns, args.dtype)
+
+    try:
+        for t, y, v in chunks:
+            for r in analyzer.feed(t, y, v):
+                print(f"group {r.index}: lag {r.lag:.0f}, tau {' '.join([f'{x:.4g}' for x in r.tau])}", flush=True)
+    except KeyboardInterrupt:
+        pass
+
+    h = analyzer.histogram
+    if h is None:
+        print('Not enough groups for tau estimates.')
+        return 1
+    print()
+    print(f"{analyzer.n_groups} groups")
+    for i in range(len(h.n)):
+        print(f"Tooth {i+1}: tau {h.mean[i]:.6g} +/- {h.std[i]:.3g} (n={h.n[i]})")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
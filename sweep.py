@@ -0,0 +1,279 @@
+"""
+Parameter sweeps: run the pipeline on one scan for a grid (or random sample) of settings
+& rank them on how consistent the grouping is and how good the fits are.
+
+Usage: python sweep.py params.json scan.csv --vary spin_min_peakprominence=0.0006,0.0012,0.0024 \
+           --vary spin_group_len=0.0004:0.0008:5 -j 4 --top 20 -o sweep.csv
+
+Without `--vary`, the four grouping/isolation inputs that usually need tuning are swept
+around their values in the parameter file (see `default_space`).
+"""
+
+import sys
+import json
+import warnings
+import argparse
+import itertools
+import numpy as np
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from pandas import DataFrame
+import kernels
+import pipeline
+import readers
+
+# Inputs that are linked in the GUI (advanced peak detection mirrors the grouping inputs)
+LINKED_PARAMS = {
+    'spin_min_peakheight': 'spin_min_peakheight_2',
+    'spin_min_peakprominence': 'spin_min_peakprominence_2',
+    'spin_moving_average_denom': 'spin_moving_average_denom_2',
+}
+
+def default_space(params: dict):
+    """
+    Values to try for the prominence, group length, moving average & peak overlap inputs,
+    spread around their current values in `params`
+    """
+
+    return {
+        'spin_min_peakprominence': [params['spin_min_peakprominence'] * f for f in [0.5, 0.75, 1, 1.5, 2]],
+        'spin_group_len': [params['spin_group_len'] * f for f in [0.75, 1, 1.25]],
+        'spin_moving_average_denom': sorted(set([max(int(round(params['spin_moving_average_denom'] * f)), 1) for f in [0.5, 1, 2]])),
+        'spin_peak_overlap': [int(round(params['spin_peak_overlap'] * f)) for f in [0.75, 1, 1.25]],
+    }
+
+def grid(space: dict):
+    """
+    Every combination of the values in `space` (name -> list of values)
+    """
+
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[n] for n in names])]
+
+def sample(space: dict, n: int, seed: int = 0):
+    """
+    `n` random combinations, each value drawn uniformly between the smallest & largest value
+    listed for it in `space` (rounded for integer inputs)
+    """
+
+    rng = np.random.default_rng(seed)
+    combos = [{} for _ in range(n)]
+    for name, values in space.items():
+        lo, hi = min(values), max(values)
+        drawn = rng.uniform(lo, hi, n)
+        if all([isinstance(v, (int, np.integer)) for v in values]):
+            drawn = np.round(drawn).astype(int)
+        for combo, v in zip(combos, drawn.tolist()):
+            combo[name] = v
+    return combos
+
+def parse_vary(spec: str, params: dict):
+    """
+    `'name=v1,v2,v3'` or `'name=lo:hi:n'` (n evenly spaced values) -> `(name, values)`.
+    Values are ints for inputs whose value in `params` is an int.
+    """
+
+    name, _, values = spec.partition('=')
+    name = name.strip()
+    if name not in params:
+        raise ValueError(f"Unknown parameter {name}")
+    if ':' in values:
+        lo, hi, n = values.split(':')
+        values = np.linspace(float(lo), float(hi), int(n)).tolist()
+    else:
+        values = [float(v) for v in values.split(',')]
+    if isinstance(params[name], int) and not isinstance(params[name], bool):
+        values = sorted(set([int(round(v)) for v in values]))
+    return name, values
+
+def combo_params(base: dict, combo: dict):
+    params = dict(base, **combo)
+    for name, linked in LINKED_PARAMS.items():
+        if name in combo:
+            params[linked] = combo[name]
+    return params
+
+# Workers: every process attaches to the scan in shared memory once & keeps its own stage
+# cache, so combinations that share grouping settings (or just the moving average) reuse
+# the smoothed signal, groups & alignment.
+
+_worker = {}
+
+def _init_worker(shm_name: str, shape: tuple, has_voltage: bool, key: str, cache_bytes: int, backend: str):
+    kernels.set_backend(backend)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    data = np.ndarray(shape, dtype=float, buffer=shm.buf)
+    analysis = pipeline.Pipeline(pipeline.StageCache(cache_bytes))
+    analysis.set_data(data[0], data[1], data[2] if has_voltage else None, key=key)
+    _worker.update({'shm': shm, 'analysis': analysis}) # keep the mapping alive
+
+def evaluate(analysis: pipeline.Pipeline, params: dict, timestep: float, fit_method: str = 'batch'):
+    """
+    Run one combination up to the tau statistics
+
+    Returns
+    -------
+    `dict` of metrics: group & tooth counts, fraction of fits the quality gate accepts, median R²,
+    median relative tau scatter over the teeth (outliers rejected) & the error message if it failed (empty otherwise)
+    """
+
+    row = {'groups': 0, 'teeth': 0, 'accepted': 0.0, 'r_squared': np.nan, 'tau_scatter': np.nan, 'error': ''}
+    try:
+        params = dict(params, check_quality_gate=True)
+        _, _, r_squared = analysis.residuals(params, fit_method)
+        time_constants = analysis.tau(params, timestep, fit_method)
+        quality = analysis.gate(params, fit_method)
+        stats = analysis.stats(params, timestep, fit_method)
+        row['groups'], row['teeth'] = time_constants.shape
+        row['accepted'] = float(quality['accepted'].mean()) if quality['accepted'].size else 0.0
+        with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+            warnings.simplefilter('ignore', RuntimeWarning) # teeth without an accepted fit
+            row['r_squared'] = float(np.nanmedian(np.where(quality['accepted'], r_squared, np.nan))) if row['accepted'] > 0 else np.nan
+            row['tau_scatter'] = float(np.nanmedian(stats['clipped_std'] / stats['clipped_mean'])) if row['accepted'] > 0 else np.nan
+    except Exception as e: # settings that find no groups/peaks just score 0
+        row['error'] = f"{type(e).__name__}: {e}"
+    return row
+
+def _evaluate_task(combos: list, base: dict, timestep: float, fit_method: str):
+    analysis = _worker['analysis']
+    return [evaluate(analysis, combo_params(base, combo), timestep, fit_method) for combo in combos]
+
+def score(rows: list):
+    """
+    Rank combinations. Group count consistency is the share of all combinations that found the
+    same number of groups & teeth (a stable plateau, not a lucky setting); it is multiplied by the
+    accepted fraction & median R² of the fits. Ties go to the lower tau scatter.
+
+    Returns
+    -------
+    `DataFrame`, best first
+    """
+
+    df = DataFrame(rows)
+    df['error'] = df['error'].fillna('')
+    ok = (df['error'] == '') & (df['groups'] > 0) & (df['teeth'] > 0)
+    counts = Counter(zip(df.loc[ok, 'groups'], df.loc[ok, 'teeth']))
+    df['consistency'] = [counts[(g, t)] / max(ok.sum(), 1) if k else 0.0 for g, t, k in zip(df['groups'], df['teeth'], ok)]
+    df['score'] = df['consistency'] * df['accepted'] * df['r_squared'].clip(lower=0).fillna(0)
+    df = df.sort_values(['score', 'tau_scatter'], ascending=[False, True], na_position='last', kind='stable')
+    df.insert(0, 'rank', np.arange(1, len(df)+1))
+    return df.reset_index(drop=True)
+
+def sweep(
+    x_data,
+    y_data,
+    v_data,
+    params: dict,
+    combos: list,
+    workers: int = 1,
+    fit_method: str = 'batch',
+    cache_bytes: int = 1 << 28,
+    progress=None
+):
+    """
+    Evaluate every combination in `combos` (dicts of inputs to change in `params`) on one scan.
+
+    Combinations with the same grouping settings go to the same task (so groups & alignment
+    are computed once per task), tasks are ordered by moving average size (so each worker
+    mostly reuses its smoothed signal) and run on `workers` processes. The scan is shared
+    with the workers through shared memory, not copied per task.
+    `progress(done, total)` is called as tasks finish.
+
+    Returns
+    -------
+    Ranked `DataFrame` (see `score`): one row per combination, with the swept inputs & metrics
+    """
+
+    timestep = pipeline.get_timestep(x_data, params)
+    names = list(dict.fromkeys([n for c in combos for n in c]))
+
+    # Tasks: combinations sharing all inputs the group stage depends on
+    def group_inputs(combo):
+        p = combo_params(params, combo)
+        return tuple([p[n] for n in pipeline.GROUP_COMMON_PARAMS + pipeline.GROUP_PARAMS[p['combo_grouping_algo']]])
+    tasks = {}
+    for i, combo in enumerate(combos):
+        tasks.setdefault(group_inputs(combo), []).append(i)
+    order = sorted(tasks, key=lambda k: combo_params(params, combos[tasks[k][0]])['spin_moving_average_denom'])
+    tasks = [tasks[k] for k in order]
+
+    data = [np.asarray(x_data, dtype=float), np.asarray(y_data, dtype=float)] + ([] if v_data is None else [np.asarray(v_data, dtype=float)])
+    key = pipeline.hash_arrays(*data)
+    rows = [None] * len(combos)
+
+    def collect(task, results):
+        for i, row in zip(task, results):
+            rows[i] = dict({n: combos[i].get(n, params.get(n)) for n in names}, **row)
+
+    if workers is None or workers <= 1:
+        analysis = pipeline.Pipeline(pipeline.StageCache(cache_bytes))
+        analysis.set_data(*data, *([None] if v_data is None else []), key=key)
+        for done, task in enumerate(tasks):
+            collect(task, [evaluate(analysis, combo_params(params, combos[i]), timestep, fit_method) for i in task])
+            if progress is not None:
+                progress(done+1, len(tasks))
+        return score(rows)
+
+    stacked = np.stack(data)
+    shm = shared_memory.SharedMemory(create=True, size=stacked.nbytes)
+    try:
+        np.ndarray(stacked.shape, dtype=float, buffer=shm.buf)[:] = stacked
+        del stacked
+        init_args = (shm.name, (len(data), len(data[0])), v_data is not None, key, cache_bytes, kernels.backend)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=init_args) as executor:
+            futures = [executor.submit(_evaluate_task, [combos[i] for i in task], params, timestep, fit_method) for task in tasks]
+            try:
+                for done, (task, f) in enumerate(zip(tasks, futures)):
+                    collect(task, f.result())
+                    if progress is not None:
+                        progress(done+1, len(tasks))
+            except BaseException:
+                for f in futures:
+                    f.cancel()
+                raise
+    finally:
+        shm.close()
+        shm.unlink()
+    return score(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweep grouping & isolation inputs over one scan and rank the settings.')
+    parser.add_argument('params', help='JSON parameter file with the base settings (keys named like the GUI inputs)')
+    parser.add_argument('input', help='Scan file (any format the GUI opens)')
+    parser.add_argument('--vary', action='append', default=[], metavar='NAME=V1,V2,... | NAME=LO:HI:N', help='Values to try for an input (repeat for more inputs)')
+    parser.add_argument('--random', type=int, default=None, metavar='N', help='Try N random combinations within the ranges instead of the full grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--fit-method', choices=['batch', 'curve_fit', 'quick'], default='batch')
+    parser.add_argument('--channel', action='append', default=[], metavar='ROLE=NAME', help='Map a channel to time/signal/voltage, e.g. --channel signal=ai0')
+    parser.add_argument('--top', type=int, default=20, help='Rows of the ranked table to print')
+    parser.add_argument('-o', '--out', metavar='CSV', help='Write the whole ranked table')
+    parser.add_argument('--best', metavar='JSON', help='Write the base parameters with the best combination applied')
+    parser.add_argument('--backend', choices=kernels.BACKENDS, default=kernels.backend, help='Kernel backend (numba if installed)')
+    args = parser.parse_args(argv)
+
+    params = pipeline.load_params(args.params)
+    kernels.set_backend(args.backend)
+    space = dict([parse_vary(spec, params) for spec in args.vary]) if args.vary else default_space(params)
+    combos = sample(space, args.random, args.seed) if args.random else grid(space)
+
+    x_data, y_data, v_data = readers.load(args.input, readers.parse_channels(args.channel), timestep=params['spin_timestep'])
+    print(f"Sweeping {len(combos)} combinations of {', '.join(space)}")
+    tty = sys.stderr.isatty() # a redirected log gets no progress line to run into the warnings
+    progress = (lambda done, total: print(f"\r{done}/{total} tasks", end='', file=sys.stderr, flush=True)) if tty else None
+    ranked = sweep(x_data, y_data, v_data, params, combos, workers=args.jobs, fit_method=args.fit_method, progress=progress)
+    if tty:
+        print(file=sys.stderr)
+
+    print(ranked.head(args.top).to_string(index=False, float_format=lambda v: f"{v:.4g}"))
+    if args.out is not None:
+        ranked.to_csv(args.out, index=False)
+    if args.best is not None and len(ranked) > 0 and ranked['score'].iloc[0] > 0:
+        best = combo_params(params, {n: ranked[n].iloc[0].item() for n in space})
+        with open(args.best, 'w') as f:
+            json.dump(best, f, indent=2)
+    return 0 if len(ranked) > 0 and ranked['score'].iloc[0] > 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import numpy as np
+import pipeline
+
+def make_scan(
+    n_groups: int = 20,
+    teeth: int = 8,
+    samples_per_group: int = 50000,
+    tau: np.array = None,
+    amplitude: float = 0.05,
+    rise: int = 50,
+    noise: float = 0.0005,
+    jitter: int = 20,
+    mirrored: bool = True,
+    voltage: bool = True,
+    timestep: float = 1.78e-8,
+    seed: int = 0
+):
+    """
+    Synthetic CRDS comb scan. The piezo voltage sweeps 0-10 mV (triangle if `mirrored`,
+    sawtooth otherwise) and every sweep passes `teeth` comb teeth, each giving a linear
+    build-up over `rise` ticks followed by a `y = a*e^(-t/tau)` ringdown with a known tau.
+    Mirrored (down) sweeps pass the teeth in reverse order. Tooth positions jitter by up
+    to `jitter` ticks per sweep & Gaussian noise is added on top.
+
+    Returns
+    -------
+    `dict` with `x_data`, `y_data`, `v_data` (`None` without `voltage`), the true tau of every
+    tooth in ticks (`tau`) & pipeline parameters (`params`, keyed like `pipeline.DEFAULT_PARAMS`)
+    that should recover them
+    """
+
+    rng = np.random.default_rng(seed)
+    tau = np.linspace(100, 200, teeth) if tau is None else np.asarray(tau, dtype=float)
+    sweep = samples_per_group
+    positions = np.linspace(0.3, 0.7, teeth) # fraction of the sweep
+    spacing = 0.4 * sweep / max(teeth-1, 1)
+    if 0.1*sweep < 8*tau.max() or spacing < 8*tau.max() + 2*rise:
+        raise ValueError('samples_per_group too small for these tau values')
+
+    # Lead-in (no teeth) so the first group doesn't run off the start
+    lead = int(0.6 * sweep)
+    n = lead + n_groups * sweep
+    phase = (np.arange(n) - lead) % sweep / sweep
+    sweep_i = (np.arange(n) - lead) // sweep
+    if mirrored:
+        v_data = np.where(sweep_i % 2 == 0, phase, 1 - phase) * 0.01
+    else:
+        v_data = phase * 0.01
+
+    # Ringdown template for every tooth (build-up, then decay)
+    t = np.arange(int(spacing))
+    y_data = rng.normal(0, noise, n)
+    for s in range(n_groups):
+        reverse = mirrored and s % 2 != 0
+        for k in range(teeth):
+            center = lead + s*sweep + int((1 - positions[k] if reverse else positions[k]) * sweep) + rng.integers(-jitter, jitter+1)
+            i0 = center - rise
+            shape = np.concatenate([np.linspace(0, amplitude, rise, endpoint=False), amplitude * np.exp(-t / tau[k])])
+            lo, hi = max(i0, 0), min(i0 + len(shape), n)
+            if hi > lo:
+                y_data[lo:hi] += shape[lo-i0:hi-i0]
+
+    x_data = np.arange(n) * timestep
+    kept_groups = n_groups // 2 if mirrored else n_groups
+    peak_width = int(0.8 * spacing)
+
+    params = dict(pipeline.DEFAULT_PARAMS)
+    params.update({
+        'spin_timestep': timestep,
+        'combo_grouping_algo': 1,
+        'spin_min_voltage': 0.001,
+        'spin_max_voltage': 0.009,
+        'spin_group_len': 0.5 * sweep * timestep,
+        'spin_min_peakheight': amplitude / 2,
+        'spin_min_peakprominence': amplitude / 4,
+        'spin_moving_average_denom': 10,
+        'check_skip_groups': mirrored,
+        'spin_peak_overlap': peak_width,
+        'spin_min_peak_height_added': 0.0,
+        'spin_peak_prominence_added': amplitude * kept_groups / 4,
+        'spin_shift_over': peak_width // 2 - 2*rise,
+        'spin_var_a': amplitude,
+        'spin_var_tau': int(np.mean(tau)),
+        'spin_var_y0': 0.0,
+        'spin_shift_over_fit': 5,
+    })
+
+    return {
+        'x_data': x_data,
+        'y_data': y_data,
+        'v_data': v_data if voltage else None,
+        'tau': tau,
+        'params': params,
+    }
+
+def write_csv(filename: str, scan: dict):
+    """
+    Write a scan in the Zurich export format (`%` comments, `;` delimiter, header line)
+    """
+
+    columns = [scan['x_data'], scan['y_data']]
+    header = 'time;signal'
+    if scan['v_data'] is not None:
+        columns.append(scan['v_data'])
+        header += ';voltage'
+    with open(filename, 'w') as f:
+        f.write('% Synthetic CRDS scan\n')
+        f.write(header + '\n')
+        np.savetxt(f, np.column_stack(columns), delimiter=';', fmt='%.10g')
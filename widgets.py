@@ -1,4 +1,5 @@
 import numpy as np
+from collections import OrderedDict
 from PyQt5 import QtWidgets
 import matplotlib
 matplotlib.use('Qt5Agg')
@@ -6,8 +7,8 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationTool
 from matplotlib.figure import Figure
 from matplotlib import colors
 from matplotlib import pyplot as plt
-from db import mem
-from crds_calc import exp_func
+from db import session
+from profiling import profiler
 
 class MplCanvas(FigureCanvasQTAgg):
     def __init__(self, parent=None, width=5, height=4, dpi=100):
@@ -50,7 +51,7 @@ class BaseGraph(QtWidgets.QWidget):
         self.setLayout(layout)
         
     def plot_data(self):
-        self.canv.axes.plot(mem['x_data'], mem['y_data'])
+        self.canv.axes.plot(session.x_data, session.y_data)
 
     def plot(self):
         try:
@@ -63,17 +64,117 @@ class BaseGraph(QtWidgets.QWidget):
     def clear(self):
         self.canv.axes.clear()
 
-class RawDataGraph(BaseGraph):
-    pass
+class MinMaxPyramid:
+    """
+    Multi-resolution min/max envelope of a (time-sorted) signal, for drawing huge traces.
+
+    Level k holds the min & max of every `base_bucket * factor**k` samples. A query picks the
+    coarsest level that still gives at least `n_points` values over the visible range (merging
+    its buckets down to about that many), so a plot of the envelope looks the same as a plot
+    of the raw data at screen resolution.
+    """
+
+    def __init__(self, x_data: np.array, y_data: np.array, base_bucket: int = 16, factor: int = 4):
+        self.x_data = x_data
+        self.y_data = y_data
+        self.levels = [] # (bucket size, mins, maxs)
+
+        bucket = base_bucket
+        n = len(y_data) // bucket * bucket
+        if n == 0:
+            return
+        mins = y_data[:n].reshape(-1, bucket).min(axis=1)
+        maxs = y_data[:n].reshape(-1, bucket).max(axis=1)
+        while True:
+            self.levels.append((bucket, mins, maxs))
+            n = len(mins) // factor * factor
+            if n < 2*factor:
+                break
+            mins = mins[:n].reshape(-1, factor).min(axis=1)
+            maxs = maxs[:n].reshape(-1, factor).max(axis=1)
+            bucket *= factor
+
+    def query(self, xmin: float, xmax: float, n_points: int):
+        """
+        Returns
+        -------
+        x & y values to draw for the `xmin`-`xmax` range
+        """
+
+        i0, i1 = np.searchsorted(self.x_data, [xmin, xmax])
+        i0, i1 = max(i0-1, 0), min(i1+1, len(self.x_data)) # reach just past the edges
+        if i1 - i0 <= n_points:
+            return self.x_data[i0:i1], self.y_data[i0:i1]
+
+        # Coarsest level that still gives >= n_points values in range (2 per bucket)
+        levels = [level for level in self.levels if 2 * ((i1 - i0) // level[0]) >= n_points]
+        if not levels:
+            # Zoomed in past the finest level: envelope the raw samples on the fly
+            offsets = np.arange(0, i1 - i0, max((i1 - i0) // max(n_points // 2, 1), 1))
+            seg = self.y_data[i0:i1]
+            return np.repeat(self.x_data[i0 + offsets], 2), np.column_stack([np.minimum.reduceat(seg, offsets), np.maximum.reduceat(seg, offsets)]).ravel()
+
+        bucket, mins, maxs = levels[-1]
+        b0, b1 = i0 // bucket, min(-(-i1 // bucket), len(mins))
+        xs = np.repeat(self.x_data[np.arange(b0, b1) * bucket], 2)
+        ys = np.column_stack([mins[b0:b1], maxs[b0:b1]]).ravel()
+
+        # Samples past the last full bucket of this level: envelope them on the fly
+        tail = len(mins) * bucket
+        if i1 > tail:
+            offsets = np.arange(0, i1 - tail, bucket)
+            seg = self.y_data[tail:i1]
+            xs = np.concatenate([xs, np.repeat(self.x_data[tail + offsets], 2)])
+            ys = np.concatenate([ys, np.column_stack([np.minimum.reduceat(seg, offsets), np.maximum.reduceat(seg, offsets)]).ravel()])
+
+        # Levels are `factor` apart: merge neighbouring buckets down to ~n_points values
+        merge = len(xs) // max(n_points, 2)
+        if merge > 1:
+            offsets = np.arange(0, len(xs) // 2, merge)
+            xs = np.repeat(xs[2*offsets], 2)
+            ys = np.column_stack([np.minimum.reduceat(ys[0::2], offsets), np.maximum.reduceat(ys[1::2], offsets)]).ravel()
+        return xs, ys
+
+class DecimatedGraph(BaseGraph):
+    """
+    Graph for full-length traces: only draws a min/max envelope of ~2x screen width points
+    for the visible range & re-decimates whenever the x-limits change (pan/zoom).
+    """
+
+    color = None
+
+    def get_data(self):
+        return session.x_data, session.y_data
+
+    def target_points(self):
+        return 2 * max(self.canv.width(), 1000)
 
-class VoltageGraph(BaseGraph):
     def plot_data(self):
-        if not mem['v_data'][0] == None:
-            self.canv.axes.plot(mem['x_data'], mem['v_data'], color='orange')
+        x_data, y_data = self.get_data()
+        if x_data is None or y_data is None or len(x_data) == 0:
+            return
+        self.pyramid = MinMaxPyramid(x_data, y_data)
+        xs, ys = self.pyramid.query(x_data[0], x_data[-1], self.target_points())
+        self.line, = self.canv.axes.plot(xs, ys, color=self.color)
+        self.canv.axes.callbacks.connect('xlim_changed', self.redecimate) # axes.clear() drops this, so reconnect every plot
+
+    def redecimate(self, axes):
+        xmin, xmax = axes.get_xlim()
+        self.line.set_data(*self.pyramid.query(xmin, xmax, self.target_points()))
+        self.canv.draw_idle()
+
+class RawDataGraph(DecimatedGraph):
+    pass
+
+class VoltageGraph(DecimatedGraph):
+    color = 'orange'
+
+    def get_data(self):
+        return session.x_data, session.v_data
 
 class PeaksGraph(BaseGraph):
     def plot_data(self):
-        for i in mem['groups_correlated']:
+        for i in session.groups_correlated:
             self.canv.axes.plot(i)
 
 class AddedPeaksGraph(BaseGraph):
@@ -88,10 +189,10 @@ class AddedPeaksGraph(BaseGraph):
         self.params['shift_over'] = shift_over
 
     def plot_data(self):
-        self.canv.axes.plot(mem['added_peaks'], color='green') # plot added peaks
+        self.canv.axes.plot(session.added_peaks, color='green') # plot added peaks
 
         if not self.params['peak_width'] == None: # plot peak indices
-            for i in mem['peak_indices']: 
+            for i in session.peak_indices: 
                 self.canv.axes.axvspan(int(i-self.params['peak_width']/2+self.params['shift_over']), int(i+self.params['peak_width']/2+self.params['shift_over']), color='red', alpha=0.4)
                 
 class FitGraph(BaseGraph):
@@ -101,36 +202,86 @@ class FitGraph(BaseGraph):
     def set_peak_index(self, i):
         self.peak_index = i
         
-    def plot_data(self):
-        resid = []
-        for g_i in range(len(mem['isolated_peaks'])):
-            peak = mem['isolated_peaks'][g_i][self.peak_index]
+    def plot_data(self): # Fit curve = data - residuals, so nothing gets re-evaluated here
+        for g_i in range(len(session.isolated_peaks)):
+            peak = session.isolated_peaks[g_i, self.peak_index]
+            resid = session.residuals[g_i, self.peak_index, :len(peak)]
+            fitted = ~np.isnan(resid)
             x_data = np.arange(len(peak))
-            x_data_target = x_data[mem['overlayed_peak_indices'][g_i][self.peak_index]+mem['shift_over_fit']:]
-            peak_target = peak[mem['overlayed_peak_indices'][g_i][self.peak_index]+mem['shift_over_fit']:]
-            popt = mem['fit_equations'][g_i][self.peak_index]['popt']
             self.canv.axes.plot(peak)
-            self.canv.axes.plot(x_data_target, exp_func(x_data_target, *popt), color='red')
-            
-            resid.append(peak_target - exp_func(x_data_target, *popt)),
-            self.canv.axes.plot(x_data_target, peak_target - exp_func(x_data_target, *popt), c='green')
-        mem['residuals'] = resid
+            self.canv.axes.plot(x_data[fitted], peak[fitted] - resid[fitted], color='red')
+            self.canv.axes.plot(x_data[fitted], resid[fitted], c='green')
+
+class LazyGraphViewer(QtWidgets.QTabWidget):
+    """
+    One tab per comb tooth, but graphs are only created & drawn when their tab is shown.
+
+    At most `max_live_graphs` graph widgets (each with its own figure) exist at a time.
+    Past that, the least recently shown one gets moved to the newly shown tab & redrawn,
+    so canvases are reused rather than piling up for every tooth.
+    """
+
+    graph_class = None
+    max_live_graphs = 6
 
-class FitsGraphViewer(QtWidgets.QTabWidget):
     def __init__(self, x):
-        super(FitsGraphViewer, self).__init__(x)
+        super().__init__(x)
         layout = QtWidgets.QGridLayout()
         self.setLayout(layout)
+        self.graphs = OrderedDict() # tab index -> graph, least recently shown first
+        self.stale = set() # tabs whose graph still shows data from a previous plot
+        self.currentChanged.connect(self.show_tab)
+
+    def tab_count(self):
+        raise NotImplementedError
+
+    def plot(self): # Create (empty) tabs; only the current one gets drawn
+        count = self.tab_count()
+
+        self.blockSignals(True)
+        while self.count() > count:
+            i = self.count() - 1
+            page = self.widget(i)
+            self.removeTab(i)
+            self.graphs.pop(i, None)
+            page.deleteLater()
+        while self.count() < count:
+            page = QtWidgets.QWidget()
+            page_layout = QtWidgets.QVBoxLayout()
+            page_layout.setContentsMargins(0, 0, 0, 0)
+            page.setLayout(page_layout)
+            self.addTab(page, str(self.count()+1))
+        self.blockSignals(False)
+
+        self.stale = set(self.graphs)
+        self.show_tab(self.currentIndex())
+
+    def show_tab(self, i):
+        if i < 0:
+            return
+
+        if i in self.graphs:
+            self.graphs.move_to_end(i)
+            if i in self.stale:
+                self.stale.discard(i)
+                self.graphs[i].plot()
+            return
+
+        if len(self.graphs) >= self.max_live_graphs:
+            j, graph = self.graphs.popitem(last=False) # reuse least recently shown canvas
+            self.stale.discard(j)
+        else:
+            graph = self.graph_class(self)
+        self.widget(i).layout().addWidget(graph) # reparents graph onto this tab
+        graph.set_peak_index(i)
+        self.graphs[i] = graph
+        graph.plot()
 
-    def plot(self): # Create tabs & plot ALL data (each individual graph)
-        self.clear()
+class FitsGraphViewer(LazyGraphViewer):
+    graph_class = FitGraph
 
-        for p_i in range(len(mem['isolated_peaks'][0])):
-            tab_name = str(p_i+1)
-            fit_graph = FitGraph(self)
-            fit_graph.set_peak_index(p_i)
-            self.addTab(fit_graph, tab_name)
-            fit_graph.plot()
+    def tab_count(self):
+        return session.isolated_peaks.n_teeth
 
 # class FitsGraph(BaseGraph):
     
@@ -139,11 +290,11 @@ class FitsGraphViewer(QtWidgets.QTabWidget):
         
 #     # def plot_data(self):
         
-#     #     for g_i in range(len(mem['isolated_peaks'])):
-#     #         for p_i in range(len(mem['isolated_peaks'][g_i])):
-#     #             peak = mem['isolated_peaks'][g_i][p_i]
+#     #     for g_i in range(len(session.isolated_peaks)):
+#     #         for p_i in range(len(session.isolated_peaks[g_i])):
+#     #             peak = session.isolated_peaks[g_i][p_i]
 #     #             x_data = np.arange(len(peak))
-#     #             popt = mem['fit_equations'][g_i][p_i]['popt']
+#     #             popt = session.fit_equations[g_i][p_i]['popt']
 #     #             self.canv.axes.plot(peak)
 #     #             self.canv.axes.plot(x_data, exp_func(x_data, *popt), color='red')
     
@@ -154,15 +305,15 @@ class FitsGraphViewer(QtWidgets.QTabWidget):
 #         except AttributeError:
 #             pass
 
-#         subplots_stacked = len(mem['isolated_peaks'][0]) # should all be same length
+#         subplots_stacked = len(session.isolated_peaks[0]) # should all be same length
 #         axes = self.canv.figure.subplots(subplots_stacked, 1, sharex=True)
         
-#         for g_i in range(len(mem['isolated_peaks'])):
+#         for g_i in range(len(session.isolated_peaks)):
 #             for p_i in range(subplots_stacked):
-#                 peak = mem['isolated_peaks'][g_i][p_i]
+#                 peak = session.isolated_peaks[g_i][p_i]
 #                 axes[p_i].plot(peak)
 #                 # x_data = np.arange(len(peak))
-#                 # popt = mem['fit_equations'][g_i][p_i]['popt']
+#                 # popt = session.fit_equations[g_i][p_i]['popt']
 #                 # axes[p_i].plot(x_data, exp_func(x_data, *popt), color='red')
 
 #         # for ax in axs.flat:
@@ -178,23 +329,74 @@ class TimeConstantGraph(BaseGraph):
         self.peak_index = i
 
     def plot_data(self):
-        data = []
-        for g_i in range(len(mem['time_constants'])):
-            data.append(mem['time_constants'][g_i][self.peak_index])
-        self.canv.axes.hist(data, bins='auto', edgecolor='black')
+        data = session.time_constants[:, self.peak_index]
+        accepted = ~np.isnan(data)
+        if session.quality is not None: # rejected fits drawn separately
+            rejected = accepted & ~session.quality['accepted'][:, self.peak_index]
+            accepted &= ~rejected
+            if rejected.any():
+                self.canv.axes.plot(data[rejected], np.zeros(rejected.sum()), 'x', color='gray')
+        self.canv.axes.hist(data[accepted], bins='auto', edgecolor='black')
+        stats = session.tau_stats
+        if stats is not None:
+            i = self.peak_index
+            self.canv.axes.axvline(stats['median'][i], color='red')
+            self.canv.axes.axvspan(stats['ci_low'][i], stats['ci_high'][i], color='red', alpha=0.2)
 
-class TimeConstantGraphsViewer(QtWidgets.QTabWidget):
-    def __init__(self, x):
-        super(TimeConstantGraphsViewer, self).__init__(x)
-        layout = QtWidgets.QGridLayout()
-        self.setLayout(layout)
+class TimeConstantGraphsViewer(LazyGraphViewer):
+    graph_class = TimeConstantGraph
+
+    def tab_count(self):
+        return session.time_constants.shape[1]
+
+class TimingPanel(QtWidgets.QDockWidget):
+    """
+    Per-stage wall time, CPU time, peak memory & item counts from `profiler`
+    """
+
+    columns = ['Stage', 'Calls', 'Wall (s)', 'CPU (s)', 'Peak MB', 'Items', 'Items/s']
+
+    def __init__(self, parent=None):
+        super().__init__('Timing', parent)
+        self.table = QtWidgets.QTableWidget(0, len(self.columns))
+        self.table.setHorizontalHeaderLabels(self.columns)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.clear_button = QtWidgets.QPushButton('Clear')
+        self.clear_button.pressed.connect(self.clear)
+        self.check_trace_memory = QtWidgets.QCheckBox('Trace memory (slows stages down)')
+        self.check_trace_memory.setChecked(profiler.trace_memory)
+        self.check_trace_memory.toggled.connect(lambda checked: setattr(profiler, 'trace_memory', checked))
 
-    def plot(self): # Create tabs & plot ALL data (each individual graph)
-        self.clear()
+        layout = QtWidgets.QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.table)
+        buttons = QtWidgets.QHBoxLayout()
+        buttons.addWidget(self.check_trace_memory)
+        buttons.addWidget(self.clear_button)
+        layout.addLayout(buttons)
+        container = QtWidgets.QWidget()
+        container.setLayout(layout)
+        self.setWidget(container)
+
+    def clear(self):
+        profiler.clear()
+        self.refresh()
 
-        for p_i in range(len(mem['time_constants'][0])):
-            tab_name = str(p_i+1)
-            tau_graph = TimeConstantGraph(self)
-            tau_graph.set_peak_index(p_i)
-            self.addTab(tau_graph, tab_name)
-            tau_graph.plot()
+    def refresh(self):
+        totals = profiler.totals()
+        self.table.setRowCount(len(totals))
+        for r_i, t in enumerate(totals):
+            rate = t['items'] / t['wall'] if t['items'] is not None and t['wall'] > 0 else None
+            row = [
+                t['name'],
+                str(t['calls']),
+                f"{t['wall']:.3f}",
+                f"{t['cpu']:.3f}",
+                '-' if t['peak_memory'] is None else f"{t['peak_memory'] / 2**20:.1f}",
+                '-' if t['items'] is None else str(t['items']),
+                '-' if rate is None else f"{rate:.0f}",
+            ]
+            for c_i, text in enumerate(row):
+                self.table.setItem(r_i, c_i, QtWidgets.QTableWidgetItem(text))
+        self.table.resizeColumnsToContents()
@@ -0,0 +1,130 @@
+import traceback
+from PyQt5 import QtWidgets, QtCore
+
+class Cancelled(Exception):
+    pass
+
+class JobSignals(QtCore.QObject):
+    progress = QtCore.pyqtSignal(int, int)
+    finished = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+    cancelled = QtCore.pyqtSignal()
+
+class Job(QtCore.QRunnable):
+    """
+    Runs `fn(progress)` on a pool thread. `fn` gets a `progress(done, total)` callback
+    to pass down to the `crds_calc` stages; once `cancel()` is called, the next
+    progress report raises `Cancelled` and the stage unwinds.
+    """
+
+    def __init__(self, fn):
+        super().__init__()
+        self.fn = fn
+        self.signals = JobSignals()
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def report_progress(self, done, total):
+        if self._cancelled:
+            raise Cancelled()
+        self.signals.progress.emit(int(done), int(total))
+
+    def run(self):
+        try:
+            result = self.fn(self.report_progress)
+        except Cancelled:
+            self.signals.cancelled.emit()
+        except ValueError as e: # stages raise ValueError w/ a user-facing message
+            self.signals.failed.emit(str(e))
+        except Exception:
+            self.signals.failed.emit(traceback.format_exc())
+        else:
+            if self._cancelled:
+                self.signals.cancelled.emit()
+            else:
+                self.signals.finished.emit(result)
+
+class JobRunner(QtCore.QObject):
+    """
+    Runs one pipeline stage at a time off the GUI thread, with a progress bar &
+    cancel button in the status bar. Stage buttons are disabled while a job runs.
+    """
+
+    failed = QtCore.pyqtSignal(str)
+    idle = QtCore.pyqtSignal() # a job ended (finished, failed or cancelled)
+
+    def __init__(self, statusbar: QtWidgets.QStatusBar, buttons: list):
+        super().__init__(statusbar)
+        self.statusbar = statusbar
+        self.buttons = buttons
+        self.pool = QtCore.QThreadPool.globalInstance()
+        self.job = None
+
+        self.label = QtWidgets.QLabel()
+        self.progress_bar = QtWidgets.QProgressBar()
+        self.progress_bar.setMaximumWidth(250)
+        self.cancel_button = QtWidgets.QPushButton('Cancel')
+        self.cancel_button.pressed.connect(self.cancel)
+        for w in [self.label, self.progress_bar, self.cancel_button]:
+            statusbar.addPermanentWidget(w)
+        self.set_busy(False)
+
+    def set_busy(self, busy: bool):
+        self.label.setVisible(busy)
+        self.progress_bar.setVisible(busy)
+        self.cancel_button.setVisible(busy)
+        self.cancel_button.setEnabled(busy)
+        for b in self.buttons:
+            b.setEnabled(not busy)
+
+    def is_running(self):
+        return self.job is not None
+
+    def start(self, name: str, fn, on_done):
+        """
+        Run `fn(progress)` in the background; `on_done(result)` is called on the GUI thread.
+        """
+
+        if self.is_running():
+            return
+        job = Job(fn)
+        job.signals.progress.connect(self.on_progress)
+        job.signals.finished.connect(lambda result: self.on_finished(job, on_done, result))
+        job.signals.failed.connect(lambda message: self.on_failed(job, message))
+        job.signals.cancelled.connect(lambda: self.on_cancelled(job))
+        self.job = job
+
+        self.label.setText(f"{name}...")
+        self.progress_bar.setRange(0, 0) # busy indicator until the first report
+        self.set_busy(True)
+        self.pool.start(job)
+
+    def cancel(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.cancel_button.setEnabled(False)
+            self.label.setText('Cancelling...')
+
+    def on_progress(self, done, total):
+        self.progress_bar.setRange(0, max(total, 1))
+        self.progress_bar.setValue(done)
+
+    def finish(self, job):
+        if job is self.job:
+            self.job = None
+            self.set_busy(False)
+            self.idle.emit()
+
+    def on_finished(self, job, on_done, result):
+        self.finish(job)
+        on_done(result)
+
+    def on_failed(self, job, message):
+        self.finish(job)
+        self.failed.emit(message)
+
+    def on_cancelled(self, job):
+        self.finish(job)
+        self.statusbar.showMessage('Cancelled.', 3000)